@@ -1,6 +1,10 @@
-from llama_cpp import Llama
 import os
 import json
+import time
+from prompt_cache import prompt_state_cache, result_cache
+
+# Version of the modification prompt, part of the result cache key
+PROMPT_TEMPLATE_VERSION = "3"
 
 # Path to Llama 3.2 model (update this path to where your model is installed)
 MODEL_PATH = "C:/Users/Fabian/Downloads/Llama-3.2-3B-Instruct-Q6_K_L.gguf"  # Update this to your actual model path
@@ -8,16 +12,102 @@ MODEL_PATH = "C:/Users/Fabian/Downloads/Llama-3.2-3B-Instruct-Q6_K_L.gguf"  # Up
 # Initialize the Llama model
 model = None
 
+# Load and warm-up state of the model, reported by /ready
+model_state = {"status": "not loaded"}
+
 def initialize_model():
     global model
     if model is None and os.path.exists(MODEL_PATH):
+        # Imported on first use, the server starts without loading llama.cpp
+        from llama_cpp import Llama
+
+        model_state["status"] = "loading"
+        start = time.perf_counter()
         model = Llama(
             model_path=MODEL_PATH,
             n_ctx=4096,  # Context window
             n_gpu_layers=-1  # Use all available GPU layers
         )
+        model_state.update({"status": "loaded", "load_ms": round((time.perf_counter() - start) * 1000, 3)})
     return model is not None
 
+def warm_up():
+    """
+    Load the model and run a one token completion, so the first user
+    request does not pay for loading the weights.
+    """
+    if model_state["status"] == "ready":
+        return get_model_status()
+    try:
+        if not initialize_model():
+            model_state.update({"status": "unavailable", "error": f"Model not found at {MODEL_PATH}"})
+            return get_model_status()
+        start = time.perf_counter()
+        model.create_completion("Hello", max_tokens=1)
+        model_state.update({"status": "ready", "warm_up_ms": round((time.perf_counter() - start) * 1000, 3)})
+    except Exception as e:
+        model_state.update({"status": "error", "error": str(e)})
+    return get_model_status()
+
+def get_model_status():
+    """Load state of the model, without loading it"""
+    return dict(model_state)
+
+def _build_chat_prompt(user_input: str, context: str = ""):
+    """
+    Create a prompt with context about the IFC file if provided.
+
+    Returns:
+        Tuple of the prefix shared by all turns on the same file and the
+        rest of the prompt
+    """
+    if context:
+        prefix = f"""Context about the IFC model:
+{context}
+
+"""
+        return prefix, f"""User request: {user_input}
+
+Based on the IFC model information above, please provide a detailed response to the user's request.
+If the user wants to modify the IFC model, explain what needs to be changed and how.
+"""
+    return "", f"User: {user_input}\nAssistant: "
+
+def _prepare_prompt(prefix: str, suffix: str):
+    """
+    Restore the saved state of the prompt prefix, so only the suffix is evaluated.
+
+    Returns:
+        Tuple of the full prompt and the prefix cache statistics
+    """
+    stats = {}
+    if prefix:
+        stats = prompt_state_cache.prepare(model, prefix)
+    return prefix + suffix, stats
+
+def _reset_llama_timings():
+    try:
+        import llama_cpp
+        llama_cpp.llama_reset_timings(model._ctx.ctx)
+    except Exception:
+        pass
+
+def _llama_timings():
+    """Prompt evaluation (prefill) and decoding time of the last completion, as measured by llama.cpp"""
+    try:
+        import llama_cpp
+        timings = llama_cpp.llama_get_timings(model._ctx.ctx)
+        return {"prefill_ms": round(timings.t_p_eval_ms, 3), "decode_ms": round(timings.t_eval_ms, 3)}
+    except Exception:
+        return {}
+
+def get_cache_stats():
+    """Statistics of the prompt state and result caches"""
+    return {
+        "prompt_states": prompt_state_cache.stats(),
+        "modification_results": result_cache.stats()
+    }
+
 def chat_with_ai(user_input: str, context: str = ""):
     """
     Send user input to Llama 3.2 and return the response.
@@ -30,18 +120,7 @@ def chat_with_ai(user_input: str, context: str = ""):
         if not initialize_model():
             return "Error: Model not initialized. Please check if the model file exists."
 
-        # Create a prompt with context about the IFC file if provided
-        if context:
-            prompt = f"""Context about the IFC model:
-{context}
-
-User request: {user_input}
-
-Based on the IFC model information above, please provide a detailed response to the user's request.
-If the user wants to modify the IFC model, explain what needs to be changed and how.
-"""
-        else:
-            prompt = f"User: {user_input}\nAssistant: "
+        prompt, _ = _prepare_prompt(*_build_chat_prompt(user_input, context))
 
         # Get response from Llama model
         response = model.create_completion(
@@ -56,42 +135,153 @@ If the user wants to modify the IFC model, explain what needs to be changed and
     except Exception as e:
         return f"Error: {str(e)}"
 
-def parse_modification_request(user_input: str, ifc_data: dict):
+def stream_chat_with_ai(user_input: str, context: str = "", cancel_event=None, stats: dict = None):
     """
-    Parse a user request to determine what modifications to make to the IFC file.
-    
+    Send user input to Llama 3.2 and yield the response piece by piece.
+
     Args:
-        user_input: The user's request
-        ifc_data: Dictionary containing information about IFC entities
-        
-    Returns:
-        Dictionary with modification instructions
+        user_input: The user's message
+        context: Additional context about the IFC file
+        cancel_event: Optional threading.Event, generation stops once it is set
+        stats: Optional dictionary receiving the token counts, tokens/s and
+            the prompt building, prefill and decoding times
+
+    Yields:
+        Text fragments of the response as they are generated
     """
+    if not initialize_model():
+        yield "Error: Model not initialized. Please check if the model file exists."
+        return
+
+    build_start = time.perf_counter()
+    prompt, prefix_stats = _prepare_prompt(*_build_chat_prompt(user_input, context))
+    prompt_tokens = len(model.tokenize(prompt.encode("utf-8")))
+    prompt_build_ms = (time.perf_counter() - build_start) * 1000 - prefix_stats.get("prefix_ms", 0.0)
+
+    start = time.perf_counter()
+    first_token_at = None
+    stream = model.create_completion(
+        prompt,
+        max_tokens=512,
+        temperature=0.7,
+        top_p=0.95,
+        stop=["User:", "\n\n"],
+        stream=True
+    )
+    tokens = 0
     try:
-        if not initialize_model():
-            return {"error": "Model not initialized"}
+        for chunk in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            # Every streamed chunk is one generated token
+            tokens += 1
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            text = chunk["choices"][0]["text"]
+            if text:
+                yield text
+    finally:
+        # Closing the completion generator stops the decoding loop
+        stream.close()
+        if stats is not None:
+            end = time.perf_counter()
+            seconds = end - start
+            stats.update({
+                **prefix_stats,
+                "prompt_build_ms": round(prompt_build_ms, 3),
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": tokens,
+                "generation_ms": round(seconds * 1000, 3),
+                "tokens_per_s": round(tokens / seconds, 2) if seconds > 0 else 0.0
+            })
+            if first_token_at is not None:
+                # Evaluating the prompt ends with the first token
+                stats["prefill_ms"] = round((first_token_at - start) * 1000, 3)
+                stats["decode_ms"] = round((end - first_token_at) * 1000, 3)
 
-        # Create a structured prompt to extract modification details
-        entities_json = json.dumps(ifc_data, indent=2)
-        prompt = f"""
-Here is information about IFC entities in a building model:
-{entities_json}
+def _build_modification_prompt(user_input: str, ifc_data: dict, context: dict = None):
+    """
+    Create the prompt of the modification parser.
 
-User request: "{user_input}"
+    Returns:
+        Tuple of the prefix shared by all requests on the same file and the
+        rest of the prompt
+    """
+    if context and "context" in context:
+        entities_context = f"Project: {ifc_data.get('ProjectName', 'Unnamed Project')}\n{context.get('summary', '')}"
+        details = context.get("details", "")
+    else:
+        entities_context = json.dumps(ifc_data, indent=2)
+        details = ""
 
-Based on the user request, extract the following information in JSON format:
+    prefix = f"""
+Here is information about IFC entities in a building model:
+{entities_context}
+
+Extract the modification the user requests in the following JSON format:
 {{
   "entity_type": "The type of entity to modify (e.g., 'IfcWall', 'IfcWindow', etc.)",
   "entity_ids": ["List of specific entity IDs to modify, or 'all' for all entities of this type"],
+  "selector": "Optional selector for entities chosen by storey, material or property, e.g. IfcDoor[storey=\"Level 2\"][Pset_DoorCommon.FireRating=EI30] or IfcWall[material=Concrete]",
   "property": "The property to modify (e.g., 'color', 'material', 'dimension')",
   "new_value": "The new value for the property",
   "confidence": "A number between 0 and 1 indicating confidence in this interpretation"
 }}
+"""
+    suffix = ""
+    if details:
+        suffix += f"""
+Entities relevant to the request:
+{details}
+"""
+    suffix += f"""
+User request: "{user_input}"
 
 JSON response:
 """
+    return prefix, suffix
+
+def parse_modification_request(user_input: str, ifc_data: dict, context: dict = None, content_hash: str = None):
+    """
+    Parse a user request to determine what modifications to make to the IFC file.
+    
+    Args:
+        user_input: The user's request
+        ifc_data: Dictionary containing information about IFC entities
+        context: Packed file context from build_modification_context, used
+            instead of the whole ifc_data when given
+        content_hash: Content hash of the file, enables the result cache
+        
+    Returns:
+        Dictionary with modification instructions
+    """
+    try:
+        # The same instruction on the same content was parsed before
+        cache_key = None
+        if content_hash:
+            cache_key = result_cache.key(content_hash, user_input, PROMPT_TEMPLATE_VERSION)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                cached["prompt_stats"] = {**cached.get("prompt_stats", {}), "result_cache": "hit"}
+                return cached
+
+        if not initialize_model():
+            return {"error": "Model not initialized"}
+
+        # Create a structured prompt to extract modification details
+        build_start = time.perf_counter()
+        prompt_stats = dict(context.get("stats", {})) if context else {}
+        prefix, suffix = _build_modification_prompt(user_input, ifc_data, context)
+        prompt, prefix_stats = _prepare_prompt(prefix, suffix)
+        prompt_stats.update(prefix_stats)
+        prompt_stats["prompt_tokens"] = len(model.tokenize(prompt.encode("utf-8")))
+        prompt_stats["prompt_build_ms"] = round(
+            (time.perf_counter() - build_start) * 1000 - prefix_stats.get("prefix_ms", 0.0), 3
+        )
 
         # Get structured response from model
+        _reset_llama_timings()
+        start = time.perf_counter()
         response = model.create_completion(
             prompt,
             max_tokens=256,
@@ -99,12 +289,21 @@ JSON response:
             top_p=0.95,
             stop=["\n\n"]
         )
+        seconds = time.perf_counter() - start
+        prompt_stats["completion_ms"] = round(seconds * 1000, 3)
+        completion_tokens = response.get("usage", {}).get("completion_tokens", 0)
+        prompt_stats["completion_tokens"] = completion_tokens
+        prompt_stats["tokens_per_s"] = round(completion_tokens / seconds, 2) if seconds > 0 else 0.0
+        prompt_stats.update(_llama_timings())
 
         result_text = response["choices"][0]["text"].strip()
 
         # Try to parse the JSON response
         try:
             modification = json.loads(result_text)
+            modification["prompt_stats"] = prompt_stats
+            if cache_key:
+                result_cache.put(cache_key, modification)
             return modification
         except json.JSONDecodeError:
             # If JSON parsing fails, return a basic response
@@ -114,8 +313,9 @@ JSON response:
                 "property": "unknown",
                 "new_value": "unknown",
                 "confidence": 0.0,
-                "raw_response": result_text
+                "raw_response": result_text,
+                "prompt_stats": prompt_stats
             }
 
     except Exception as e:
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
@@ -0,0 +1,385 @@
+"""
+Benchmark of the backend on synthetic models of growing size.
+
+For each model size the stages below run in a fresh process, so the peak
+RSS reported for a stage is that of the stage and the model it works on,
+not of the stages before it:
+
+    upload       stream the file into the content store, hashing it
+    open         parse the file with ifcopenshell
+    metadata     process_ifc_file, the metadata returned on upload
+    summary      get_entity_summary, the chat context of the file
+    context      build_modification_context for an instruction
+    parse        parse_modification_request with a stubbed LLM
+    query        query_entities with a storey, material and property filter
+    modify_name, modify_color, modify_material
+                 modify_ifc_entities on all walls, including the write
+    write        write the unmodified model
+
+Except for upload and open, the model is parsed and put into the model cache
+before the stage starts, like on a server that already opened the file; the
+time it took is reported as setup_seconds. The LLM is replaced by a stub
+returning a fixed answer, so the benchmark runs offline and measures the
+backend, not the model.
+
+Synthetic models are generated once per parameter set and reused from the
+work directory. Results are written as JSON, pass the file of an earlier run
+with --baseline to compare against it.
+
+Usage:
+    python benchmarks/bench_backend.py --sizes 1000,10000,100000 [--psets 2 --materials 10]
+        [--stages metadata,summary] [--repeat 3] [--output results.json] [--baseline old.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+FILE_ID = "benchmark"
+
+INSTRUCTION = "change the material of the walls on level 2 to concrete"
+
+QUERY = 'IfcWall[storey="Level 2"][material="Material 2"][*.FireRating=EI30]'
+
+MODIFICATIONS = {
+    "modify_name": {"entity_type": "IfcWall", "entity_ids": ["all"], "property": "name", "new_value": "Renamed wall"},
+    "modify_color": {"entity_type": "IfcWall", "entity_ids": ["all"], "property": "color", "new_value": "red"},
+    "modify_material": {"entity_type": "IfcWall", "entity_ids": ["all"], "property": "material",
+                        "new_value": "Concrete"}
+}
+
+STAGES = ["upload", "open", "metadata", "summary", "context", "parse", "query",
+          "modify_name", "modify_color", "modify_material", "write"]
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class _StubLlama:
+    """Stands in for llama_cpp.Llama, answering every completion with the same modification"""
+
+    answer = json.dumps({"entity_type": "IfcWall", "entity_ids": ["all"], "property": "material",
+                         "new_value": "Concrete", "confidence": 0.9})
+
+    def tokenize(self, text: bytes):
+        # About four bytes per token, like the Llama tokenizer on English text
+        return list(range(len(text) // 4 + 1))
+
+    def reset(self):
+        pass
+
+    def eval(self, tokens):
+        pass
+
+    def save_state(self):
+        return object()
+
+    def load_state(self, state):
+        pass
+
+    def create_completion(self, prompt, **kwargs):
+        return {"choices": [{"text": self.answer}], "usage": {"completion_tokens": len(self.answer) // 4}}
+
+
+# Stages, run in the benchmark process. Each returns a dictionary of figures
+# to report next to the timing.
+
+async def _upload_chunks(file_path: str, chunk_size: int):
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _stage_upload(file_path: str, work_dir: str):
+    from storage import CHUNK_SIZE, ContentStore
+
+    store = ContentStore(os.path.join(work_dir, "store"))
+    content_hash, size, temp_path = asyncio.run(store.write_stream(_upload_chunks(file_path, CHUNK_SIZE)))
+    stored_path = store.commit(temp_path, content_hash, os.path.basename(file_path))
+    os.remove(stored_path)
+    return {"bytes": size}
+
+
+def _stage_open(file_path: str, work_dir: str):
+    import ifcopenshell
+
+    model = ifcopenshell.open(file_path)
+    return {"products": len(model.by_type("IfcProduct"))}
+
+
+def _stage_metadata(file_path: str, work_dir: str):
+    from ifc_handler import process_ifc_file
+
+    result = process_ifc_file(file_path, FILE_ID)
+    return {"response_bytes": len(json.dumps(result)), "error": result.get("error")}
+
+
+def _stage_summary(file_path: str, work_dir: str):
+    from ifc_handler import get_entity_summary
+
+    return {"response_bytes": len(get_entity_summary(file_path, FILE_ID))}
+
+
+def _stage_context(file_path: str, work_dir: str):
+    from ifc_handler import build_modification_context
+
+    result = build_modification_context(file_path, FILE_ID, INSTRUCTION)
+    return {"context_stats": result.get("stats"), "error": result.get("error")}
+
+
+def _stage_parse(file_path: str, work_dir: str):
+    import ai_chatbot
+    from ifc_handler import build_modification_context
+
+    ai_chatbot.model = _StubLlama()
+    context = build_modification_context(file_path, FILE_ID, INSTRUCTION)
+    result = ai_chatbot.parse_modification_request(INSTRUCTION, {}, context)
+    return {"prompt_stats": result.get("prompt_stats"), "error": result.get("error")}
+
+
+def _stage_query(file_path: str, work_dir: str):
+    from ifc_handler import query_entities
+
+    result = query_entities(file_path, FILE_ID, QUERY)
+    return {"count": result.get("count"), "index_build_ms": result.get("index_build_ms"),
+            "query_ms": result.get("query_ms"), "error": result.get("error")}
+
+
+def _stage_modify(modification: dict):
+    def stage(file_path: str, work_dir: str):
+        from ifc_handler import modify_ifc_entities
+
+        result = modify_ifc_entities(file_path, dict(modification), FILE_ID)
+        if "modified_file" in result:
+            os.remove(result["modified_file"])
+        return {"entities_modified": result.get("entities_modified"), "file_size": result.get("file_size"),
+                "file_size_delta": result.get("file_size_delta"), "error": result.get("error")}
+    return stage
+
+
+def _stage_write(file_path: str, work_dir: str):
+    import model_cache
+
+    model = model_cache.model_cache.get(FILE_ID, file_path)
+    output_path = os.path.join(work_dir, "written.ifc")
+    model.write(output_path)
+    size = os.path.getsize(output_path)
+    os.remove(output_path)
+    return {"file_size": size}
+
+
+_STAGE_FUNCTIONS = {
+    "upload": (_stage_upload, False),
+    "open": (_stage_open, False),
+    "metadata": (_stage_metadata, True),
+    "summary": (_stage_summary, True),
+    "context": (_stage_context, True),
+    "parse": (_stage_parse, True),
+    "query": (_stage_query, True),
+    **{name: (_stage_modify(modification), True) for name, modification in MODIFICATIONS.items()},
+    "write": (_stage_write, True)
+}
+
+
+def _run_stage(stage: str, file_path: str, work_dir: str, connection):
+    """Run one stage, in a process of its own, and send its figures back"""
+    try:
+        function, needs_model = _STAGE_FUNCTIONS[stage]
+        # Imported before the timing starts, what is left is the memory of the stage and its model
+        import ifcopenshell
+        import ai_chatbot
+        import ifc_handler
+        import model_cache
+        import storage
+
+        figures = {"baseline_rss_mb": _peak_rss_mb()}
+        if needs_model:
+            start = time.perf_counter()
+            model_cache.model_cache.put(FILE_ID, file_path, ifcopenshell.open(file_path))
+            figures["setup_seconds"] = round(time.perf_counter() - start, 4)
+            figures["setup_peak_rss_mb"] = _peak_rss_mb()
+
+        start = time.perf_counter()
+        details = function(file_path, work_dir)
+        figures["seconds"] = round(time.perf_counter() - start, 4)
+        figures["peak_rss_mb"] = _peak_rss_mb()
+        figures.update({key: value for key, value in details.items() if value is not None})
+        connection.send(figures)
+    except Exception as e:
+        connection.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        connection.close()
+
+
+def _run_generate(file_path: str, parameters: dict, connection):
+    from synthetic_model import generate_model
+
+    try:
+        connection.send(generate_model(file_path, **parameters))
+    except Exception as e:
+        connection.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        connection.close()
+
+
+def _in_process(target, *args):
+    """Run target(*args, connection) in a fresh process and return what it sends"""
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=target, args=(*args, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": "Benchmark process exited"}
+    process.join()
+    if process.exitcode:
+        result.setdefault("error", f"Benchmark process exited with code {process.exitcode}")
+    return result
+
+
+def model_path(work_dir: str, parameters: dict):
+    """Path of the synthetic model of a parameter set in the work directory"""
+    name = "synthetic_{elements}e_{psets}p_{properties}q_{materials}m_{storeys}s_{geometry:d}g_{seed}.ifc"
+    return os.path.join(work_dir, "models", name.format(**parameters))
+
+
+def benchmark_size(parameters: dict, stages, repeat: int, work_dir: str, regenerate: bool = False):
+    """
+    Benchmark the stages on the synthetic model of a parameter set.
+
+    Returns:
+        Dictionary with the model and the figures of each stage. Timings are
+        the median of the runs, peak RSS their maximum.
+    """
+    file_path = model_path(work_dir, parameters)
+    model = {"elements": parameters["elements"]}
+    if regenerate or not os.path.exists(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        generated = _in_process(_run_generate, file_path, parameters)
+        if "error" in generated:
+            return {**model, "error": generated["error"]}
+        model.update(entities=generated["entities"], generate_seconds=generated["generate_seconds"])
+    model["file_size"] = os.path.getsize(file_path)
+
+    results = {}
+    for stage in stages:
+        runs = [_in_process(_run_stage, stage, file_path, work_dir) for _ in range(repeat)]
+        errors = [run["error"] for run in runs if "error" in run]
+        if errors:
+            results[stage] = {"error": errors[0]}
+            continue
+        figures = dict(runs[-1])
+        seconds = [run["seconds"] for run in runs]
+        figures.update(
+            seconds=round(statistics.median(seconds), 4),
+            min_seconds=min(seconds),
+            peak_rss_mb=max(run["peak_rss_mb"] for run in runs),
+            runs=len(runs)
+        )
+        results[stage] = figures
+        print(f"  {stage:<16} {figures['seconds']:>9.3f} s  {figures['peak_rss_mb']:>8.1f} MB", file=sys.stderr)
+    return {**model, "stages": results}
+
+
+def compare(baseline: dict, current: dict):
+    """
+    Ratio of the stage timings and peak RSS of a run to those of a baseline
+    run, for the model sizes and stages both have. Below 1 is an improvement.
+    """
+    previous = {result["elements"]: result for result in baseline.get("results", [])}
+    comparison = []
+    for result in current["results"]:
+        before = previous.get(result["elements"])
+        if not before or "stages" not in before or "stages" not in result:
+            continue
+        stages = {}
+        for stage, figures in result["stages"].items():
+            old = before["stages"].get(stage)
+            if not old or "seconds" not in old or "seconds" not in figures:
+                continue
+            stages[stage] = {
+                "seconds": round(figures["seconds"] / old["seconds"], 3) if old["seconds"] else None,
+                "peak_rss_mb": round(figures["peak_rss_mb"] / old["peak_rss_mb"], 3) if old["peak_rss_mb"] else None
+            }
+        comparison.append({"elements": result["elements"], "stages": stages})
+    return comparison
+
+
+def _versions():
+    import ifcopenshell
+
+    return {"python": platform.python_version(), "ifcopenshell": ifcopenshell.version,
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="Comma separated element counts of the models, e.g. 1000,10000,100000,500000")
+    parser.add_argument("--psets", type=int, default=2, help="Property sets per element")
+    parser.add_argument("--properties", type=int, default=4, help="Properties per property set")
+    parser.add_argument("--materials", type=int, default=10, help="Number of materials")
+    parser.add_argument("--storeys", type=int, default=5, help="Number of storeys")
+    parser.add_argument("--no-geometry", action="store_true", help="Generate elements without geometry")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the models")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated stages to run")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each stage")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "sapcad-benchmark"),
+                        help="Directory of the generated models and temporary files")
+    parser.add_argument("--regenerate", action="store_true", help="Generate the models even if they exist")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in _STAGE_FUNCTIONS]
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(unknown)} (known: {', '.join(STAGES)})")
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": _versions(),
+        "parameters": {"psets": args.psets, "properties": args.properties, "materials": args.materials,
+                       "storeys": args.storeys, "geometry": not args.no_geometry, "seed": args.seed,
+                       "repeat": args.repeat, "llm": "stub"},
+        "results": []
+    }
+    for size in (int(size) for size in args.sizes.split(",")):
+        print(f"{size} elements", file=sys.stderr)
+        parameters = {"elements": size, "psets": args.psets, "properties": args.properties,
+                      "materials": args.materials, "storeys": args.storeys, "geometry": not args.no_geometry,
+                      "seed": args.seed}
+        report["results"].append(benchmark_size(parameters, stages, args.repeat, args.work_dir, args.regenerate))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(json.load(f), report)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
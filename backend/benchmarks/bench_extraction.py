@@ -0,0 +1,82 @@
+"""
+Benchmark of metadata extraction: per-entity relationship lookups
+(element_util.get_material / get_psets for every entity) against the
+one-pass RelationshipIndex used by process_ifc_file.
+
+Usage:
+    python benchmarks/bench_extraction.py path/to/model.ifc [--repeat 3]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ifcopenshell
+from ifc_handler import ENTITY_TYPES, _get_entity_info
+from relationship_index import RelationshipIndex
+
+
+def extract(model, use_index: bool):
+    """Extract the entity details of a model, returning them and the elapsed time"""
+    start = time.perf_counter()
+    index = RelationshipIndex(model) if use_index else None
+    details = {}
+    for entity_type in ENTITY_TYPES:
+        details[entity_type] = [
+            _get_entity_info(entity, entity_type, index=index) for entity in model.by_type(entity_type)
+        ]
+    return details, time.perf_counter() - start
+
+
+def compare(per_entity, indexed):
+    """Count entities whose properties, materials or colour differ between both paths"""
+    mismatches = 0
+    for entity_type, entities in per_entity.items():
+        for a, b in zip(entities, indexed[entity_type]):
+            for key in ("Properties", "Material", "Materials", "Color"):
+                if a.get(key) != b.get(key):
+                    mismatches += 1
+                    break
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file_path", help="IFC file to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each path")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    model = ifcopenshell.open(args.file_path)
+    open_seconds = time.perf_counter() - start
+    entity_count = sum(len(model.by_type(t)) for t in ENTITY_TYPES)
+
+    per_entity_times, indexed_times = [], []
+    per_entity, indexed = None, None
+    for _ in range(args.repeat):
+        per_entity, elapsed = extract(model, use_index=False)
+        per_entity_times.append(elapsed)
+        indexed, elapsed = extract(model, use_index=True)
+        indexed_times.append(elapsed)
+
+    per_entity_best = min(per_entity_times)
+    indexed_best = min(indexed_times)
+    print(json.dumps({
+        "file": os.path.basename(args.file_path),
+        "file_mb": round(os.path.getsize(args.file_path) / (1024 * 1024), 2),
+        "entities": entity_count,
+        "open_seconds": round(open_seconds, 3),
+        "per_entity_seconds": round(per_entity_best, 3),
+        "indexed_seconds": round(indexed_best, 3),
+        "per_entity_entities_per_second": round(entity_count / per_entity_best) if per_entity_best else None,
+        "indexed_entities_per_second": round(entity_count / indexed_best) if indexed_best else None,
+        "speedup": round(per_entity_best / indexed_best, 2) if indexed_best else None,
+        "mismatches": compare(per_entity, indexed)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Generator of synthetic IFC models for the benchmarks.
+
+The models have the structure the backend works on: a project, site and
+building with storeys, elements of every type in ENTITY_TYPES contained in
+the storeys, an extruded box as geometry, property sets and material
+associations. The generation is deterministic for a given seed.
+
+Usage:
+    python benchmarks/synthetic_model.py out.ifc --elements 10000 [--psets 2 --properties 4 --materials 10]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ifcopenshell
+import ifcopenshell.guid
+
+# Share of each element type, roughly that of a building model
+ELEMENT_MIX = [
+    ("IfcWall", 0.35), ("IfcWindow", 0.15), ("IfcDoor", 0.10), ("IfcSlab", 0.08), ("IfcColumn", 0.08),
+    ("IfcBeam", 0.10), ("IfcFurnishingElement", 0.09), ("IfcSpace", 0.03), ("IfcStair", 0.01), ("IfcRoof", 0.01)
+]
+
+FIRE_RATINGS = ["EI30", "EI60", "EI90", "EI120"]
+
+
+class _Generator:
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+        self.model = ifcopenshell.file(schema="IFC4")
+        self.created = 0
+
+    def guid(self):
+        return ifcopenshell.guid.compress(uuid.UUID(int=self.rng.getrandbits(128)).hex)
+
+    def create(self, entity_type: str, *args, **kwargs):
+        self.created += 1
+        return self.model.create_entity(entity_type, *args, **kwargs)
+
+    def root(self, entity_type: str, *args, **kwargs):
+        """Create an IfcRoot entity, with a GUID and no owner history"""
+        return self.create(entity_type, self.guid(), None, *args, **kwargs)
+
+
+def _element_types(count: int, rng: random.Random):
+    """Element type of each of count elements, following ELEMENT_MIX"""
+    types, weights = zip(*ELEMENT_MIX)
+    return rng.choices(types, weights=weights, k=count)
+
+
+def _property_values(g: _Generator, entity_type: str, index: int, properties: int):
+    """Single value properties of a property set"""
+    values = [
+        ("FireRating", g.create("IfcLabel", FIRE_RATINGS[index % len(FIRE_RATINGS)])),
+        ("IsExternal", g.create("IfcBoolean", index % 4 == 0)),
+        ("LoadBearing", g.create("IfcBoolean", entity_type in ("IfcWall", "IfcColumn", "IfcBeam", "IfcSlab"))),
+        ("Reference", g.create("IfcIdentifier", f"{entity_type[3:]}-{index % 50}")),
+        ("ThermalTransmittance", g.create("IfcThermalTransmittanceMeasure", round(g.rng.uniform(0.1, 3.0), 3))),
+    ]
+    for extra in range(len(values), properties):
+        values.append((f"Property{extra}", g.create("IfcLabel", f"Value {g.rng.randrange(100)}")))
+    return [g.create("IfcPropertySingleValue", name, None, value, None) for name, value in values[:properties]]
+
+
+def generate_model(file_path: str, elements: int, psets: int = 2, properties: int = 4, materials: int = 10,
+                   storeys: int = 5, geometry: bool = True, seed: int = 0):
+    """
+    Write a synthetic IFC model.
+
+    Args:
+        file_path: Path of the IFC file to write
+        elements: Number of elements
+        psets: Property sets of each element, the first one is the common
+            property set of its type (Pset_WallCommon, ...)
+        properties: Properties in each property set
+        materials: Number of materials, assigned to the elements in turn
+        storeys: Number of building storeys ("Level 0", "Level 1", ...)
+        geometry: Give each element an extruded box as body representation
+        seed: Seed of the GUIDs and property values
+
+    Returns:
+        Dictionary with the parameters, the entity count and the file size
+    """
+    start = time.perf_counter()
+    g = _Generator(seed)
+
+    # Units, context and spatial structure
+    length = g.create("IfcSIUnit", None, "LENGTHUNIT", None, "METRE")
+    units = g.create("IfcUnitAssignment", [length])
+    origin = g.create("IfcAxis2Placement3D", g.create("IfcCartesianPoint", (0.0, 0.0, 0.0)), None, None)
+    context = g.create("IfcGeometricRepresentationContext", None, "Model", 3, 1.0e-5, origin, None)
+    body_context = g.create("IfcGeometricRepresentationSubContext", "Body", "Model", None, None, None, None,
+                            context, None, "MODEL_VIEW", None)
+    project = g.root("IfcProject", Name="Benchmark project", RepresentationContexts=[context], UnitsInContext=units)
+    site = g.root("IfcSite", Name="Site", CompositionType="ELEMENT")
+    building = g.root("IfcBuilding", Name="Building", CompositionType="ELEMENT")
+    levels = [
+        g.root("IfcBuildingStorey", Name=f"Level {i}", CompositionType="ELEMENT", Elevation=i * 3.0)
+        for i in range(storeys)
+    ]
+    g.root("IfcRelAggregates", None, None, project, [site])
+    g.root("IfcRelAggregates", None, None, site, [building])
+    g.root("IfcRelAggregates", None, None, building, levels)
+
+    material_entities = [g.create("IfcMaterial", f"Material {i}", None, None) for i in range(materials)]
+
+    # Geometry shared by all elements, only the placement differs
+    if geometry:
+        profile = g.create("IfcRectangleProfileDef", "AREA", None, None, 1.0, 0.2)
+        up = g.create("IfcDirection", (0.0, 0.0, 1.0))
+
+    contained = [[] for _ in levels]
+    spaces = [[] for _ in levels]
+    by_material = [[] for _ in material_entities]
+    for index, entity_type in enumerate(_element_types(elements, g.rng)):
+        level = index % storeys
+        representation = placement = None
+        if geometry:
+            point = g.create("IfcCartesianPoint", (float(index % 1000), float(index // 1000), level * 3.0))
+            placement = g.create("IfcLocalPlacement", None, g.create("IfcAxis2Placement3D", point, None, None))
+            solid = g.create("IfcExtrudedAreaSolid", profile, None, up, 3.0)
+            shape = g.create("IfcShapeRepresentation", body_context, "Body", "SweptSolid", [solid])
+            representation = g.create("IfcProductDefinitionShape", None, None, [shape])
+
+        name = f"{entity_type[3:]} {index}"
+        if entity_type == "IfcSpace":
+            element = g.root(entity_type, Name=name, ObjectPlacement=placement, Representation=representation,
+                             CompositionType="ELEMENT")
+            spaces[level].append(element)
+        else:
+            element = g.root(entity_type, Name=name, ObjectPlacement=placement, Representation=representation)
+            contained[level].append(element)
+
+        for pset_index in range(psets):
+            pset_name = f"Pset_{entity_type[3:]}Common" if pset_index == 0 else f"Pset_Benchmark{pset_index}"
+            pset = g.root("IfcPropertySet", pset_name, None, _property_values(g, entity_type, index, properties))
+            g.root("IfcRelDefinesByProperties", None, None, [element], pset)
+
+        if materials and entity_type != "IfcSpace":
+            by_material[index % materials].append(element)
+
+    for level, elements_of_level in zip(levels, contained):
+        if elements_of_level:
+            g.root("IfcRelContainedInSpatialStructure", None, None, elements_of_level, level)
+    for level, spaces_of_level in zip(levels, spaces):
+        if spaces_of_level:
+            g.root("IfcRelAggregates", None, None, level, spaces_of_level)
+    for material, elements_of_material in zip(material_entities, by_material):
+        if elements_of_material:
+            g.root("IfcRelAssociatesMaterial", None, None, elements_of_material, material)
+
+    g.model.write(file_path)
+    return {
+        "elements": elements,
+        "psets": psets,
+        "properties": properties,
+        "materials": materials,
+        "storeys": storeys,
+        "geometry": geometry,
+        "seed": seed,
+        "entities": g.created,
+        "file_size": os.path.getsize(file_path),
+        "generate_seconds": round(time.perf_counter() - start, 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file_path", help="IFC file to write")
+    parser.add_argument("--elements", type=int, default=10000, help="Number of elements")
+    parser.add_argument("--psets", type=int, default=2, help="Property sets per element")
+    parser.add_argument("--properties", type=int, default=4, help="Properties per property set")
+    parser.add_argument("--materials", type=int, default=10, help="Number of materials")
+    parser.add_argument("--storeys", type=int, default=5, help="Number of storeys")
+    parser.add_argument("--no-geometry", action="store_true", help="Write elements without geometry")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    print(json.dumps(generate_model(
+        args.file_path, args.elements, args.psets, args.properties, args.materials, args.storeys,
+        not args.no_geometry, args.seed
+    ), indent=2))
+
+
+if __name__ == "__main__":
+    main()
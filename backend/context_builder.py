@@ -0,0 +1,257 @@
+import math
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+
+import ifcopenshell.util.element as element_util
+
+from relationship_index import RelationshipIndex
+
+# Token budget of the file context pasted into the modification prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("SAPCAD_CONTEXT_TOKENS", "2048"))
+
+# Number of per-file context indexes kept in memory
+MAX_CONTEXT_INDEXES = int(os.environ.get("SAPCAD_MAX_CONTEXT_INDEXES", "8"))
+
+# Rough number of characters per token, used to estimate token counts while packing
+CHARS_PER_TOKEN = 3.5
+
+_WORD_RE = re.compile(r"[A-Za-z]+|\d+")
+_CAMEL_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def estimate_tokens(text: str):
+    """Estimate the number of tokens of a text without a tokenizer"""
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def _normalize(word: str):
+    """Lowercase a word and strip simple plural endings"""
+    word = word.lower()
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str):
+    """Split text into normalized search terms, splitting CamelCase names too"""
+    terms = []
+    for word in _WORD_RE.findall(text or ""):
+        terms.append(_normalize(word))
+        parts = _CAMEL_RE.findall(word)
+        if len(parts) > 1:
+            terms.extend(_normalize(p) for p in parts if p.lower() != "ifc")
+    return terms
+
+
+class _Entry:
+    """A line of context together with its search terms"""
+
+    def __init__(self, text: str, terms, always: bool = False):
+        self.text = text
+        self.terms = Counter(terms)
+        self.length = sum(self.terms.values())
+        self.tokens = estimate_tokens(text) + 1
+        self.always = always
+
+
+def _material_name(material):
+    return getattr(material, "Name", None) if material is not None else None
+
+
+class ContextIndex:
+    """
+    Searchable context of one model.
+
+    There is one summary line per entity type (count, materials, property set
+    keys) which is always included, and one line per entity (id, name,
+    material, property sets) which is only included when it is relevant to
+    the instruction. Relevance is scored with BM25 over the entry terms.
+    """
+
+    def __init__(self, model, entity_types):
+        start = time.perf_counter()
+        index = RelationshipIndex(model)
+        self.entries = []
+        # Entity id -> (position of its entry, entity type, material name)
+        self.entities = {}
+        # Entity type -> position of its summary entry, count, materials and pset keys
+        self.type_summaries = {}
+
+        for entity_type in entity_types:
+            entities = model.by_type(entity_type)
+            if not entities:
+                continue
+
+            summary = {"count": len(entities), "materials": Counter(), "pset_keys": {}}
+            for entity in entities:
+                material_name = _material_name(index.get_material(entity))
+                psets = index.get_psets(entity)
+                self._add_to_summary(summary, material_name, psets)
+                self.entities[entity.id()] = (len(self.entries), entity_type, material_name)
+                self.entries.append(self._entity_entry(entity, entity_type, material_name, psets))
+
+            summary["position"] = len(self.entries)
+            self.type_summaries[entity_type] = summary
+            self.entries.append(self._summary_entry(entity_type, summary))
+
+        # Inverted index, so only entries sharing a term with the query are scored
+        self.postings = {}
+        for position, entry in enumerate(self.entries):
+            for term in entry.terms:
+                self.postings.setdefault(term, set()).add(position)
+        self.total_length = sum(e.length for e in self.entries)
+        self.build_ms = (time.perf_counter() - start) * 1000
+
+    @property
+    def average_length(self):
+        return self.total_length / len(self.entries) if self.entries else 0
+
+    def _entity_entry(self, entity, entity_type: str, material_name: str, psets: dict):
+        name = entity.Name if getattr(entity, "Name", None) else f"{entity_type}_{entity.id()}"
+        text = f"{entity_type} #{entity.id()} name={name!r}"
+        if material_name:
+            text += f" material={material_name!r}"
+        if psets:
+            text += " psets=" + ",".join(sorted(psets))
+        terms = tokenize(f"{entity_type} {name} {material_name or ''} {' '.join(psets)}")
+        terms.append(str(entity.id()))
+        return _Entry(text, terms)
+
+    def _add_to_summary(self, summary: dict, material_name: str, psets: dict):
+        for pset_name, props in psets.items():
+            summary["pset_keys"].setdefault(pset_name, set()).update(k for k in props if k != "id")
+        if material_name:
+            summary["materials"][material_name] += 1
+
+    def _summary_entry(self, entity_type: str, summary: dict):
+        """Summary of the whole entity type"""
+        text = f"{entity_type}: {summary['count']} elements"
+        materials = [m for m, count in summary["materials"].most_common(10) if count > 0]
+        if materials:
+            text += "; materials: " + ", ".join(materials)
+        if summary["pset_keys"]:
+            psets = [f"{name}({', '.join(sorted(keys)[:8])})" for name, keys in sorted(summary["pset_keys"].items())[:8]]
+            text += "; psets: " + ", ".join(psets)
+        return _Entry(text, tokenize(text), always=True)
+
+    def _replace_entry(self, position: int, entry: _Entry):
+        """Swap an entry, keeping the inverted index and lengths up to date"""
+        old = self.entries[position]
+        for term in old.terms:
+            self.postings[term].discard(position)
+        for term in entry.terms:
+            self.postings.setdefault(term, set()).add(position)
+        self.total_length += entry.length - old.length
+        self.entries[position] = entry
+
+    def update_entities(self, entities):
+        """
+        Refresh the entries of entities changed by an edit.
+        Only those entries and the summaries of their types are rebuilt.
+        """
+        changed_types = set()
+        for entity in entities:
+            known = self.entities.get(entity.id())
+            if known is None:
+                continue
+            position, entity_type, old_material = known
+            material_name = _material_name(element_util.get_material(entity))
+            psets = element_util.get_psets(entity)
+
+            summary = self.type_summaries[entity_type]
+            if old_material:
+                summary["materials"][old_material] -= 1
+            self._add_to_summary(summary, material_name, psets)
+            self.entities[entity.id()] = (position, entity_type, material_name)
+            self._replace_entry(position, self._entity_entry(entity, entity_type, material_name, psets))
+            changed_types.add(entity_type)
+
+        for entity_type in changed_types:
+            summary = self.type_summaries[entity_type]
+            self._replace_entry(summary["position"], self._summary_entry(entity_type, summary))
+
+    def _score(self, entry: _Entry, query_terms, k1: float = 1.2, b: float = 0.75):
+        score = 0.0
+        count = len(self.entries)
+        for term in query_terms:
+            frequency = entry.terms.get(term)
+            if not frequency:
+                continue
+            document_frequency = len(self.postings[term])
+            idf = math.log(1 + (count - document_frequency + 0.5) / (document_frequency + 0.5))
+            norm = frequency + k1 * (1 - b + b * entry.length / (self.average_length or 1))
+            score += idf * frequency * (k1 + 1) / norm
+        return score
+
+    def pack(self, instruction: str, token_budget: int = CONTEXT_TOKEN_BUDGET):
+        """
+        Select the entries relevant to an instruction within a token budget.
+
+        Returns:
+            Dictionary with the packed context text and packing statistics
+        """
+        start = time.perf_counter()
+        query_terms = set(tokenize(instruction))
+
+        # Type summaries first, then the most relevant entities
+        selected = [e for e in self.entries if e.always]
+        candidates = set()
+        for term in query_terms:
+            candidates.update(self.postings.get(term, ()))
+        ranked = []
+        for position in sorted(candidates):
+            entry = self.entries[position]
+            if not entry.always:
+                ranked.append((self._score(entry, query_terms), entry))
+        ranked.sort(key=lambda item: item[0], reverse=True)
+
+        used_tokens = sum(e.tokens for e in selected)
+        for _, entry in ranked:
+            if used_tokens + entry.tokens > token_budget:
+                break
+            selected.append(entry)
+            used_tokens += entry.tokens
+
+        # The summary is the same for every instruction on this file, the
+        # details depend on the instruction
+        summary = [e.text for e in selected if e.always]
+        details = [e.text for e in selected if not e.always]
+        return {
+            "context": "\n".join(summary + details),
+            "summary": "\n".join(summary),
+            "details": "\n".join(details),
+            "stats": {
+                "pack_ms": round((time.perf_counter() - start) * 1000, 3),
+                "index_build_ms": round(self.build_ms, 3),
+                "context_tokens_estimate": used_tokens,
+                "token_budget": token_budget,
+                "entries_used": len(selected),
+                "entries_matched": len(ranked),
+                "entries_total": len(self.entries)
+            }
+        }
+
+
+# Context indexes of the files handled by this process, least recently used first
+_indexes = OrderedDict()
+
+
+def get_context_index(file_id: str, model, entity_types):
+    """Get the context index of a file, building it on first use"""
+    index = _indexes.get(file_id)
+    if index is None:
+        index = ContextIndex(model, entity_types)
+        _indexes[file_id] = index
+        while len(_indexes) > MAX_CONTEXT_INDEXES:
+            _indexes.popitem(last=False)
+    _indexes.move_to_end(file_id)
+    return index
+
+
+def take_context_index(file_id: str):
+    """Remove the context index of a file from the cache, e.g. to update it while the model is edited"""
+    return _indexes.pop(file_id, None)
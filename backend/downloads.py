@@ -0,0 +1,272 @@
+import os
+import re
+import threading
+import uuid
+import zlib
+from urllib.parse import quote
+
+import anyio
+from starlette.responses import Response
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Size of the chunks read from disk when the server has no zero-copy extension
+CHUNK_SIZE = 1024 * 1024
+
+# File contents never change for a file ID, so clients and CDNs may keep them
+CONTENT_CACHE_CONTROL = os.environ.get("SAPCAD_CONTENT_CACHE_CONTROL", "public, max-age=31536000, immutable")
+
+# Disk space for compressed copies of served files (in MB)
+ENCODED_CACHE_MB = int(os.environ.get("SAPCAD_ENCODED_CACHE_MB", "2048"))
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+# Content codings offered, preferred first; zstd only with the zstandard package
+ENCODINGS = ("zstd", "gzip") if zstandard else ("gzip",)
+_SUFFIXES = {"gzip": "gz", "zstd": "zst"}
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def negotiate_encoding(accept_encoding: str):
+    """Content coding to compress a response with, from an Accept-Encoding header, or None"""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q=([\d.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def entity_tag(content_hash: str, encoding: str = None):
+    """Strong ETag of a representation: the content hash, suffixed by the coding it is compressed with"""
+    return f'"{content_hash}-{_SUFFIXES[encoding]}"' if encoding else f'"{content_hash}"'
+
+
+def _tags(header: str):
+    return [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+
+def not_modified(if_none_match: str, etag: str):
+    """Whether an If-None-Match header matches the ETag (weak comparison, as for GET)"""
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in _tags(if_none_match)
+
+
+def parse_range(range_header: str, size: int):
+    """
+    First and last byte of a single byte range.
+
+    Returns:
+        Tuple of both offsets, or None to send the whole file, e.g. for
+        several ranges, which are not supported
+
+    Raises:
+        RangeNotSatisfiable: If the range starts after the end of the file
+    """
+    match = _RANGE_RE.match((range_header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # The last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - length), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or last < first:
+        raise RangeNotSatisfiable()
+    return first, last
+
+
+def content_disposition(filename: str, attachment: bool = False):
+    disposition = "attachment" if attachment else "inline"
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{filename}"'
+
+
+class ContentResponse(Response):
+    """
+    A file, or a byte range of it, streamed from disk. Sent with the
+    zero-copy extensions of the ASGI server when it has them
+    (http.response.zerocopy, or http.response.pathsend for whole files),
+    otherwise read in large chunks in a thread.
+    """
+
+    def __init__(self, path: str, size: int, status_code: int = 200, headers: dict = None, media_type: str = None,
+                 offset: int = 0, length: int = None):
+        self.path = path
+        self.offset = offset
+        self.length = size - offset if length is None else length
+        self.whole_file = offset == 0 and self.length == size
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(self.length)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        extensions = scope.get("extensions") or {}
+        if self.whole_file and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopy" in extensions:
+                await send({
+                    "type": "http.response.zerocopy", "file": f, "offset": self.offset, "count": self.length,
+                    "more_body": False
+                })
+                return
+            remaining = self.length
+            position = self.offset
+            while True:
+                chunk = await anyio.to_thread.run_sync(os.pread, f.fileno(), min(CHUNK_SIZE, remaining), position)
+                remaining -= len(chunk)
+                position += len(chunk)
+                more_body = bool(chunk) and remaining > 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+                if not more_body:
+                    break
+
+
+def _compressor(encoding: str):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def _encode_chunk(source, target, compressor):
+    """
+    Read, compress and write the next chunk (runs in a thread).
+
+    Returns:
+        Tuple of the compressed data and whether the file is complete
+    """
+    chunk = source.read(CHUNK_SIZE)
+    data = compressor.compress(chunk) if chunk else compressor.flush()
+    target.write(data)
+    return data, not chunk
+
+
+class EncodedCache:
+    """
+    Compressed copies of served files, by content hash and coding.
+
+    A file is compressed while it is sent the first time; later requests
+    for the same content get the stored copy. The least recently served
+    copies are deleted beyond the disk budget.
+    """
+
+    def __init__(self, root: str, budget_bytes: int = ENCODED_CACHE_MB * 1024 * 1024):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, content_hash: str, encoding: str):
+        return os.path.join(self.root, f"{content_hash}.ifc.{_SUFFIXES[encoding]}")
+
+    def lookup(self, content_hash: str, encoding: str):
+        """Path of the compressed copy, or None; counts the hit or miss"""
+        path = self.path(content_hash, encoding)
+        try:
+            # The modification time orders the copies for eviction
+            os.utime(path)
+            found = True
+        except OSError:
+            found = False
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return path if found else None
+
+    async def encode(self, file_path: str, content_hash: str, encoding: str):
+        """Compress a file chunk by chunk while it is sent, keeping the result once complete"""
+        path = self.path(content_hash, encoding)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+        compressor = _compressor(encoding)
+        try:
+            with open(file_path, "rb") as source, open(temp_path, "wb") as target:
+                complete = False
+                while not complete:
+                    data, complete = await anyio.to_thread.run_sync(_encode_chunk, source, target, compressor)
+                    if data:
+                        yield data
+            os.replace(temp_path, path)
+        finally:
+            # Left over when the client went away before the end
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        self._trim()
+
+    def _trim(self):
+        """Delete the least recently served copies beyond the budget"""
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".part"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.budget_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        total = 0
+        for name in os.listdir(self.root):
+            try:
+                total += os.path.getsize(os.path.join(self.root, name))
+            except OSError:
+                pass
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "current_mb": round(total / (1024 * 1024), 2),
+                "budget_mb": round(self.budget_bytes / (1024 * 1024), 2),
+                "encodings": list(ENCODINGS)
+            }
@@ -0,0 +1,173 @@
+import bisect
+import os
+import time
+
+from model_cache import model_cache
+from ifc_constants import ENTITY_TYPES
+from context_builder import CONTEXT_TOKEN_BUDGET, ContextIndex, take_context_index
+from ifc_handler import apply_modification, write_modified_model
+from storage import hash_file
+
+# Editing sessions open in this process, by session ID
+_sessions = {}
+
+
+class EditSession:
+    """
+    A model kept open in memory while it is edited.
+
+    Edits are applied to the model in place. The metadata and the context
+    index are patched for the entities an edit touched instead of being
+    extracted from the whole file again, and the model is only written
+    when the session is flushed.
+    """
+
+    def __init__(self, session_id: str, file_id: str, file_path: str, metadata: dict):
+        self.session_id = session_id
+        self.file_id = file_id
+        self.file_path = file_path
+        # The model is modified in place, so it is taken out of the shared cache
+        self.model = model_cache.take(file_id, file_path)
+        self.metadata = dict(metadata or {})
+        self.metadata["MaterialNames"] = list(self.metadata.get("MaterialNames", []))
+        self.context_index = take_context_index(file_id)
+        self.version = 0
+        self.saved_version = 0
+        self.edits = []
+        # Element changes since the last flush, i.e. against the last written file
+        self.pending_delta = {"elements": {}, "geometry": {}}
+
+    @property
+    def dirty(self):
+        return self.version != self.saved_version
+
+    def _patch_metadata(self, modification: dict):
+        """Update the metadata for an edit. Only new material names can change it."""
+        if modification.get("property", "").lower() == "material":
+            names = self.metadata["MaterialNames"]
+            name = modification.get("new_value")
+            position = bisect.bisect_left(names, name)
+            if position == len(names) or names[position] != name:
+                names.insert(position, name)
+
+    def apply(self, modification_data: dict):
+        start = time.perf_counter()
+        result, entities = apply_modification(self.model, modification_data)
+        if "error" in result:
+            return result
+
+        self._patch_metadata(result["modification"])
+        if self.context_index is not None:
+            self.context_index.update_entities(entities)
+
+        for guid, element in result["delta"]["elements"].items():
+            self.pending_delta["elements"].setdefault(guid, {}).update(element)
+        self.pending_delta["geometry"].update(result["delta"]["geometry"])
+
+        self.version += 1
+        self.edits.append(result["modification"])
+        result["delta"]["base_version"] = self.version - 1
+        result["version"] = self.version
+        result["metadata"] = dict(self.metadata)
+        result["edit_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        return result
+
+    def context(self, instruction: str, token_budget: int = None):
+        if self.context_index is None:
+            self.context_index = ContextIndex(self.model, ENTITY_TYPES)
+        return self.context_index.pack(instruction, token_budget or CONTEXT_TOKEN_BUDGET)
+
+    def flush(self):
+        """Write the model with all edits so far"""
+        start = time.perf_counter()
+        previous_size = os.path.getsize(self.file_path)
+        output_path = write_modified_model(self.model, self.file_path)
+        file_size = os.path.getsize(output_path)
+        self.file_path = output_path
+        self.saved_version = self.version
+        delta = {"changed": list(self.pending_delta["elements"]), **self.pending_delta}
+        self.pending_delta = {"elements": {}, "geometry": {}}
+        self.metadata["FileName"] = os.path.basename(output_path)
+        self.metadata["FilePath"] = output_path
+        return {
+            "modified_file": output_path,
+            "content_hash": hash_file(output_path),
+            "file_size": file_size,
+            "file_size_delta": file_size - previous_size,
+            "version": self.version,
+            "edits": len(self.edits),
+            "metadata": dict(self.metadata),
+            "delta": delta,
+            "flush_ms": round((time.perf_counter() - start) * 1000, 3)
+        }
+
+    def info(self):
+        return {
+            "session_id": self.session_id,
+            "file_id": self.file_id,
+            "version": self.version,
+            "saved_version": self.saved_version,
+            "dirty": self.dirty,
+            "edits": list(self.edits)
+        }
+
+
+def _get_session(session_id: str):
+    session = _sessions.get(session_id)
+    if session is None:
+        raise KeyError(f"Editing session {session_id} is not open")
+    return session
+
+
+def open_session(session_id: str, file_id: str, file_path: str, metadata: dict):
+    """Open an editing session on a file"""
+    try:
+        session = EditSession(session_id, file_id, file_path, metadata)
+        _sessions[session_id] = session
+        return session.info()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def apply_session_edit(session_id: str, modification_data: dict):
+    """Apply a modification to the model of a session, without writing it"""
+    try:
+        return _get_session(session_id).apply(modification_data)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def build_session_context(session_id: str, instruction: str, token_budget: int = None):
+    """Build the modification parser context from the edited model"""
+    try:
+        return _get_session(session_id).context(instruction, token_budget)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def flush_session(session_id: str, new_file_id: str):
+    """
+    Write the edited model to a new file.
+    The model stays in the session, so it is only cached under the new
+    file ID once the session is closed.
+    """
+    try:
+        session = _get_session(session_id)
+        result = session.flush()
+        session.file_id = new_file_id
+        return result
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def close_session(session_id: str):
+    """
+    Close a session. A model without unsaved edits goes back into the
+    model cache under the ID of the last file written from it.
+    """
+    session = _sessions.pop(session_id, None)
+    if session is None:
+        return {"error": f"Editing session {session_id} is not open"}
+    if not session.dirty:
+        model_cache.put(session.file_id, session.file_path, session.model)
+    return session.info()
@@ -0,0 +1,467 @@
+import fnmatch
+import re
+import time
+import weakref
+
+import ifcopenshell
+import ifcopenshell.util.element as element_util
+
+from metrics import record_throughput
+
+# Entity index of every model it was built for, dropped together with the model
+_indexes = weakref.WeakKeyDictionary()
+
+# Selector tokens: a head (type, * or #id), then [key op value] filters, terms separated by commas
+_HEAD_RE = re.compile(r"\s*(?:(?P<any>\*)|#(?P<id>\d+)|(?P<type>[A-Za-z][A-Za-z0-9_]*))?")
+_FILTER_RE = re.compile(
+    r"\s*\[\s*(?P<key>(?:\*\.)?[A-Za-z_][\w.]*?)\s*(?P<op>!=|~=|=)\s*"
+    r"(?:\"(?P<dq>[^\"]*)\"|'(?P<sq>[^']*)'|(?P<bare>[^\]]*?))\s*\]"
+)
+_SEPARATOR_RE = re.compile(r"\s*(?:(?P<comma>,)|\Z)")
+
+
+class SelectorError(ValueError):
+    """A selector that can't be parsed"""
+
+
+def _value_key(value):
+    """Comparable form of a property value: lower-case text, numbers without trailing zeros"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return format(float(value), "g")
+    text = str(value).strip()
+    try:
+        return format(float(text), "g")
+    except ValueError:
+        return text.lower()
+
+
+def _material_names(material):
+    """Names of the materials of a material definition (material, set, list or usage)"""
+    if material is None:
+        return ()
+    if material.is_a("IfcMaterial"):
+        return (material.Name,) if material.Name else ()
+    if material.is_a("IfcMaterialLayerSetUsage"):
+        material = material.ForLayerSet
+    elif material.is_a("IfcMaterialProfileSetUsage"):
+        material = material.ForProfileSet
+    if material.is_a("IfcMaterialLayerSet"):
+        parts = [layer.Material for layer in material.MaterialLayers]
+    elif material.is_a("IfcMaterialProfileSet"):
+        parts = [profile.Material for profile in material.MaterialProfiles]
+    elif material.is_a("IfcMaterialConstituentSet"):
+        parts = [constituent.Material for constituent in material.MaterialConstituents or []]
+    elif material.is_a("IfcMaterialList"):
+        parts = material.Materials
+    else:
+        parts = []
+    return tuple(dict.fromkeys(m.Name for m in parts if m is not None and m.Name))
+
+
+class EntityIndex:
+    """
+    Lookup tables of the products of a model by id, GlobalId, type,
+    containing storey, material and property set value.
+
+    Built once per model with one scan of the relationships, and updated
+    for the elements an edit touched. Selectors are resolved with set
+    operations on the tables instead of scanning the model.
+
+    Selector syntax, terms separated by commas are combined:
+
+        IfcWall                          walls, including subtypes
+        #123                             the entity with id 123
+        *[guid=2O2Fr$t4X7Zf8NOew3FLOH]   any type, by GlobalId
+        IfcDoor[storey="Level 2"][Pset_DoorCommon.FireRating=EI30]
+        IfcWall[material=Concrete][name~="EXT-*"]
+
+    Filters compare with = or != (case-insensitive), ~= matches a glob
+    pattern. Keys are id, guid, name, type, storey, material,
+    <pset>.<property> (*.<property> for any property set) or any other
+    attribute of the entities, e.g. ObjectType or PredefinedType; id and
+    guid take several values separated by |. Tables of other attributes
+    are built the first time they are queried.
+    """
+
+    def __init__(self, model):
+        start = time.perf_counter()
+        # Lower-case type name, including supertypes -> ids
+        self.types = {}
+        self.guids = {}
+        self.names = {}
+        # Storey name and GlobalId -> ids, id -> storey id (keys of all tables are value keys)
+        self.storeys = {}
+        self.element_storey = {}
+        # Material name -> ids, id -> material names
+        self.materials = {}
+        self.element_materials = {}
+        # Lower-case (pset, property) -> value key -> ids, id -> {(pset, property): value key}
+        self.psets = {}
+        self.element_psets = {}
+        # Id -> class name, storey id -> storey name
+        self.element_class = {}
+        self.storey_names = {}
+        # Lower-case attribute name -> value key -> ids, built on first use
+        self.attributes = {}
+        self._model = weakref.ref(model)
+        self._supertypes = {}
+        self._schema = ifcopenshell.ifcopenshell_wrapper.schema_by_name(model.schema)
+        self._build(model)
+        self.build_ms = round((time.perf_counter() - start) * 1000, 3)
+        record_throughput("entity_index", len(self.element_class), self.build_ms / 1000)
+
+    def _type_names(self, entity):
+        """Lower-case names of the class of an entity and its supertypes"""
+        name = entity.is_a()
+        names = self._supertypes.get(name)
+        if names is None:
+            names = []
+            declaration = self._schema.declaration_by_name(name)
+            while declaration is not None:
+                names.append(declaration.name().lower())
+                declaration = declaration.supertype()
+            self._supertypes[name] = names
+        return names
+
+    def _build(self, model):
+        # Relationship entities are scanned once, and what they relate (a
+        # storey, a material, a property set) is read once for all their objects
+        parents = {}
+        for rel in model.by_type("IfcRelContainedInSpatialStructure"):
+            for element in rel.RelatedElements:
+                parents[element.id()] = rel.RelatingStructure
+        for rel in model.by_type("IfcRelAggregates"):
+            for part in rel.RelatedObjects:
+                parents.setdefault(part.id(), rel.RelatingObject)
+
+        element_types = {}
+        type_psets = {}
+        for rel in model.by_type("IfcRelDefinesByType"):
+            relating_type = rel.RelatingType
+            if relating_type.id() not in type_psets:
+                type_psets[relating_type.id()] = self._pset_values(relating_type.HasPropertySets or [])
+            for obj in rel.RelatedObjects:
+                element_types[obj.id()] = relating_type.id()
+
+        materials = {}
+        material_names = {}
+        for rel in model.by_type("IfcRelAssociatesMaterial"):
+            material = rel.RelatingMaterial
+            if material.id() not in material_names:
+                material_names[material.id()] = _material_names(material)
+            for obj in rel.RelatedObjects:
+                # The first association wins, like in get_material
+                materials.setdefault(obj.id(), material_names[material.id()])
+
+        # Occurrence property sets override those of the type
+        psets = {}
+        for rel in model.by_type("IfcRelDefinesByProperties"):
+            definitions = rel.RelatingPropertyDefinition
+            values = self._pset_values(definitions if isinstance(definitions, (list, tuple)) else [definitions])
+            for obj in rel.RelatedObjects:
+                psets.setdefault(obj.id(), {}).update(values)
+
+        storey_of = {}
+        storey_keys = {}
+
+        def find_storey(entity):
+            seen = []
+            while entity is not None and entity.id() not in storey_of and entity.id() not in seen:
+                if entity.is_a("IfcBuildingStorey"):
+                    storey_of[entity.id()] = entity.id()
+                    self.storey_names[entity.id()] = entity.Name
+                    storey_keys[entity.id()] = {_value_key(k) for k in (entity.Name, entity.GlobalId) if k}
+                    break
+                seen.append(entity.id())
+                entity = parents.get(entity.id())
+            storey = storey_of.get(entity.id()) if entity is not None else None
+            for entity_id in seen:
+                storey_of[entity_id] = storey
+            return storey
+
+        for entity in model.by_type("IfcProduct"):
+            entity_id = entity.id()
+            self.element_class[entity_id] = entity.is_a()
+            for type_name in self._type_names(entity):
+                self.types.setdefault(type_name, set()).add(entity_id)
+            # GlobalId and Name are the first and third attribute of every IfcRoot,
+            # reading them by position is much faster than by name
+            global_id, name = entity[0], entity[2]
+            if global_id:
+                self.guids[global_id] = entity_id
+            self.names[entity_id] = name
+
+            storey = find_storey(parents.get(entity_id))
+            if storey is not None:
+                self.element_storey[entity_id] = storey
+                for key in storey_keys[storey]:
+                    self.storeys.setdefault(key, set()).add(entity_id)
+
+            type_id = element_types.get(entity_id)
+            names = materials.get(entity_id)
+            if names is None and type_id is not None:
+                names = materials.get(type_id)
+            self._add_materials(entity_id, names or ())
+
+            values = type_psets.get(type_id)
+            if values:
+                values = {**values, **psets.get(entity_id, {})}
+            else:
+                values = psets.get(entity_id, {})
+            self._add_pset_values(entity_id, values)
+
+    def _pset_values(self, definitions):
+        """{(pset, property): value key} of property set definitions"""
+        values = {}
+        for definition in definitions:
+            properties = element_util.get_property_definition(definition)
+            if definition.Name and properties:
+                self._collect_values(values, definition.Name, properties)
+        return values
+
+    def _collect_values(self, values: dict, pset_name: str, properties: dict):
+        for prop, value in properties.items():
+            # Nested values (lists, complex properties) are not indexed
+            if prop == "id" or value is None or isinstance(value, (dict, list, tuple)):
+                continue
+            values[(pset_name.lower(), prop.lower())] = _value_key(value)
+
+    def _add_materials(self, entity_id: int, names):
+        self.element_materials[entity_id] = names
+        for name in names:
+            self.materials.setdefault(_value_key(name), set()).add(entity_id)
+
+    def _remove_materials(self, entity_id: int):
+        for name in self.element_materials.pop(entity_id, ()):
+            self.materials.get(_value_key(name), set()).discard(entity_id)
+
+    def _add_pset_values(self, entity_id: int, values: dict):
+        self.element_psets[entity_id] = values
+        for key, value in values.items():
+            self.psets.setdefault(key, {}).setdefault(value, set()).add(entity_id)
+
+    def _remove_psets(self, entity_id: int):
+        for key, value in self.element_psets.pop(entity_id, {}).items():
+            self.psets.get(key, {}).get(value, set()).discard(entity_id)
+
+    def update(self, entities, field: str = None):
+        """
+        Update the tables for edited elements.
+
+        Args:
+            entities: The elements an edit touched
+            field: Field the edit changed ("Name", "Material", "Color"), all when None
+        """
+        for entity in entities:
+            entity_id = entity.id()
+            if entity_id not in self.names:
+                continue
+            if field in (None, "Name"):
+                self.names[entity_id] = entity.Name
+            if field in (None, "Material"):
+                self._remove_materials(entity_id)
+                self._add_materials(entity_id, _material_names(element_util.get_material(entity)))
+            if field is None:
+                self._remove_psets(entity_id)
+                values = {}
+                for pset_name, properties in element_util.get_psets(entity).items():
+                    self._collect_values(values, pset_name, properties)
+                self._add_pset_values(entity_id, values)
+
+    # Selectors
+
+    def parse(self, selector: str):
+        """
+        Parse a selector.
+
+        Returns:
+            List of terms as (head, filters) with filters as (key, op, value)
+        """
+        terms = []
+        position = 0
+        while True:
+            # Terms end at a comma outside quotes, so quoted values may hold commas
+            head_match = _HEAD_RE.match(selector, position)
+            head = head_match.group("any") or (f"#{head_match.group('id')}" if head_match.group("id") else None) \
+                or head_match.group("type")
+            position = head_match.end()
+            filters = []
+            while True:
+                match = _FILTER_RE.match(selector, position)
+                if not match:
+                    break
+                value = next(v for v in (match.group("dq"), match.group("sq"), match.group("bare")) if v is not None)
+                filters.append((match.group("key").lower(), match.group("op"), value))
+                position = match.end()
+            end = _SEPARATOR_RE.match(selector, position)
+            if not end:
+                raise SelectorError(f"Invalid selector near '{selector[position:].strip()}'")
+            if head is None and not filters:
+                raise SelectorError(f"Empty term in selector: {selector}")
+            terms.append((head, filters))
+            if not end.group("comma"):
+                return terms
+            position = end.end()
+
+    def _all(self):
+        return set(self.names)
+
+    def _lookup(self, key: str, value: str, glob: bool):
+        """Ids of the entities whose field matches a value or glob pattern"""
+        if key == "id":
+            ids = {int(v) for v in value.split("|") if v.strip().isdigit()}
+            return ids & self.names.keys()
+        if key in ("guid", "globalid"):
+            return {self.guids[g] for g in value.split("|") if g in self.guids}
+        if key == "type":
+            return set(self.types.get(value.lower(), ()))
+        if key == "name":
+            pattern = value.lower()
+            if glob:
+                return {i for i, name in self.names.items() if fnmatch.fnmatchcase((name or "").lower(), pattern)}
+            return {i for i, name in self.names.items() if (name or "").lower() == pattern}
+
+        if key == "storey":
+            table = self.storeys
+        elif key == "material":
+            table = self.materials
+        elif key.startswith("*."):
+            # The property in any property set
+            prop = key[2:]
+            return set().union(*(
+                self._match(table, value, glob) for (_, name), table in self.psets.items() if name == prop
+            ))
+        elif "." in key:
+            table = self.psets.get(tuple(key.split(".", 1)), {})
+        else:
+            table = self._attribute_table(key)
+        return self._match(table, value, glob)
+
+    def _match(self, table: dict, value: str, glob: bool):
+        """Ids of a value key -> ids table matching a value or glob pattern"""
+        if not glob:
+            return set(table.get(_value_key(value), ()))
+
+        ids = set()
+        for table_key, table_ids in table.items():
+            if fnmatch.fnmatchcase(table_key, value.lower()):
+                ids |= table_ids
+        return ids
+
+    def _attribute_table(self, attribute: str):
+        """Value key -> ids of an attribute, read from the model on first use"""
+        table = self.attributes.get(attribute)
+        if table is not None:
+            return table
+        model = self._model()
+        if model is None:
+            raise SelectorError("The model of the index is closed")
+
+        table = {}
+        found = False
+        positions = {}
+        for entity_id, class_name in self.element_class.items():
+            if class_name not in positions:
+                # Position of the attribute in the class, None if it has no such attribute
+                declaration = self._schema.declaration_by_name(class_name)
+                names = [a.name().lower() for a in declaration.all_attributes()]
+                positions[class_name] = names.index(attribute) if attribute in names else None
+            position = positions[class_name]
+            if position is None:
+                continue
+            found = True
+            value = model.by_id(entity_id)[position]
+            # References to other entities are not indexed
+            if value is not None and not isinstance(value, (ifcopenshell.entity_instance, tuple, list)):
+                table.setdefault(_value_key(value), set()).add(entity_id)
+        if not found:
+            raise SelectorError(f"Unknown selector key: {attribute}")
+        self.attributes[attribute] = table
+        return table
+
+    def _resolve_term(self, head, filters):
+        if head is None or head == "*":
+            ids = None
+        elif head.startswith("#"):
+            ids = {int(head[1:])} & self.names.keys()
+        else:
+            ids = set(self.types.get(head.lower(), ()))
+
+        # Exact matches narrow the candidates the most, negations and globs come last
+        for key, op, value in sorted(filters, key=lambda f: f[1] != "="):
+            matches = self._lookup(key, value, op == "~=")
+            if op == "!=":
+                ids = (ids if ids is not None else self._all()) - matches
+            else:
+                ids = matches if ids is None else ids & matches
+            if not ids:
+                break
+        return ids if ids is not None else self._all()
+
+    def select(self, selector: str):
+        """
+        Ids of the entities matching a selector, in ascending order.
+
+        Raises:
+            SelectorError: The selector can't be parsed
+        """
+        ids = set()
+        for head, filters in self.parse(selector):
+            ids |= self._resolve_term(head, filters)
+        return sorted(ids)
+
+    def counts(self, ids):
+        """Number of entities by class, storey and material among the given ids"""
+        by_type, by_storey, by_material = {}, {}, {}
+        for entity_id in ids:
+            class_name = self.element_class[entity_id]
+            by_type[class_name] = by_type.get(class_name, 0) + 1
+            storey = self.element_storey.get(entity_id)
+            if storey is not None:
+                name = self.storey_names.get(storey) or f"#{storey}"
+                by_storey[name] = by_storey.get(name, 0) + 1
+            for material in self.element_materials.get(entity_id, ()):
+                by_material[material] = by_material.get(material, 0) + 1
+        return {"type": by_type, "storey": by_storey, "material": by_material}
+
+    def stats(self):
+        return {
+            "entities": len(self.names),
+            "types": len(self.types),
+            "storeys": len({s for s in self.element_storey.values()}),
+            "materials": len(self.materials),
+            "pset_properties": len(self.psets),
+            "build_ms": self.build_ms
+        }
+
+
+def get_entity_index(model):
+    """Get the entity index of a model, building it on first use"""
+    index = _indexes.get(model)
+    if index is None:
+        index = _indexes[model] = EntityIndex(model)
+    return index
+
+
+def update_entity_index(model, entities, field: str = None):
+    """Keep the index of a model current after an edit, if it has been built"""
+    index = _indexes.get(model)
+    if index is not None:
+        index.update(entities, field)
+
+
+def select_entities(model, selector: str, entity_type: str = None):
+    """
+    Entities of a model matching a selector, optionally only those of a type.
+
+    Raises:
+        SelectorError: The selector can't be parsed
+    """
+    index = get_entity_index(model)
+    ids = index.select(selector)
+    if entity_type:
+        type_ids = index.types.get(entity_type.lower(), set())
+        ids = [i for i in ids if i in type_ids]
+    return [model.by_id(i) for i in ids]
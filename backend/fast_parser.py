@@ -0,0 +1,224 @@
+import re
+import threading
+
+from ifc_constants import ENTITY_TYPES, COLOR_MAP
+
+# Words users write for the entity types in ENTITY_TYPES
+_TYPE_WORDS = {
+    "wall": "IfcWall",
+    "window": "IfcWindow",
+    "door": "IfcDoor",
+    "slab": "IfcSlab",
+    "floor": "IfcSlab",
+    "roof": "IfcRoof",
+    "column": "IfcColumn",
+    "beam": "IfcBeam",
+    "stair": "IfcStair",
+    "staircase": "IfcStair",
+    "space": "IfcSpace",
+    "room": "IfcSpace",
+    "furniture": "IfcFurnishingElement",
+    "furnishing": "IfcFurnishingElement",
+}
+_TYPE_WORDS.update({t.lower(): t for t in ENTITY_TYPES})
+
+# Spellings of color names that are not keys of COLOR_MAP
+_COLOR_ALIASES = {"grey": "gray", "violet": "purple"}
+
+# "<type> [#]<id>", "<type>s <id>, <id> and <id>", optionally "on level <storey>",
+# or an entity selector in backticks (see entity_index)
+_TARGET = (
+    r"(?:`(?P<selector>[^`]+)`|(?:the\s+|(?P<all>all\s+(?:the\s+)?|every\s+))?(?P<type>[A-Za-z]+?)(?:e?s)?"
+    r"(?P<ids>(?:\s*(?:,|and)?\s*#?\d+)*)"
+    r"(?:\s+(?:on|in|at)\s+(?:the\s+)?(?P<level>storey|level)\s+(?P<storey>\"[^\"]+\"|'[^']+'|[\w.-]+))?)"
+)
+_VALUE = r"['\"]?(?P<value>[^'\"]+?)['\"]?\s*[.!]?"
+
+_PATTERNS = [
+    # rename door 1234 to D-01
+    ("name", re.compile(rf"^rename\s+{_TARGET}\s+(?:to|as)\s+{_VALUE}$", re.I)),
+    # set/change the name of door 1234 to D-01
+    ("name", re.compile(rf"^(?:set|change|update)\s+(?:the\s+)?name\s+of\s+{_TARGET}\s+to\s+{_VALUE}$", re.I)),
+    # set/change the material of IfcSlab to Concrete
+    ("material", re.compile(rf"^(?:set|change|update)\s+(?:the\s+)?material\s+of\s+{_TARGET}\s+to\s+{_VALUE}$", re.I)),
+    # set/change the color of walls to red
+    ("color", re.compile(rf"^(?:set|change|update)\s+(?:the\s+)?colou?r\s+of\s+{_TARGET}\s+to\s+{_VALUE}$", re.I)),
+    # make/paint/color/turn all walls red, change walls to red
+    ("value", re.compile(rf"^(?:make|paint|colou?r|turn|change|set)\s+{_TARGET}\s+(?:to\s+|in\s+)?{_VALUE}$", re.I)),
+]
+
+
+# Questions about the entities of the model, answered with an entity query
+_QUESTION = re.compile(r"\b(?:which|what|how\s+many|list|show|count|find|are\s+there|is\s+there)\b", re.I)
+_SELECTOR = re.compile(r"`(?P<selector>[^`]+)`")
+_WORD = re.compile(r"[A-Za-z]+")
+_QUOTED = r"(\"[^\"]+\"|'[^']+'|[\w.-]+)"
+_STOREY_QUALIFIER = re.compile(rf"\b(?:on|in|at)\s+(?:the\s+)?(storey|level)\s+{_QUOTED}", re.I)
+_MATERIAL_QUALIFIER = re.compile(rf"\b(?:made\s+of|with\s+material|of\s+material)\s+{_QUOTED}", re.I)
+# "with FireRating EI30", "where IsExternal is true": a property name is written in CamelCase
+_PROPERTY_QUALIFIER = re.compile(rf"\b(?:with|where|having)\s+(?:a\s+|an\s+)?([A-Z][a-z]+[A-Z]\w*)\s*(?:=|of|is)?\s*{_QUOTED}")
+
+
+def _storey_filters(entity_type: str, keyword: str, storey: str):
+    """Selector terms of a type on a storey; "level 2" may be the storey "2" or "Level 2" """
+    terms = [f'{entity_type}[storey="{storey}"]']
+    if keyword.lower() == "level" and not storey.lower().startswith("level"):
+        terms.append(f'{entity_type}[storey="Level {storey}"]')
+    return terms
+
+
+class FastPathParser:
+    """
+    Rule based parser for the common modification commands.
+
+    Resolves instructions like "make all walls red", "set material of IfcSlab
+    to Concrete", "rename door 1234 to D-01", "make walls on level 2 red" or
+    "make `IfcDoor[material=Oak]` white" without calling the LLM.
+    Returns None when an instruction is not understood, so the caller falls
+    back to the LLM. Hits and fallbacks are counted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fallbacks = 0
+
+    def _entity_type(self, word: str):
+        word = word.lower()
+        if word in _TYPE_WORDS:
+            return _TYPE_WORDS[word]
+        # Plural forms the pattern did not strip (e.g. "stairs" -> "stair")
+        return _TYPE_WORDS.get(word.rstrip("s"))
+
+    def _color(self, value: str):
+        value = value.strip().lower()
+        value = _COLOR_ALIASES.get(value, value)
+        return value if value in COLOR_MAP else None
+
+    def _material(self, value: str, material_names):
+        """Match a value against the materials of the model, ignoring case"""
+        for name in material_names or []:
+            if name.lower() == value.strip().lower():
+                return name
+        return None
+
+    def _resolve(self, instruction: str, metadata: dict):
+        instruction = " ".join((instruction or "").split())
+        for kind, pattern in _PATTERNS:
+            match = pattern.match(instruction)
+            if not match:
+                continue
+
+            selector = match.group("selector")
+            if selector:
+                head = re.match(r"\s*(Ifc\w+)", selector)
+                entity_type = head.group(1) if head else None
+            else:
+                entity_type = self._entity_type(match.group("type"))
+                if not entity_type:
+                    continue
+                if match.group("storey"):
+                    storey = match.group("storey").strip("\"'")
+                    selector = ",".join(_storey_filters(entity_type, match.group("level"), storey))
+            value = match.group("value").strip()
+            ids = re.findall(r"\d+", match.group("ids") or "")
+
+            # Names are per instance: "rename wall to Outer Wall" does not say
+            # which wall, so only listed ids, a selector or "all" are renamed here
+            if kind == "name" and not (ids or match.group("selector") or match.group("all")):
+                continue
+
+            if kind == "color":
+                value = self._color(value)
+                if not value:
+                    continue
+            elif kind == "value":
+                # "make walls red" is a color, "make walls concrete" a known material
+                color = self._color(value)
+                material = self._material(value, metadata.get("MaterialNames"))
+                if color:
+                    kind, value = "color", color
+                elif material:
+                    kind, value = "material", material
+                else:
+                    continue
+            elif kind == "material":
+                value = self._material(value, metadata.get("MaterialNames")) or value
+
+            result = {
+                "entity_type": entity_type,
+                "entity_ids": ids or ["all"],
+                "property": kind,
+                "new_value": value,
+                "confidence": 1.0,
+                "parser": "fast_path"
+            }
+            if selector:
+                result["selector"] = selector
+            return result
+        return None
+
+    def parse(self, instruction: str, metadata: dict = None):
+        """
+        Parse an instruction with the rules.
+
+        Args:
+            instruction: The user's request
+            metadata: Metadata of the file, used for its material names
+
+        Returns:
+            Modification data like parse_modification_request, or None
+        """
+        result = self._resolve(instruction, metadata or {})
+        with self._lock:
+            if result:
+                self.hits += 1
+            else:
+                self.fallbacks += 1
+        return result
+
+    def parse_query(self, message: str):
+        """
+        Turn a question about the entities of the model, e.g. "which doors
+        are on level 2 with FireRating EI30?", into an entity selector.
+
+        Returns:
+            The selector, or None when the message is not such a question
+        """
+        message = " ".join((message or "").split())
+        explicit = _SELECTOR.search(message)
+        if explicit:
+            return explicit.group("selector").strip()
+        if not _QUESTION.search(message):
+            return None
+
+        entity_type = next((t for t in map(self._entity_type, _WORD.findall(message)) if t), None)
+        if not entity_type:
+            return None
+
+        filters = ""
+        material = _MATERIAL_QUALIFIER.search(message)
+        if material:
+            name = material.group(1).strip("\"'")
+            filters += f'[material="{name}"]'
+        for prop, value in _PROPERTY_QUALIFIER.findall(message):
+            value = value.strip("\"'")
+            filters += f'[*.{prop}="{value}"]'
+
+        storey = _STOREY_QUALIFIER.search(message)
+        if storey:
+            terms = _storey_filters(entity_type, storey.group(1), storey.group(2).strip("\"'"))
+            return ",".join(term + filters for term in terms)
+        return entity_type + filters
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.fallbacks
+            return {
+                "hits": self.hits,
+                "fallbacks": self.fallbacks,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0
+            }
+
+
+fast_parser = FastPathParser()
@@ -0,0 +1,24 @@
+# Entity types reported in the metadata and summaries
+ENTITY_TYPES = ["IfcWall", "IfcWindow", "IfcDoor", "IfcSlab", "IfcRoof",
+                "IfcColumn", "IfcBeam", "IfcStair", "IfcSpace", "IfcFurnishingElement"]
+
+# Map of color names to RGB values
+COLOR_MAP = {
+    "red": (1.0, 0.0, 0.0),
+    "green": (0.0, 1.0, 0.0),
+    "blue": (0.0, 0.0, 1.0),
+    "yellow": (1.0, 1.0, 0.0),
+    "white": (1.0, 1.0, 1.0),
+    "black": (0.0, 0.0, 0.0),
+    "gray": (0.5, 0.5, 0.5),
+    "purple": (0.5, 0.0, 0.5),
+    "orange": (1.0, 0.65, 0.0),
+    "brown": (0.65, 0.16, 0.16)
+}
+
+# Properties a modification can change
+MODIFIABLE_PROPERTIES = ["color", "colour", "material", "name"]
+
+# Fields of an entity that are cheap to read, and those loaded on request
+BASE_FIELDS = ["GlobalId", "Name", "id", "type"]
+DETAIL_FIELDS = ["Material", "Materials", "Color", "Properties"]
@@ -1,23 +1,123 @@
 import ifcopenshell
 import ifcopenshell.util.element as element_util
-import ifcopenshell.geom
+import bisect
 import os
 import json
+import time
 import uuid
+import weakref
+from contextlib import nullcontext
 from datetime import datetime
+from model_cache import model_cache
+from ifc_constants import ENTITY_TYPES, COLOR_MAP, BASE_FIELDS, DETAIL_FIELDS
+from relationship_index import RelationshipIndex, get_element_colour
+from tessellation import geometry_engine, tessellate_elements
+from context_builder import CONTEXT_TOKEN_BUDGET, ContextIndex, get_context_index
+from storage import hash_file
+from entity_index import SelectorError, get_entity_index, select_entities, update_entity_index
+from metrics import record_span, record_throughput, span
+from progress import iter_progress, report_progress
+
+def _parse_file(file_path: str):
+    """Parse an IFC file, timed as the ifc_open stage"""
+    report_progress("parsing")
+    with span("ifc_open"):
+        return ifcopenshell.open(file_path)
+
+def _open_model(file_path: str, file_id: str = None):
+    """Get the model from the shared cache when the file ID is known"""
+    if file_id:
+        return model_cache.get(file_id, file_path)
+    return _parse_file(file_path)
+
+# Sorted ids of the entities of a type in a model, for paging, dropped together
+# with the model. Edits never add or remove entities of ENTITY_TYPES.
+_sorted_ids = weakref.WeakKeyDictionary()
+
+def _type_ids(model, entity_type: str):
+    """Ids of the entities of a type (including subtypes) in ascending order"""
+    ids_by_type = _sorted_ids.get(model)
+    if ids_by_type is None:
+        ids_by_type = _sorted_ids[model] = {}
+    ids = ids_by_type.get(entity_type)
+    if ids is None:
+        ids = ids_by_type[entity_type] = sorted(e.id() for e in model.by_type(entity_type))
+    return ids
+
+# Reuse identical styles and material associations when writing edits,
+# instead of adding new ones for every edit
+COMPACT_WRITE = os.environ.get("SAPCAD_COMPACT_WRITE", "1") != "0"
+
+def _material_info(materials, entity_info: dict):
+    """Add the name(s) of a material lookup result to the entity details"""
+    if materials:
+        if hasattr(materials, "Name"):
+            entity_info["Material"] = materials.Name
+        elif isinstance(materials, list):
+            entity_info["Materials"] = [m.Name for m in materials if hasattr(m, "Name")]
+
+def _get_entity_info(entity, entity_type: str, fields=None, index: RelationshipIndex = None):
+    """
+    Collect the details of one entity.
 
-# Set up IFC settings
-settings = ifcopenshell.geom.settings()
-settings.set(settings.USE_WORLD_COORDS, True)
+    Args:
+        entity: The IFC entity
+        entity_type: The type the entity was listed under
+        fields: Fields to include, all fields when None
+        index: Relationship index of the model. Without it the relationships
+            of the entity are walked one by one.
 
-def process_ifc_file(file_path: str):
+    Returns:
+        Dictionary with the entity details
+    """
+    entity_info = {
+        "GlobalId": entity.GlobalId,
+        "Name": entity.Name if hasattr(entity, "Name") and entity.Name else f"{entity_type}_{entity.id()}",
+        "id": entity.id()
+    }
+
+    # Try to get material information
+    if fields is None or "Material" in fields or "Materials" in fields:
+        try:
+            if index:
+                _material_info(index.get_material(entity), entity_info)
+            else:
+                _material_info(element_util.get_material(entity), entity_info)
+        except:
+            pass
+
+    # Try to get color information if available
+    if fields is None or "Color" in fields:
+        try:
+            # Both paths read the styled items of the representation the same way
+            colour = index.get_colour(entity) if index else get_element_colour(entity.file, entity)
+            if colour:
+                entity_info["Color"] = colour
+        except:
+            pass
+
+    # Get properties
+    if fields is None or "Properties" in fields:
+        try:
+            props = index.get_psets(entity) if index else element_util.get_psets(entity)
+            if props:
+                entity_info["Properties"] = props
+        except:
+            pass
+
+    return entity_info
+
+def process_ifc_file(file_path: str, file_id: str = None, include_details: bool = True):
     """
     Parse and extract metadata from the IFC file.
     Returns detailed information about the model's entities.
+
+    With include_details=False only the project info and entity counts are
+    returned, the entities themselves are listed with list_ifc_entities.
     """
     try:
         # Open the IFC file
-        model = ifcopenshell.open(file_path)
+        model = _open_model(file_path, file_id)
 
         # Basic metadata
         project = model.by_type("IfcProject")[0]
@@ -30,269 +130,764 @@ def process_ifc_file(file_path: str):
         }
 
         # Extract entities and count them by type
-        entity_types = ["IfcWall", "IfcWindow", "IfcDoor", "IfcSlab", "IfcRoof",
-                        "IfcColumn", "IfcBeam", "IfcStair", "IfcSpace", "IfcFurnishingElement"]
-
         entity_details = {}
 
-        for entity_type in entity_types:
+        # Scan the relationships once instead of walking them per entity
+        with span("relationship_index"):
+            index = RelationshipIndex(model) if include_details else None
+
+        extract_start = time.perf_counter()
+        extracted = 0
+        for entity_type in iter_progress("extracting metadata", ENTITY_TYPES):
             entities = model.by_type(entity_type)
             metadata["EntityCounts"][entity_type] = len(entities)
 
             # Get details for each entity
-            if entities:
-                entity_details[entity_type] = []
-                for entity in entities:
-                    entity_info = {
-                        "GlobalId": entity.GlobalId,
-                        "Name": entity.Name if hasattr(entity, "Name") and entity.Name else f"{entity_type}_{entity.id()}",
-                        "id": entity.id()
-                    }
-
-                    # Try to get material information
-                    try:
-                        materials = element_util.get_material(entity)
-                        if materials:
-                            if hasattr(materials, "Name"):
-                                entity_info["Material"] = materials.Name
-                            elif isinstance(materials, list):
-                                entity_info["Materials"] = [m.Name for m in materials if hasattr(m, "Name")]
-                    except:
-                        pass
-
-                    # Try to get color information if available
-                    try:
-                        styles = element_util.get_style(entity)
-                        if styles and hasattr(styles, "Styles"):
-                            for style in styles.Styles:
-                                if style.is_a("IfcSurfaceStyle"):
-                                    for style_item in style.Styles:
-                                        if style_item.is_a("IfcSurfaceStyleShading"):
-                                            entity_info["Color"] = {
-                                                "Red": style_item.SurfaceColour.Red,
-                                                "Green": style_item.SurfaceColour.Green,
-                                                "Blue": style_item.SurfaceColour.Blue,
-                                                "Alpha": style_item.SurfaceColour.Alpha if hasattr(style_item.SurfaceColour, "Alpha") else 1.0
-                                            }
-                    except:
-                        pass
-
-                    # Get properties
-                    try:
-                        props = element_util.get_psets(entity)
-                        if props:
-                            entity_info["Properties"] = props
-                    except:
-                        pass
-
-                    entity_details[entity_type].append(entity_info)
-
-        metadata["EntityDetails"] = entity_details
+            if entities and include_details:
+                entity_details[entity_type] = [
+                    _get_entity_info(entity, entity_type, index=index) for entity in entities
+                ]
+                extracted += len(entities)
+
+        if include_details:
+            extract_seconds = time.perf_counter() - extract_start
+            record_span("extract_entities", extract_seconds * 1000)
+            record_throughput("extract_entities", extracted, extract_seconds)
+
+        # Names of the materials in the model, known to the fast-path parser
+        metadata["MaterialNames"] = sorted({m.Name for m in model.by_type("IfcMaterial") if m.Name})
+
+        if include_details:
+            metadata["EntityDetails"] = entity_details
         return metadata
     except Exception as e:
         return {"error": str(e)}
 
-def modify_ifc_entities(file_path: str, modification_data: dict):
+def list_ifc_entities(file_path: str, file_id: str = None, entity_types=None, cursor: str = None,
+                      limit: int = 100, fields=None):
     """
-    Modify IFC entities based on the modification data.
+    List the entities of a model one page at a time.
 
     Args:
         file_path: Path to the IFC file
-        modification_data: Dictionary with modification instructions
+        file_id: ID of the file in the model cache, if any
+        entity_types: Types to list, defaults to ENTITY_TYPES
+        cursor: Cursor returned by the previous page ("<type>:<id>")
+        limit: Maximum number of entities in the page
+        fields: Fields to include, defaults to BASE_FIELDS. Material, Color and
+            Properties are only read from the model when requested.
 
     Returns:
-        Path to the modified file and a summary of changes
+        Dictionary with the entities of the page and the cursor of the next page
     """
     try:
-        # Open the IFC file
-        model = ifcopenshell.open(file_path)
+        model = _open_model(file_path, file_id)
+
+        entity_types = [t for t in (entity_types or ENTITY_TYPES) if t in ENTITY_TYPES]
+        fields = [f for f in (fields or BASE_FIELDS) if f in BASE_FIELDS + DETAIL_FIELDS]
+        if "Material" in fields or "Materials" in fields:
+            fields += [f for f in ("Material", "Materials") if f not in fields]
+        detail_fields = [f for f in fields if f in DETAIL_FIELDS]
+
+        # Resume after the entity the cursor points to
+        cursor_type, cursor_id = None, None
+        if cursor:
+            cursor_type, _, cursor_id = cursor.partition(":")
+            if cursor_type not in entity_types or not cursor_id.isdigit():
+                return {"error": f"Invalid cursor: {cursor}"}
+            entity_types = entity_types[entity_types.index(cursor_type):]
+            cursor_id = int(cursor_id)
+
+        page = []
+        next_cursor = None
+        for entity_type in entity_types:
+            ids = _type_ids(model, entity_type)
+            start = 0
+            if entity_type == cursor_type:
+                start = bisect.bisect_right(ids, cursor_id)
+
+            # One more entity than fits in the page tells whether there is a next page
+            for entity_id in ids[start:start + limit - len(page) + 1]:
+                if len(page) == limit:
+                    next_cursor = f"{page[-1]['type']}:{page[-1]['id']}"
+                    break
+                entity = model.by_id(entity_id)
+                entity_info = _get_entity_info(entity, entity_type, detail_fields)
+                entity_info["type"] = entity_type
+                page.append({k: v for k, v in entity_info.items() if k in fields or k in ("id", "type")})
+            if next_cursor:
+                break
+
+        return {
+            "entities": page,
+            "count": len(page),
+            "next_cursor": next_cursor
+        }
+    except Exception as e:
+        return {"error": str(e)}
 
-        # Extract modification parameters
-        entity_type = modification_data.get("entity_type", "")
-        entity_ids = modification_data.get("entity_ids", ["all"])
-        property_to_modify = modification_data.get("property", "")
-        new_value = modification_data.get("new_value", "")
+def list_entity_rows(file_path: str, file_id: str = None):
+    """
+    The base fields of all entities of ENTITY_TYPES, for the file registry.
 
-        # Check if we have valid data
-        if not entity_type or not property_to_modify or not new_value:
-            return {"error": "Missing required modification parameters"}
+    Returns:
+        List of (type, id, GlobalId, Name) tuples
+    """
+    try:
+        model = _open_model(file_path, file_id)
+        rows = []
+        for entity_type in iter_progress("indexing entities", ENTITY_TYPES):
+            for entity in model.by_type(entity_type):
+                name = entity.Name if getattr(entity, "Name", None) else f"{entity_type}_{entity.id()}"
+                rows.append((entity_type, entity.id(), entity.GlobalId, name))
+        return rows
+    except Exception as e:
+        return {"error": str(e)}
 
-        # Get entities to modify
-        if entity_type == "unknown":
-            return {"error": "Could not determine which entity type to modify"}
+def get_ifc_entity(file_path: str, file_id: str = None, entity_id: int = None):
+    """Get all details of one entity, including its property sets and materials"""
+    try:
+        model = _open_model(file_path, file_id)
+        try:
+            entity = model.by_id(int(entity_id))
+        except RuntimeError:
+            return {"error": f"Entity {entity_id} not found"}
+
+        entity_type = next((t for t in ENTITY_TYPES if entity.is_a(t)), entity.is_a())
+        entity_info = _get_entity_info(entity, entity_type)
+        entity_info["type"] = entity_type
+        return entity_info
+    except Exception as e:
+        return {"error": str(e)}
 
-        entities = model.by_type(entity_type)
+def query_entities(file_path: str, file_id: str = None, selector: str = "*", cursor: str = None,
+                   limit: int = 100, fields=None):
+    """
+    Answer an entity query from the entity index of a model.
 
-        # Filter entities by ID if specific IDs are provided
-        if entity_ids != ["all"]:
+    Args:
+        file_path: Path to the IFC file
+        file_id: ID of the file in the model cache, if any
+        selector: Filter in the selector syntax of entity_index
+        cursor: Cursor returned by the previous page (the last entity id)
+        limit: Maximum number of entities in the page
+        fields: Fields to include, defaults to BASE_FIELDS and the storey
+
+    Returns:
+        Dictionary with the number of matches, their counts by type, storey
+        and material, the entities of the page and the cursor of the next page
+    """
+    try:
+        start = time.perf_counter()
+        fields = [f for f in (fields or BASE_FIELDS + ["Storey"]) if f in BASE_FIELDS + DETAIL_FIELDS + ["Storey"]]
+        detail_fields = [f for f in fields if f in DETAIL_FIELDS]
+        if cursor is not None and not str(cursor).isdigit():
+            return {"error": f"Invalid cursor: {cursor}"}
+
+        # Hold the model's lock, a modification may take the same model
+        if file_id:
+            opened = model_cache.open_model(file_id, file_path)
+        else:
+            opened = nullcontext(_parse_file(file_path))
+        with opened as model:
+            with span("entity_index"):
+                index = get_entity_index(model)
             try:
-                entity_ids = [int(id) for id in entity_ids if str(id).isdigit()]
-                entities = [e for e in entities if e.id() in entity_ids]
-            except:
-                # If conversion fails, proceed with all entities
-                pass
-
-        if not entities:
-            return {"error": f"No {entity_type} entities found to modify"}
-
-        changes_made = 0
-
-        # Apply modifications based on property type
-        if property_to_modify.lower() in ["color", "colour"]:
-            # Handle color modification
-            changes_made = _modify_entity_colors(model, entities, new_value)
-
-        elif property_to_modify.lower() in ["material"]:
-            # Handle material modification
-            changes_made = _modify_entity_materials(model, entities, new_value)
-
-        elif property_to_modify.lower() in ["name"]:
-            # Handle name modification
-            for entity in entities:
-                if hasattr(entity, "Name"):
-                    entity.Name = new_value
-                    changes_made += 1
+                with span("entity_query"):
+                    ids = index.select(selector or "*")
+            except SelectorError as e:
+                return {"error": str(e)}
+
+            position = bisect.bisect_right(ids, int(cursor)) if cursor is not None else 0
+            page = []
+            for entity_id in ids[position:position + limit]:
+                entity = model.by_id(entity_id)
+                entity_info = _get_entity_info(entity, entity.is_a(), detail_fields)
+                entity_info["type"] = entity.is_a()
+                storey = index.element_storey.get(entity_id)
+                if storey is not None:
+                    entity_info["Storey"] = index.storey_names.get(storey)
+                page.append({k: v for k, v in entity_info.items() if k in fields or k in ("id", "type")})
 
-        # Save the modified file
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        filename = os.path.basename(file_path)
-        base_name, ext = os.path.splitext(filename)
-        output_dir = os.path.join(os.path.dirname(file_path), "modified")
+        return {
+            "selector": selector,
+            "count": len(ids),
+            "counts": index.counts(ids),
+            "entities": page,
+            "next_cursor": str(page[-1]["id"]) if position + limit < len(ids) and page else None,
+            "index_build_ms": index.build_ms,
+            "query_ms": round((time.perf_counter() - start) * 1000, 3)
+        }
+    except Exception as e:
+        return {"error": str(e)}
+
+# Field of the element delta changed by each kind of modification
+DELTA_FIELDS = {"color": "Color", "colour": "Color", "material": "Material", "name": "Name"}
+
+def _delta_value(model, entity, field: str):
+    """Current value of an element delta field"""
+    if field == "Color":
+        return get_element_colour(model, entity)
+    if field == "Material":
+        material = element_util.get_material(entity)
+        return getattr(material, "Name", None) if material is not None else None
+    return getattr(entity, "Name", None)
+
+def _shape_key(entity):
+    """References that determine the shape of an element"""
+    representation = getattr(entity, "Representation", None)
+    placement = getattr(entity, "ObjectPlacement", None)
+    return (representation.id() if representation else None, placement.id() if placement else None)
+
+def _element_delta(model, entities, field: str, before: dict):
+    """
+    Compare the elements of an edit with their state before it.
+    Only elements whose value or shape changed are part of the delta, and
+    only those whose shape changed are tessellated again.
+    """
+    delta = {"changed": [], "elements": {}, "geometry": {}}
+    shape_changed = []
+    for entity in entities:
+        old_value, old_shape = before[entity.id()]
+        value = _delta_value(model, entity, field) if field else old_value
+        if _shape_key(entity) != old_shape:
+            shape_changed.append(entity)
+        elif value == old_value:
+            continue
+        guid = getattr(entity, "GlobalId", None) or str(entity.id())
+        delta["changed"].append(guid)
+        element = {"id": entity.id(), "type": entity.is_a()}
+        if field:
+            element[field] = value
+        delta["elements"][guid] = element
+    delta["geometry"] = tessellate_elements(model, shape_changed)
+    return delta
+
+def _select_targets(model, entity_type: str, entity_ids, selector: str = None):
+    """
+    Entities a modification applies to: those matching the selector if
+    there is one, else the entities of the type, or the listed ones by id
+    or GlobalId.
+    """
+    if selector:
+        return select_entities(model, selector, entity_type)
+    if not entity_ids or entity_ids == ["all"] or "all" in entity_ids:
+        return model.by_type(entity_type)
+
+    entities = []
+    for entity_id in dict.fromkeys(str(i).strip().lstrip("#") for i in entity_ids):
+        try:
+            entity = model.by_id(int(entity_id)) if entity_id.isdigit() else model.by_guid(entity_id)
+        except RuntimeError:
+            # Not in the model
+            continue
+        if entity.is_a(entity_type):
+            entities.append(entity)
+    return entities
+
+def apply_modification(model, modification_data: dict, compact: bool = None):
+    """
+    Apply a modification to an open model in place, without writing it.
+
+    Args:
+        model: The IFC model
+        modification_data: Dictionary with modification instructions
+        compact: Reuse styles and material associations (defaults to COMPACT_WRITE)
 
-        # Create output directory if it doesn't exist
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+    Returns:
+        Tuple of a summary of changes (or an error) and the modified entities
+    """
+    # Extract modification parameters
+    entity_type = modification_data.get("entity_type", "")
+    entity_ids = modification_data.get("entity_ids", ["all"])
+    selector = modification_data.get("selector")
+    property_to_modify = modification_data.get("property", "")
+    new_value = modification_data.get("new_value", "")
+
+    if compact is None:
+        compact = COMPACT_WRITE
+
+    # Check if we have valid data
+    if not (entity_type or selector) or not property_to_modify or not new_value:
+        return {"error": "Missing required modification parameters"}, []
+
+    # Get entities to modify
+    if entity_type == "unknown" and not selector:
+        return {"error": "Could not determine which entity type to modify"}, []
+    if entity_type == "unknown":
+        entity_type = None
+
+    try:
+        report_progress("selecting")
+        with span("ifc_select"):
+            entities = _select_targets(model, entity_type, entity_ids, selector)
+    except SelectorError as e:
+        return {"error": str(e)}, []
+
+    if not entities:
+        return {"error": f"No {selector or entity_type} entities found to modify"}, []
+    entity_type = entity_type or entities[0].is_a()
 
-        output_path = os.path.join(output_dir, f"{base_name}_modified_{timestamp}{ext}")
+    edit_start = time.perf_counter()
+    changes_made = 0
+    tally = {"entities_added": 0, "entities_removed": 0}
+
+    # State of the elements before the edit, to report what it changed
+    field = DELTA_FIELDS.get(property_to_modify.lower())
+    before = {
+        e.id(): (_delta_value(model, e, field) if field else None, _shape_key(e)) for e in entities
+    }
+
+    # Apply modifications based on property type
+    if property_to_modify.lower() in ["color", "colour"]:
+        # Handle color modification
+        changes_made = _modify_entity_colors(model, entities, new_value, tally, compact)
+
+    elif property_to_modify.lower() in ["material"]:
+        # Handle material modification
+        changes_made = _modify_entity_materials(model, entities, new_value, tally, compact)
+
+    elif property_to_modify.lower() in ["name"]:
+        # Handle name modification
+        for entity in iter_progress("applying edit", entities):
+            if hasattr(entity, "Name"):
+                entity.Name = new_value
+                changes_made += 1
+
+    # Selectors resolved on this model later see the edit
+    report_progress("re-indexing")
+    update_entity_index(model, entities, field)
+
+    delta = _element_delta(model, entities, field, before)
+    record_span("ifc_edit", (time.perf_counter() - edit_start) * 1000)
+    return {
+        "entities_modified": changes_made,
+        "modification": {
+            "entity_type": entity_type,
+            **({"selector": selector} if selector else {}),
+            "property": property_to_modify,
+            "new_value": new_value
+        },
+        # Change of the number of entities in the model
+        "entity_delta": {**tally, "net": tally["entities_added"] - tally["entities_removed"]},
+        # Elements changed by the edit, so clients can patch their scene
+        "delta": delta
+    }, entities
+
+def write_modified_model(model, file_path: str):
+    """
+    Write a modified model next to the file it derives from.
+
+    Returns:
+        Path of the written file
+    """
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    filename = os.path.basename(file_path)
+    base_name, ext = os.path.splitext(filename)
+    # All versions of a lineage share the modified directory of its upload,
+    # named after the uploaded file rather than after every version before
+    base_name = base_name.split("_modified_")[0]
+    output_dir = os.path.dirname(file_path)
+    if os.path.basename(output_dir) != "modified":
+        output_dir = os.path.join(output_dir, "modified")
+
+    # Create output directory if it doesn't exist
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # The random suffix keeps files written within the same second apart
+    output_path = os.path.join(output_dir, f"{base_name}_modified_{timestamp}_{uuid.uuid4().hex[:6]}{ext}")
+    report_progress("writing file")
+    with span("ifc_write"):
         model.write(output_path)
+    return output_path
+
+def modify_ifc_entities(file_path: str, modification_data: dict, file_id: str = None, new_file_id: str = None):
+    """
+    Modify IFC entities based on the modification data.
+
+    Args:
+        file_path: Path to the IFC file
+        modification_data: Dictionary with modification instructions
+        file_id: ID of the file in the model cache, if any
+        new_file_id: ID under which the modified model is cached, if any
+
+    Returns:
+        Path to the modified file and a summary of changes
+    """
+    try:
+        # Check the parameters before opening the model
+        if not (modification_data.get("entity_type") or modification_data.get("selector")) \
+                or not modification_data.get("property") or not modification_data.get("new_value"):
+            return {"error": "Missing required modification parameters"}
+        if modification_data.get("entity_type") == "unknown" and not modification_data.get("selector"):
+            return {"error": "Could not determine which entity type to modify"}
+
+        # Open the IFC file. The cached model is taken out of the cache since
+        # it is modified in place and becomes the model of the new file.
+        if file_id:
+            model = model_cache.take(file_id, file_path)
+        else:
+            model = _parse_file(file_path)
+
+        result, entities = apply_modification(model, modification_data)
+        if "error" in result:
+            # Nothing was changed, so the model can go back into the cache
+            if file_id:
+                model_cache.put(file_id, file_path, model)
+            return result
 
+        # Save the modified file
+        output_path = write_modified_model(model, file_path)
+
+        # Keep the modified model in memory for the new file
+        if new_file_id:
+            model_cache.put(new_file_id, output_path, model)
+
+        file_size = os.path.getsize(output_path)
         return {
             "original_file": file_path,
             "modified_file": output_path,
-            "entities_modified": changes_made,
-            "modification": {
-                "entity_type": entity_type,
-                "property": property_to_modify,
-                "new_value": new_value
-            }
+            "content_hash": hash_file(output_path),
+            "file_size": file_size,
+            "file_size_delta": file_size - os.path.getsize(file_path),
+            **result
         }
 
     except Exception as e:
         return {"error": str(e)}
 
-def _modify_entity_colors(model, entities, color_value):
-    """Helper function to modify entity colors"""
-    changes_made = 0
-    try:
-        # Parse color value
-        if isinstance(color_value, str):
-            color_name = color_value.lower()
-            # Map of color names to RGB values
-            color_map = {
-                "red": (1.0, 0.0, 0.0),
-                "green": (0.0, 1.0, 0.0),
-                "blue": (0.0, 0.0, 1.0),
-                "yellow": (1.0, 1.0, 0.0),
-                "white": (1.0, 1.0, 1.0),
-                "black": (0.0, 0.0, 0.0),
-                "gray": (0.5, 0.5, 0.5),
-                "purple": (0.5, 0.0, 0.5),
-                "orange": (1.0, 0.65, 0.0),
-                "brown": (0.65, 0.16, 0.16)
-            }
-            if color_name in color_map:
-                r, g, b = color_map[color_name]
-            else:
-                # Default to red if color not recognized
-                r, g, b = (1.0, 0.0, 0.0)
-        else:
-            # Default to red
-            r, g, b = (1.0, 0.0, 0.0)
+def modify_and_process_ifc_file(file_path: str, modification_data: dict, file_id: str = None, new_file_id: str = None):
+    """
+    Modify an IFC file and extract the metadata of the modified file.
+    Both steps run in the same call so that, in a worker process, the
+    metadata is extracted from the modified model still in that process' cache.
 
-        # Create a new color
-        rgb = model.createIfcColourRgb(None, r, g, b)
+    Returns:
+        Tuple of the modification result and the new metadata (None on error)
+    """
+    result = modify_ifc_entities(file_path, modification_data, file_id, new_file_id)
+    new_metadata = None
+    if "error" not in result and "modified_file" in result:
+        new_metadata = process_ifc_file(result["modified_file"], new_file_id, False)
+    return result, new_metadata
+
+def modify_ifc_batch(file_path: str, operations: list, file_id: str = None, new_file_id: str = None):
+    """
+    Apply a list of modifications to one loaded model and write it once.
+    An operation that fails or modifies no entity is reported and skipped,
+    the others are applied in order. Nothing is written when no operation
+    changed the model.
 
-        # Create surface style shading
-        surface_shading = model.createIfcSurfaceStyleShading(rgb)
+    Args:
+        file_path: Path to the IFC file
+        operations: Modification dictionaries, as taken by apply_modification
+        file_id: ID of the file in the model cache, if any
+        new_file_id: ID under which the modified model is cached, if any
+
+    Returns:
+        Tuple of the batch result with per-operation results and timings,
+        and the metadata of the modified file (None if nothing was written)
+    """
+    try:
+        start = time.perf_counter()
+        if file_id:
+            model = model_cache.take(file_id, file_path)
+        else:
+            model = _parse_file(file_path)
+        open_ms = (time.perf_counter() - start) * 1000
+
+        results = []
+        delta = {"elements": {}, "geometry": {}}
+        tally = {"entities_added": 0, "entities_removed": 0}
+        raised = False
+        for index, modification_data in enumerate(operations):
+            report_progress("applying edits", index / len(operations), done=index, total=len(operations))
+            edit_start = time.perf_counter()
+            try:
+                result, _ = apply_modification(model, modification_data)
+            except Exception as e:
+                # The edit may have stopped halfway, the model is no longer the cached file
+                raised = True
+                result = {"error": str(e)}
+            if "error" not in result and not result["entities_modified"]:
+                result.pop("delta")
+                result["error"] = "No entity was modified"
+            result["edit_ms"] = round((time.perf_counter() - edit_start) * 1000, 3)
+            result["index"] = index
+            if "error" not in result:
+                operation_delta = result.pop("delta")
+                for guid, element in operation_delta["elements"].items():
+                    delta["elements"].setdefault(guid, {}).update(element)
+                delta["geometry"].update(operation_delta["geometry"])
+                for key in tally:
+                    tally[key] += result["entity_delta"][key]
+            results.append(result)
+
+        applied = sum(1 for r in results if "error" not in r)
+        summary = {
+            "operations": results,
+            "applied": applied,
+            "failed": len(results) - applied,
+            "entities_modified": sum(r.get("entities_modified", 0) for r in results),
+            "entity_delta": {**tally, "net": tally["entities_added"] - tally["entities_removed"]}
+        }
+        if not applied:
+            # Nothing was changed, so the model can go back into the cache,
+            # unless an edit failed partway; it is then read again when needed
+            if file_id and not raised:
+                model_cache.put(file_id, file_path, model)
+            return {**summary, "error": "No modification could be applied"}, None
+
+        delta = {"changed": list(delta["elements"]), **delta}
+
+        write_start = time.perf_counter()
+        output_path = write_modified_model(model, file_path)
+        write_ms = (time.perf_counter() - write_start) * 1000
+        if new_file_id:
+            model_cache.put(new_file_id, output_path, model)
+
+        metadata_start = time.perf_counter()
+        new_metadata = process_ifc_file(output_path, new_file_id, False)
+        metadata_ms = (time.perf_counter() - metadata_start) * 1000
+
+        file_size = os.path.getsize(output_path)
+        return {
+            "original_file": file_path,
+            "modified_file": output_path,
+            "content_hash": hash_file(output_path),
+            "file_size": file_size,
+            "file_size_delta": file_size - os.path.getsize(file_path),
+            **summary,
+            "delta": delta,
+            "timings": {
+                "open_ms": round(open_ms, 3),
+                "edit_ms": round(sum(r["edit_ms"] for r in results), 3),
+                "write_ms": round(write_ms, 3),
+                "metadata_ms": round(metadata_ms, 3),
+                "total_ms": round((time.perf_counter() - start) * 1000, 3)
+            }
+        }, new_metadata
 
-        # Create surface style rendering
-        renderer = model.createIfcSurfaceStyleRendering(
-            rgb, 0.0, None, None, None, None, None, None, "FLAT"
-        )
+    except Exception as e:
+        return {"error": str(e)}, None
+
+def _create(model, tally: dict, entity_type: str, *args):
+    """Create an entity, counting it in the tally of the edit"""
+    tally["entities_added"] += 1
+    return model.create_entity(entity_type, *args)
+
+def _remove_unused(model, entity, tally: dict):
+    """Remove an entity nothing refers to anymore, then the entities it referred to if they became unused"""
+    if entity.id() == 0 or model.get_total_inverses(entity) > 0:
+        return
+    children = []
+    for value in entity:
+        values = value if isinstance(value, (list, tuple)) else [value]
+        children.extend(v for v in values if isinstance(v, ifcopenshell.entity_instance))
+    model.remove(entity)
+    tally["entities_removed"] += 1
+    for child in children:
+        _remove_unused(model, child, tally)
+
+def _parse_color(color_value):
+    """RGB of a color name, red if the name is not recognized"""
+    if isinstance(color_value, str) and color_value.lower() in COLOR_MAP:
+        return COLOR_MAP[color_value.lower()]
+    return (1.0, 0.0, 0.0)
+
+def _is_surface_style(style):
+    """Whether a style (or a style assignment) sets the surface colour"""
+    if style.is_a("IfcPresentationStyleAssignment"):
+        return any(s.is_a("IfcSurfaceStyle") for s in style.Styles)
+    return style.is_a("IfcSurfaceStyle")
+
+def _find_surface_style(model, rgb):
+    """An existing opaque surface style with exactly this colour, or None"""
+    for style in model.by_type("IfcSurfaceStyle"):
+        shadings = [s for s in style.Styles if s.is_a("IfcSurfaceStyleShading")]
+        if shadings and all(
+            (s.SurfaceColour.Red, s.SurfaceColour.Green, s.SurfaceColour.Blue) == tuple(rgb)
+            and not getattr(s, "Transparency", None)
+            for s in shadings
+        ):
+            return style
+    return None
+
+def _surface_style_reference(model, rgb, tally: dict):
+    """
+    The style to put on styled items for a colour, reusing an identical
+    existing style and its style assignment.
+    """
+    style = _find_surface_style(model, rgb)
+    if style is None:
+        r, g, b = rgb
+        colour = _create(model, tally, "IfcColourRgb", None, r, g, b)
+        shading = _create(model, tally, "IfcSurfaceStyleShading", colour)
+        rendering = _create(model, tally, "IfcSurfaceStyleRendering", colour, 0.0, None, None, None, None, None, None, "FLAT")
+        style = _create(model, tally, "IfcSurfaceStyle", f"Color-{uuid.uuid4().hex[:8]}", "BOTH", [shading, rendering])
+
+    # IFC4X3 removed the style assignment, styles are referenced directly
+    if model.schema not in ("IFC2X3", "IFC4"):
+        return style
+    for inverse in model.get_inverse(style):
+        if inverse.is_a("IfcPresentationStyleAssignment") and len(inverse.Styles) == 1:
+            return inverse
+    return _create(model, tally, "IfcPresentationStyleAssignment", [style])
+
+def _modify_entity_colors(model, entities, color_value, tally: dict, compact: bool = True):
+    """
+    Helper function to modify entity colors.
 
-        # Create surface style
-        style_name = f"Color-{uuid.uuid4().hex[:8]}"
-        surface_style = model.createIfcSurfaceStyle(
-            style_name, "BOTH", [surface_shading, renderer]
-        )
+    In compact mode an identical existing style is reused, and the surface
+    style of an already styled item is replaced instead of stacking another
+    styled item on it. Styles nothing refers to anymore are removed.
+    """
+    changes_made = 0
+    try:
+        rgb = _parse_color(color_value)
 
-        # Create presentation style assignment
-        style_assignment = model.createIfcPresentationStyleAssignment([surface_style])
+        if compact:
+            style_reference = _surface_style_reference(model, rgb, tally)
+        else:
+            # A new style for every edit
+            r, g, b = rgb
+            colour = _create(model, tally, "IfcColourRgb", None, r, g, b)
+            shading = _create(model, tally, "IfcSurfaceStyleShading", colour)
+            rendering = _create(model, tally, "IfcSurfaceStyleRendering", colour, 0.0, None, None, None, None, None, None, "FLAT")
+            surface_style = _create(model, tally, "IfcSurfaceStyle", f"Color-{uuid.uuid4().hex[:8]}", "BOTH", [shading, rendering])
+            style_reference = _create(model, tally, "IfcPresentationStyleAssignment", [surface_style])
 
         # Apply styling to each entity
-        for entity in entities:
+        for entity in iter_progress("applying edit", entities):
             # Get entity representation
-            if hasattr(entity, "Representation") and entity.Representation:
-                representations = entity.Representation.Representations
-
-                for rep in representations:
-                    for item in rep.Items:
-                        # Create styled item
-                        styled_item = model.createIfcStyledItem(item, [style_assignment], None)
+            if not (hasattr(entity, "Representation") and entity.Representation):
+                continue
+            for rep in entity.Representation.Representations:
+                for item in rep.Items:
+                    styled_items = [i for i in model.get_inverse(item) if i.is_a("IfcStyledItem")] if compact else []
+                    if not styled_items:
+                        _create(model, tally, "IfcStyledItem", item, [style_reference], None)
                         changes_made += 1
+                        continue
+
+                    # Replace the surface style of the first styled item, drop the ones stacked on it
+                    styled_item, superseded = styled_items[0], styled_items[1:]
+                    old_styles = [s for s in styled_item.Styles if s != style_reference]
+                    styled_item.Styles = [s for s in old_styles if not _is_surface_style(s)] + [style_reference]
+                    for stacked in superseded:
+                        old_styles.extend(stacked.Styles)
+                        model.remove(stacked)
+                        tally["entities_removed"] += 1
+                    for style in old_styles:
+                        _remove_unused(model, style, tally)
+                    changes_made += 1
 
         return changes_made
     except Exception as e:
         print(f"Error modifying colors: {e}")
         return changes_made
 
-def _modify_entity_materials(model, entities, material_name):
-    """Helper function to modify entity materials"""
+def _modify_entity_materials(model, entities, material_name, tally: dict, compact: bool = True):
+    """
+    Helper function to modify entity materials.
+
+    In compact mode the entities are moved out of their previous material
+    associations and added to a single association with the new material.
+    """
     changes_made = 0
     try:
-        # Create a new material if it doesn't exist
-        materials = model.by_type("IfcMaterial")
-        material = None
-
         # Try to find existing material with the same name
-        for mat in materials:
+        material = None
+        for mat in model.by_type("IfcMaterial"):
             if mat.Name == material_name:
                 material = mat
                 break
 
         # Create new material if not found
         if not material:
-            material = model.createIfcMaterial(material_name)
-
-        # Create material assignment for each entity
-        for entity in entities:
-            # Create material select
-            material_select = model.createIfcMaterialDefinitionRepresentation(
-                material_name, None, None, material
-            )
-
-            # Assign material to entity
-            rel = model.createIfcRelAssociatesMaterial(
-                ifcopenshell.guid.new(),  # GlobalId
-                model.by_type("IfcOwnerHistory")[0] if model.by_type("IfcOwnerHistory") else None,  # OwnerHistory
-                f"MaterialAssignment-{material_name}",  # Name
-                None,  # Description
-                [entity],  # RelatedObjects
-                material  # RelatingMaterial
+            material = _create(model, tally, "IfcMaterial", material_name)
+
+        owner_histories = model.by_type("IfcOwnerHistory")
+        owner_history = owner_histories[0] if owner_histories else None
+
+        if not compact:
+            # Create material assignment for each entity
+            for entity in iter_progress("applying edit", entities):
+                _create(model, tally, "IfcMaterialDefinitionRepresentation", material_name, None, None, material)
+                _create(
+                    model, tally, "IfcRelAssociatesMaterial",
+                    ifcopenshell.guid.new(),  # GlobalId
+                    owner_history,  # OwnerHistory
+                    f"MaterialAssignment-{material_name}",  # Name
+                    None,  # Description
+                    [entity],  # RelatedObjects
+                    material  # RelatingMaterial
+                )
+                changes_made += 1
+            return changes_made
+
+        # Take the entities out of the associations with other materials
+        entity_ids = {e.id() for e in entities}
+        previous = {}
+        for entity in iter_progress("applying edit", entities):
+            for rel in getattr(entity, "HasAssociations", None) or []:
+                if rel.is_a("IfcRelAssociatesMaterial") and rel.RelatingMaterial != material:
+                    previous[rel.id()] = rel
+        for rel in previous.values():
+            remaining = [o for o in rel.RelatedObjects if o.id() not in entity_ids]
+            if remaining:
+                rel.RelatedObjects = remaining
+            else:
+                model.remove(rel)
+                tally["entities_removed"] += 1
+
+        # Add them to the association of the material, or create one for all of them
+        rel = next((i for i in model.get_inverse(material) if i.is_a("IfcRelAssociatesMaterial")), None)
+        if rel is not None:
+            related = list(rel.RelatedObjects)
+            related_ids = {o.id() for o in related}
+            rel.RelatedObjects = related + [e for e in entities if e.id() not in related_ids]
+        else:
+            _create(
+                model, tally, "IfcRelAssociatesMaterial",
+                ifcopenshell.guid.new(), owner_history, f"MaterialAssignment-{material_name}", None,
+                list(entities), material
             )
-            changes_made += 1
+        changes_made = len(entities)
 
         return changes_made
     except Exception as e:
         print(f"Error modifying materials: {e}")
         return changes_made
 
-def get_entity_summary(file_path: str):
+def build_modification_context(file_path: str, file_id: str = None, instruction: str = "", token_budget: int = None):
+    """
+    Build the file context for the modification parser prompt.
+    Only the entries relevant to the instruction are packed into the token budget.
+
+    Returns:
+        Dictionary with the context text and packing statistics
+    """
+    try:
+        model = _open_model(file_path, file_id)
+        with span("context_index"):
+            if file_id:
+                index = get_context_index(file_id, model, ENTITY_TYPES)
+            else:
+                index = ContextIndex(model, ENTITY_TYPES)
+        with span("context_pack"):
+            return index.pack(instruction, token_budget or CONTEXT_TOKEN_BUDGET)
+    except Exception as e:
+        return {"error": str(e)}
+
+def get_entity_summary(file_path: str, file_id: str = None):
     """
     Get a simplified summary of IFC entities suitable for AI context.
     """
     try:
-        model = ifcopenshell.open(file_path)
+        model = _open_model(file_path, file_id)
+        summary_start = time.perf_counter()
 
         # Create a summary of the model contents
         summary = []
@@ -305,11 +900,9 @@ def get_entity_summary(file_path: str):
             summary.append(f"Project: {project.Name or 'Unnamed'}")
 
         # Count entities by type
-        entity_types = ["IfcWall", "IfcWindow", "IfcDoor", "IfcSlab", "IfcRoof",
-                        "IfcColumn", "IfcBeam", "IfcStair", "IfcSpace", "IfcFurnishingElement"]
-
+        report_progress("summarizing")
         counts = {}
-        for entity_type in entity_types:
+        for entity_type in ENTITY_TYPES:
             count = len(model.by_type(entity_type))
             if count > 0:
                 counts[entity_type] = count
@@ -328,6 +921,15 @@ def get_entity_summary(file_path: str):
             if len(materials) > 5:
                 summary.append(f"  (and {len(materials) - 5} more materials)")
 
+        record_span("summary", (time.perf_counter() - summary_start) * 1000)
         return "\n".join(summary)
     except Exception as e:
-        return f"Error getting entity summary: {str(e)}"
\ No newline at end of file
+        return f"Error getting entity summary: {str(e)}"
+
+def load_engine():
+    """
+    Import the IFC and geometry engines in this worker process, so the
+    first request it serves does not pay for it.
+    """
+    geometry_engine()
+    return {"ifcopenshell": ifcopenshell.version, "pid": os.getpid()}
@@ -0,0 +1,221 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+# Priority classes, lower runs first. Parsing a modification blocks an edit
+# the user is waiting for, free chat can wait behind it.
+PRIORITY_PARSE = 0
+PRIORITY_CHAT = 1
+
+# Maximum number of requests waiting for the model
+INFERENCE_QUEUE_DEPTH = int(os.environ.get("SAPCAD_INFERENCE_QUEUE_DEPTH", "32"))
+
+# Seconds a request may take from submission, including its wait in the queue
+INFERENCE_REQUEST_TIMEOUT = float(os.environ.get("SAPCAD_INFERENCE_REQUEST_TIMEOUT", "120"))
+
+
+class InferenceQueueFull(Exception):
+    """The queue is at its maximum depth"""
+
+
+class InferenceTimeout(Exception):
+    """The request did not start before its deadline"""
+
+
+class InferenceCancelled(Exception):
+    """The request was cancelled while it was queued"""
+
+
+def add_inference_stats(result, stats: dict):
+    """Report the scheduling of a request in the prompt_stats of its result"""
+    if isinstance(result, dict) and isinstance(result.get("prompt_stats"), dict):
+        for key, value in stats.items():
+            # Statistics of the inference service, if any, are the more precise ones
+            result["prompt_stats"].setdefault(key, value)
+    return result
+
+
+class _Request:
+    def __init__(self, func, args, priority: int, deadline: float, cancel_event, key):
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.deadline = deadline
+        self.key = key
+        self.submitted_at = time.perf_counter()
+        # The request and the identical requests coalesced into it, as (future, cancel event)
+        self.waiters = [(Future(), cancel_event)]
+
+    @property
+    def cancelled(self):
+        """Cancelled once everybody waiting for it cancelled, or stopped waiting"""
+        return all(
+            future.cancelled() or (event is not None and event.is_set()) for future, event in self.waiters
+        )
+
+
+class InferenceScheduler:
+    """
+    Queue in front of the LLM.
+
+    Requests wait in a bounded priority queue and are run by a fixed number
+    of threads (one when the model is in this process, since it can only
+    decode one sequence at a time). A request that is cancelled or past its
+    deadline before it starts is dropped. Identical call requests waiting in
+    the queue are run once and share the result, which is the batching the
+    llama.cpp bindings allow: they decode a single sequence per call.
+
+    The future of a request carries an inference_stats dictionary with its
+    queue wait and run time.
+    """
+
+    def __init__(self, concurrency: int = 1, max_depth: int = INFERENCE_QUEUE_DEPTH,
+                 timeout: float = INFERENCE_REQUEST_TIMEOUT, name: str = "sapcad-inference"):
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.timeout = timeout
+        self.name = name
+        self._queue = []
+        self._queued = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._running = 0
+        self._stopped = False
+        self.counters = {"completed": 0, "failed": 0, "rejected": 0, "timed_out": 0,
+                         "cancelled": 0, "coalesced": 0}
+        self.total_wait_ms = 0.0
+
+    def _key(self, func, args):
+        """Key of identical requests, None when the arguments can't be compared"""
+        try:
+            return (func.__module__, func.__qualname__, json.dumps(args, sort_keys=True))
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    def submit(self, func, *args, priority: int = PRIORITY_CHAT, timeout: float = None,
+               cancel_event=None, coalesce: bool = False):
+        """
+        Queue a blocking call.
+
+        Args:
+            func: Function to call with args
+            priority: PRIORITY_PARSE or PRIORITY_CHAT
+            timeout: Seconds until the request is dropped if it has not started
+            cancel_event: threading.Event, the request is dropped if set before it starts
+            coalesce: Share the result with an identical request already queued
+
+        Returns:
+            concurrent.futures.Future of the result
+        """
+        key = self._key(func, args) if coalesce else None
+        deadline = time.perf_counter() + (timeout or self.timeout)
+        with self._condition:
+            existing = self._queued.get(key) if key else None
+            if existing is not None:
+                future = Future()
+                existing.waiters.append((future, cancel_event))
+                existing.deadline = max(existing.deadline, deadline)
+                self.counters["coalesced"] += 1
+                return future
+
+            if len(self._queue) >= self.max_depth:
+                self.counters["rejected"] += 1
+                raise InferenceQueueFull(f"Inference queue is full ({self.max_depth} requests)")
+
+            request = _Request(func, args, priority, deadline, cancel_event, key)
+            heapq.heappush(self._queue, (priority, next(self._sequence), request))
+            if key:
+                self._queued[key] = request
+            self._start_threads()
+            self._condition.notify()
+            return request.waiters[0][0]
+
+    def _start_threads(self):
+        while len(self._threads) < self.concurrency:
+            thread = threading.Thread(target=self._work, name=f"{self.name}-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _finish(self, request: _Request, stats: dict, result=None, error: Exception = None):
+        for future, _ in request.waiters:
+            # The future of a waiter that went away (e.g. a cancelled asyncio
+            # task wrapping it) is cancelled and takes no result
+            if future.cancelled():
+                continue
+            future.inference_stats = stats
+            try:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    # Dictionaries are copied, waiters may change their result
+                    future.set_result(dict(result) if isinstance(result, dict) else result)
+            except InvalidStateError:
+                # Cancelled in the meantime
+                pass
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                _, _, request = heapq.heappop(self._queue)
+                if request.key:
+                    self._queued.pop(request.key, None)
+                self._running += 1
+
+            started_at = time.perf_counter()
+            stats = {"queue_wait_ms": round((started_at - request.submitted_at) * 1000, 3),
+                     "priority": request.priority, "coalesced": len(request.waiters) - 1}
+            outcome = "completed"
+            try:
+                if request.cancelled:
+                    outcome = "cancelled"
+                    self._finish(request, stats, error=InferenceCancelled("Request cancelled while queued"))
+                elif started_at > request.deadline:
+                    outcome = "timed_out"
+                    self._finish(request, stats, error=InferenceTimeout("Request timed out in the inference queue"))
+                else:
+                    try:
+                        result = request.func(*request.args)
+                    except Exception as e:
+                        outcome = "failed"
+                        stats["run_ms"] = round((time.perf_counter() - started_at) * 1000, 3)
+                        self._finish(request, stats, error=e)
+                    else:
+                        stats["run_ms"] = round((time.perf_counter() - started_at) * 1000, 3)
+                        self._finish(request, stats, result)
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    self.counters[outcome] += 1
+                    self.total_wait_ms += stats["queue_wait_ms"]
+
+    def shutdown(self):
+        """Stop the threads and fail the requests still queued"""
+        with self._condition:
+            self._stopped = True
+            queued = [request for _, _, request in self._queue]
+            self._queue.clear()
+            self._queued.clear()
+            self._condition.notify_all()
+        for request in queued:
+            self._finish(request, {}, error=InferenceCancelled("Inference scheduler stopped"))
+
+    def stats(self):
+        with self._condition:
+            started = sum(self.counters[k] for k in ("completed", "failed", "timed_out", "cancelled"))
+            return {
+                "queued": len(self._queue),
+                "running": self._running,
+                "max_depth": self.max_depth,
+                "concurrency": self.concurrency,
+                **self.counters,
+                "average_wait_ms": round(self.total_wait_ms / started, 3) if started else 0.0
+            }
@@ -0,0 +1,225 @@
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+
+from inference_scheduler import InferenceScheduler, PRIORITY_CHAT, PRIORITY_PARSE, add_inference_stats
+
+# Address of the inference service, a socket path or "host:port". When it is
+# set the server workers send their LLM requests there instead of loading
+# the model themselves, so only one copy of the model is kept in memory.
+INFERENCE_SOCKET = os.environ.get("SAPCAD_INFERENCE_SOCKET", "")
+
+# Seconds a server worker waits for the inference service
+INFERENCE_TIMEOUT = float(os.environ.get("SAPCAD_INFERENCE_TIMEOUT", "300"))
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "sapcad-inference.sock")
+
+
+def _tcp_address(address: str):
+    """(host, port) of a "host:port" address, or None for a socket path"""
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port)) if host and port.isdigit() else None
+
+
+# Service side
+
+class _InferenceHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one request per connection.
+
+    The request is a JSON line {"method": ..., "args": [...]}. The reply is
+    a JSON line {"result": ...} or {"error": ...}; streamed chat replies send
+    {"delta": ...} lines first. A client cancels a stream by closing the
+    connection.
+    """
+
+    def _send(self, message: dict):
+        try:
+            self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+            self.wfile.flush()
+            return True
+        except OSError:
+            return False
+
+    def _watch_disconnect(self, cancel_event: threading.Event):
+        try:
+            self.rfile.read(1)
+        except OSError:
+            pass
+        cancel_event.set()
+
+    def handle(self):
+        import ai_chatbot
+
+        try:
+            request = json.loads(self.rfile.readline())
+            method = request.get("method")
+            args = request.get("args", [])
+        except ValueError:
+            self._send({"error": "Invalid request"})
+            return
+
+        scheduler = self.server.scheduler
+        # A client that gives up closes the connection, which drops its queued request
+        cancel_event = threading.Event()
+        threading.Thread(target=self._watch_disconnect, args=(cancel_event,), daemon=True).start()
+
+        try:
+            if method == "stream_chat":
+                stats = {}
+
+                def pump():
+                    stream = ai_chatbot.stream_chat_with_ai(*args, cancel_event=cancel_event, stats=stats)
+                    try:
+                        for delta in stream:
+                            if not self._send({"delta": delta}):
+                                break
+                    finally:
+                        stream.close()
+
+                future = scheduler.submit(pump, priority=PRIORITY_CHAT, cancel_event=cancel_event)
+                future.result()
+                self._send({"result": {**future.inference_stats, **stats}})
+            elif method == "chat":
+                future = scheduler.submit(ai_chatbot.chat_with_ai, *args, priority=PRIORITY_CHAT,
+                                          cancel_event=cancel_event)
+                self._send({"result": future.result()})
+            elif method == "parse_modification_request":
+                future = scheduler.submit(ai_chatbot.parse_modification_request, *args, priority=PRIORITY_PARSE,
+                                          cancel_event=cancel_event, coalesce=True)
+                self._send({"result": add_inference_stats(future.result(), future.inference_stats)})
+            elif method == "status":
+                # Not queued, answers while the model is busy or still loading
+                self._send({"result": ai_chatbot.get_model_status()})
+            elif method == "stats":
+                self._send({"result": {**ai_chatbot.get_cache_stats(), "service_scheduler": scheduler.stats()}})
+            else:
+                self._send({"error": f"Unknown method: {method}"})
+        except Exception as e:
+            self._send({"error": str(e)})
+
+
+class _UnixInferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPInferenceServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(address: str = None):
+    """Load and warm up the model once and serve inference requests until interrupted"""
+    import ai_chatbot
+
+    address = address or INFERENCE_SOCKET or DEFAULT_SOCKET
+    if not os.path.exists(ai_chatbot.MODEL_PATH):
+        print(f"Warning: model not found at {ai_chatbot.MODEL_PATH}, requests will return errors")
+
+    tcp_address = _tcp_address(address)
+    if tcp_address:
+        server = _TCPInferenceServer(tcp_address, _InferenceHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixInferenceServer(address, _InferenceHandler)
+    # The model is not thread safe, requests are queued and use it one at a time
+    server.scheduler = InferenceScheduler(concurrency=1, name="sapcad-inference-service")
+    # Loaded while the service already answers status requests, ahead of anything queued
+    server.scheduler.submit(ai_chatbot.warm_up, priority=PRIORITY_PARSE)
+
+    print(f"SAPCAD inference service listening on {address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# Client side, with the signatures of the ai_chatbot functions
+
+def _connect():
+    tcp_address = _tcp_address(INFERENCE_SOCKET)
+    if tcp_address:
+        sock = socket.create_connection(tcp_address, timeout=INFERENCE_TIMEOUT)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(INFERENCE_TIMEOUT)
+        sock.connect(INFERENCE_SOCKET)
+    return sock
+
+
+def _request(sock, method: str, *args):
+    sock.sendall(json.dumps({"method": method, "args": list(args)}).encode("utf-8") + b"\n")
+    return sock.makefile("rb")
+
+
+def _call(method: str, *args):
+    with _connect() as sock:
+        reply = json.loads(_request(sock, method, *args).readline())
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
+
+
+def chat_with_ai(user_input: str, context: str = ""):
+    """chat_with_ai of the inference service"""
+    try:
+        return _call("chat", user_input, context)
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+
+def stream_chat_with_ai(user_input: str, context: str = "", cancel_event=None, stats: dict = None):
+    """stream_chat_with_ai of the inference service, closing the connection cancels it"""
+    try:
+        sock = _connect()
+    except OSError as e:
+        yield f"Error: {str(e)}"
+        return
+    try:
+        for line in _request(sock, "stream_chat", user_input, context):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            message = json.loads(line)
+            if "delta" in message:
+                yield message["delta"]
+            else:
+                if "error" in message:
+                    yield f"Error: {message['error']}"
+                elif stats is not None and message.get("result"):
+                    # Queue wait and tokens/s measured by the service
+                    stats.update(message["result"])
+                break
+    finally:
+        sock.close()
+
+
+def parse_modification_request(user_input: str, ifc_data: dict, context: dict = None, content_hash: str = None):
+    """parse_modification_request of the inference service"""
+    try:
+        return _call("parse_modification_request", user_input, ifc_data, context, content_hash)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def get_model_status():
+    """Load state of the model in the inference service"""
+    try:
+        return _call("status")
+    except Exception as e:
+        return {"status": "unreachable", "error": str(e)}
+
+
+def get_cache_stats():
+    """Cache statistics of the inference service"""
+    try:
+        return _call("stats")
+    except Exception as e:
+        return {"error": str(e)}
+
+
+if __name__ == "__main__":
+    serve()
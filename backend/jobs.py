@@ -0,0 +1,442 @@
+import asyncio
+import importlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from inference_scheduler import InferenceScheduler, InferenceTimeout, PRIORITY_CHAT, add_inference_stats
+from inference_service import INFERENCE_SOCKET
+from progress import report_to
+
+# Number of worker processes for CPU-bound IFC work (parsing, modification)
+IFC_WORKERS = int(os.environ.get("SAPCAD_IFC_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+
+# Number of finished jobs kept around for status/result lookups
+MAX_FINISHED_JOBS = int(os.environ.get("SAPCAD_MAX_FINISHED_JOBS", "500"))
+
+# Seconds the state of a job is kept in the shared store
+JOB_RETENTION_SECONDS = float(os.environ.get("SAPCAD_JOB_RETENTION_SECONDS", "86400"))
+
+# IFC work runs in worker processes so parsing does not hold the GIL of the server.
+# Each worker has its own model cache, so work on a file is always routed to the
+# same worker: its parsed model then lives in exactly one process.
+_ifc_executors = []
+_next_executor = 0
+
+# Progress events of the IFC workers come back on one queue as (call ID, event),
+# and are handed to the listener of the call by a thread of the server process
+_progress_queue = None
+_progress_listeners = {}
+
+# Model cache statistics of every IFC worker, as returned with its last call.
+# The cache only changes during calls, so the values are current without
+# asking the workers, which may be busy for minutes with a large model.
+_worker_cache_stats = {}
+
+# LLM requests go through a priority queue. A model in this process is used
+# by one thread at a time; calls to the inference service can overlap, it
+# schedules them itself.
+INFERENCE_CLIENT_CONCURRENCY = int(os.environ.get("SAPCAD_INFERENCE_CLIENT_CONCURRENCY", "8"))
+inference_scheduler = InferenceScheduler(concurrency=INFERENCE_CLIENT_CONCURRENCY if INFERENCE_SOCKET else 1)
+
+
+class IfcTask:
+    """
+    A module level function referenced by its module and name. It is
+    pickled as the two names, so the module is only imported by the worker
+    process that runs it and the server process never loads the IFC engine.
+    """
+
+    def __init__(self, module: str, name: str):
+        self.module = module
+        self.name = name
+
+    def __call__(self, *args):
+        return getattr(importlib.import_module(self.module), self.name)(*args)
+
+
+def _init_ifc_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _traced_call(call_id, func, *args):
+    """
+    Run a function in an IFC worker, returning its result with the spans it
+    recorded and the statistics of the model cache of the worker. With a
+    call ID its progress is sent back to the server.
+    """
+    with metrics.collect_trace(remote=True) as trace:
+        if call_id is None or _progress_queue is None:
+            result = func(*args)
+        else:
+            with report_to(lambda event: _progress_queue.put((call_id, event))):
+                result = func(*args)
+    # A worker that never imported the model cache has nothing cached
+    cache = sys.modules.get("model_cache")
+    return result, trace.spans, trace.samples, cache.cache_stats() if cache else None
+
+
+def _forward_progress(progress_queue):
+    """Hand the progress events of the workers to the event loop of their listener"""
+    while True:
+        item = progress_queue.get()
+        if item is None:
+            break
+        call_id, event = item
+        listener = _progress_listeners.get(call_id)
+        if listener is None:
+            continue
+        loop, events = listener
+        try:
+            loop.call_soon_threadsafe(events.put_nowait, event)
+        except RuntimeError:
+            # The event loop is closed
+            pass
+
+
+def get_ifc_executors():
+    """Create the IFC worker processes on first use"""
+    global _progress_queue
+    if not _ifc_executors:
+        _progress_queue = multiprocessing.Queue()
+        threading.Thread(target=_forward_progress, args=(_progress_queue,), daemon=True).start()
+        for _ in range(IFC_WORKERS):
+            _ifc_executors.append(ProcessPoolExecutor(
+                max_workers=1, initializer=_init_ifc_worker, initargs=(_progress_queue,)
+            ))
+    return _ifc_executors
+
+
+def _pick_executor(key: str = None):
+    """Route work on the same key to the same worker, other work round-robin"""
+    global _next_executor
+    executors = get_ifc_executors()
+    if key:
+        return executors[zlib.crc32(key.encode("utf-8")) % len(executors)]
+    _next_executor = (_next_executor + 1) % len(executors)
+    return executors[_next_executor]
+
+
+async def _deliver_progress(events: asyncio.Queue, listener):
+    while (event := await events.get()) is not None:
+        try:
+            await listener(event)
+        except Exception as e:
+            print(f"Error delivering progress: {e}")
+
+
+async def run_ifc(func, *args, key: str = None, progress=None):
+    """
+    Run a blocking IFC function in a worker process. The stages it timed
+    are recorded in the metrics of this process.
+
+    Args:
+        func: Module level function to run
+        key: Routing key, work with the same key runs in the same worker
+        progress: Optional async callable receiving the progress events the
+            function reports (see progress.report), in order
+    """
+    loop = asyncio.get_running_loop()
+    executor = _pick_executor(key)
+    if progress is None:
+        result, spans, samples, cache_stats = await loop.run_in_executor(executor, _traced_call, None, func, *args)
+    else:
+        call_id = uuid.uuid4().hex
+        events = asyncio.Queue()
+        _progress_listeners[call_id] = (loop, events)
+        delivery = asyncio.create_task(_deliver_progress(events, progress))
+        try:
+            result, spans, samples, cache_stats = await loop.run_in_executor(executor, _traced_call, call_id, func, *args)
+        finally:
+            _progress_listeners.pop(call_id, None)
+            events.put_nowait(None)
+            await delivery
+    metrics.record_remote(spans, samples)
+    if cache_stats is not None:
+        _worker_cache_stats[executor] = cache_stats
+    return result
+
+
+def ifc_worker_cache_stats():
+    """Last known model cache statistics of the IFC workers that have run work"""
+    return [_worker_cache_stats[e] for e in _ifc_executors if e in _worker_cache_stats]
+
+
+async def run_on_all_ifc_workers(func, *args):
+    """Run a function on every IFC worker, e.g. to collect cache statistics"""
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[
+        loop.run_in_executor(executor, func, *args) for executor in get_ifc_executors()
+    ])
+
+
+async def run_inference(func, *args, priority: int = PRIORITY_CHAT, timeout: float = None,
+                        cancel_event=None, coalesce: bool = False):
+    """
+    Run a blocking LLM call through the inference scheduler.
+
+    Args:
+        func: Function to call with args
+        priority: Priority class, see inference_scheduler
+        timeout: Seconds after which the request is dropped if it has not started
+        cancel_event: threading.Event that drops the request if set before it starts
+        coalesce: Share the result of an identical request that is still queued
+    """
+    future = inference_scheduler.submit(
+        func, *args, priority=priority, timeout=timeout, cancel_event=cancel_event, coalesce=coalesce
+    )
+    result = await asyncio.wrap_future(future)
+    return add_inference_stats(result, future.inference_stats)
+
+
+def shutdown_executors():
+    """Stop the worker pools, called when the server shuts down"""
+    for executor in _ifc_executors:
+        executor.shutdown(wait=False, cancel_futures=True)
+    _ifc_executors.clear()
+    _worker_cache_stats.clear()
+    if _progress_queue is not None:
+        # Stops the progress thread
+        _progress_queue.put(None)
+    inference_scheduler.shutdown()
+
+
+class Job:
+    """A long running operation whose status can be polled or streamed"""
+
+    def __init__(self, kind: str, file_id: str = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.file_id = file_id
+        self.status = "queued"
+        self.stage = None
+        # Part of the current stage done, when the stage reports it
+        self.stage_progress = None
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.listeners = []
+        self.task = None
+
+    @classmethod
+    def from_record(cls, record: dict, result=None):
+        """A job known from its stored record, e.g. one run by another server worker"""
+        job = cls(record["kind"], record.get("file_id"))
+        job.id = record["job_id"]
+        for key in ("status", "stage", "stage_progress", "progress", "error", "created_at", "started_at", "finished_at"):
+            setattr(job, key, record.get(key))
+        job.result = result
+        return job
+
+    @property
+    def finished(self):
+        return self.status in ("completed", "failed")
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "file_id": self.file_id,
+            "status": self.status,
+            "stage": self.stage,
+            "stage_progress": self.stage_progress,
+            "progress": round(self.progress, 3),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class JobManager:
+    """
+    Keeps track of submitted jobs.
+
+    A job is a coroutine factory taking the Job itself, so that the coroutine
+    can report its progress with update(). Listeners are async callables that
+    receive a progress event every time the job changes.
+    """
+
+    def __init__(self, max_finished: int = MAX_FINISHED_JOBS):
+        self.max_finished = max_finished
+        self.jobs = {}
+        # Shared store of job states (see FileRegistry.save_job), so that
+        # jobs can be looked up on any server worker
+        self.store = None
+
+    def submit(self, kind: str, job_func, file_id: str = None, listener=None):
+        """
+        Start a job in the background.
+
+        Args:
+            kind: Type of the job (e.g. 'upload', 'modify')
+            job_func: Coroutine function called with the Job
+            file_id: ID of the file the job works on, if any
+            listener: Optional async callable receiving progress events
+
+        Returns:
+            The submitted Job
+        """
+        job = Job(kind, file_id)
+        if listener:
+            job.listeners.append(listener)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, job_func))
+        return job
+
+    async def _run(self, job: Job, job_func):
+        job.status = "running"
+        job.started_at = time.time()
+        await self._notify(job)
+        try:
+            job.result = await job_func(job)
+            job.status = "completed"
+            job.progress = 1.0
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            await self._notify(job)
+            self._prune()
+
+    async def update(self, job: Job, stage: str, progress: float = None, stage_progress: float = None):
+        """Report the current stage of a job, and optionally the part of it done, to its listeners"""
+        job.stage = stage
+        job.stage_progress = stage_progress
+        if progress is not None:
+            job.progress = progress
+        await self._notify(job)
+
+    def subscribe(self, job_id: str, listener):
+        """Add a progress listener to a running job"""
+        job = self.jobs.get(job_id)
+        if job:
+            job.listeners.append(listener)
+        return job
+
+    def unsubscribe(self, listener):
+        """Remove a listener from all jobs, e.g. when a WebSocket disconnects"""
+        for job in self.jobs.values():
+            if listener in job.listeners:
+                job.listeners.remove(listener)
+
+    async def _notify(self, job: Job):
+        event = {"type": "job_progress", **job.to_dict()}
+        if self.store is not None:
+            try:
+                self.store.save_job(job.to_dict(), job.result if job.finished else None)
+            except Exception as e:
+                print(f"Error storing job {job.id}: {e}")
+        for listener in list(job.listeners):
+            try:
+                await listener(event)
+            except Exception:
+                # The listener went away (closed WebSocket), stop notifying it
+                job.listeners.remove(listener)
+
+    async def wait(self, job: Job):
+        """Wait for a job to finish and return it"""
+        await asyncio.shield(job.task)
+        return job
+
+    def get(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            stored = self.store.load_job(job_id)
+            if stored:
+                job = Job.from_record(*stored)
+        return job
+
+    def _prune(self):
+        """Forget the oldest finished jobs once there are too many"""
+        finished = [j for j in self.jobs.values() if j.finished]
+        if len(finished) > self.max_finished:
+            finished.sort(key=lambda j: j.finished_at)
+            for job in finished[:len(finished) - self.max_finished]:
+                del self.jobs[job.id]
+            if self.store is not None:
+                self.store.prune_jobs(JOB_RETENTION_SECONDS)
+
+
+job_manager = JobManager()
+
+
+class _StreamError:
+    """Exception raised by a streamed generator, handed over to the event loop"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_STREAM_END = object()
+
+
+async def stream_inference(gen_func, *args, priority: int = PRIORITY_CHAT, timeout: float = None,
+                           cancel_event=None, stats: dict = None):
+    """
+    Run a blocking generator through the inference scheduler and yield its items.
+
+    The generator runs on an inference thread and hands every item to the
+    event loop as soon as it is produced. To stop it early, pass a cancel
+    event to the generator and set it; leaving this loop does not stop it.
+    The same event drops the request while it is still queued.
+
+    Args:
+        stats: Dictionary receiving the queue wait and run time of the request
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is closed, nobody is listening anymore
+            pass
+
+    deadline = time.perf_counter() + (timeout or inference_scheduler.timeout)
+
+    def produce():
+        generator = gen_func(*args)
+        try:
+            for item in generator:
+                put(item)
+                # Running streams stop at the deadline too
+                if time.perf_counter() > deadline:
+                    raise InferenceTimeout("Inference request timed out")
+        except Exception as e:
+            put(_StreamError(e))
+        finally:
+            generator.close()
+            put(_STREAM_END)
+
+    def dropped(f):
+        # A request dropped before it started never produces the end marker.
+        # A cancelled future has no exception to hand over, nobody waits for it.
+        if not f.cancelled() and f.exception():
+            put(_StreamError(f.exception()))
+
+    future = inference_scheduler.submit(produce, priority=priority, timeout=timeout, cancel_event=cancel_event)
+    future.add_done_callback(dropped)
+    while True:
+        item = await queue.get()
+        if item is _STREAM_END:
+            break
+        if isinstance(item, _StreamError):
+            raise item.error
+        yield item
+    await asyncio.wrap_future(future)
+    if stats is not None:
+        for key, value in future.inference_stats.items():
+            stats.setdefault(key, value)
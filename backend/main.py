@@ -1,18 +1,71 @@
-from fastapi import FastAPI, UploadFile, WebSocket, WebSocketDisconnect, File, Form, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, WebSocket, WebSocketDisconnect, File, Form, HTTPException, Request
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import MutableHeaders
 from fastapi.staticfiles import StaticFiles
 import uvicorn
-from ifc_handler import process_ifc_file, modify_ifc_entities, get_entity_summary
-from ai_chatbot import chat_with_ai, parse_modification_request
-import shutil
+from inference_service import INFERENCE_SOCKET
+if INFERENCE_SOCKET:
+    # One shared inference process instead of a model copy in every server worker
+    from inference_service import chat_with_ai, stream_chat_with_ai, parse_modification_request
+    from inference_service import get_cache_stats as get_llm_cache_stats, get_model_status
+else:
+    from ai_chatbot import chat_with_ai, stream_chat_with_ai, parse_modification_request, warm_up
+    from ai_chatbot import get_cache_stats as get_llm_cache_stats, get_model_status
+from fast_parser import fast_parser
+from ifc_constants import ENTITY_TYPES, BASE_FIELDS, MODIFIABLE_PROPERTIES
+from jobs import (job_manager, run_ifc, run_inference, run_on_all_ifc_workers, shutdown_executors, stream_inference,
+                  ifc_worker_cache_stats, inference_scheduler, IfcTask)
+from inference_scheduler import PRIORITY_CHAT, PRIORITY_PARSE
+from storage import CHUNK_SIZE, ContentStore, UploadSessions
+from registry import FileRegistry
+from tessellation import MeshCache, read_mesh_header
+from downloads import (CONTENT_CACHE_CONTROL, ContentResponse, EncodedCache, RangeNotSatisfiable, content_disposition,
+                       entity_tag, negotiate_encoding, not_modified, parse_range)
+from version_store import GC_INTERVAL_SECONDS, VersionStore, VersionUnavailable
+from ws_protocol import MessageChannel
+import metrics
+from metrics import collect_trace, record_llm, span
 import os
 import json
+import time
 import asyncio
+import threading
+from contextlib import nullcontext
 from typing import List
 from datetime import datetime
 import uuid
 
+# IFC functions run in the worker processes, which import the IFC engine;
+# the server process itself starts without it
+process_ifc_file = IfcTask("ifc_handler", "process_ifc_file")
+modify_and_process_ifc_file = IfcTask("ifc_handler", "modify_and_process_ifc_file")
+modify_ifc_batch = IfcTask("ifc_handler", "modify_ifc_batch")
+get_entity_summary = IfcTask("ifc_handler", "get_entity_summary")
+list_ifc_entities = IfcTask("ifc_handler", "list_ifc_entities")
+list_entity_rows = IfcTask("ifc_handler", "list_entity_rows")
+get_ifc_entity = IfcTask("ifc_handler", "get_ifc_entity")
+query_entities = IfcTask("ifc_handler", "query_entities")
+build_modification_context = IfcTask("ifc_handler", "build_modification_context")
+load_ifc_engine = IfcTask("ifc_handler", "load_engine")
+tessellate_ifc_file = IfcTask("tessellation", "tessellate_ifc_file")
+open_session = IfcTask("edit_session", "open_session")
+apply_session_edit = IfcTask("edit_session", "apply_session_edit")
+build_session_context = IfcTask("edit_session", "build_session_context")
+flush_session = IfcTask("edit_session", "flush_session")
+close_session = IfcTask("edit_session", "close_session")
+
+# Entities of a query listed in the chat context
+CHAT_QUERY_LIMIT = int(os.environ.get("SAPCAD_CHAT_QUERY_LIMIT", "20"))
+
+# Stages the IFC workers report for a modification, in the order they run (see _job_progress)
+MODIFY_STAGES = ("parsing", "selecting", "applying edit", "re-indexing", "writing file", "extracting metadata")
+BATCH_STAGES = ("parsing", "applying edits", "writing file", "extracting metadata")
+SESSION_EDIT_STAGES = ("selecting", "applying edit", "re-indexing")
+
+# Load the LLM at startup and run a dummy completion, so the first chat is fast
+WARM_UP = os.environ.get("SAPCAD_WARM_UP", "1") != "0"
+
 app = FastAPI()
 
 # Add CORS middleware
@@ -24,13 +77,119 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Metrics of the requests served by this process, see /metrics
+HTTP_REQUEST_MS = metrics.registry.histogram(
+    "sapcad_http_request_duration_ms", "Duration of HTTP requests in milliseconds", ["method", "route", "status"]
+)
+WEBSOCKET_SESSIONS = metrics.registry.gauge("sapcad_websocket_sessions", "Connected WebSocket clients")
+JOBS_RUNNING = metrics.registry.gauge("sapcad_jobs_running", "Jobs queued or running in this worker")
+INFERENCE_QUEUE = metrics.registry.gauge(
+    "sapcad_inference_queue", "LLM requests of this worker waiting or running", ["state"]
+)
+INFERENCE_REQUESTS = metrics.registry.counter(
+    "sapcad_inference_scheduler_requests_total", "LLM requests by how they left the queue", ["outcome"]
+)
+CACHE_LOOKUPS = metrics.registry.counter("sapcad_cache_lookups_total", "Cache lookups", ["cache", "result"])
+CACHE_HIT_RATIO = metrics.registry.gauge("sapcad_cache_hit_ratio", "Share of cache lookups that hit", ["cache"])
+CACHE_SIZE_MB = metrics.registry.gauge("sapcad_cache_size_mb", "Memory used by a cache", ["cache"])
+
+def _profile(enabled: bool):
+    """Trace of the stages of a profiled request, or nothing"""
+    return collect_trace() if enabled else nullcontext()
+
+class RecordRequests:
+    """
+    Time every request. With ?profile=1 (or the X-SAPCAD-Profile: 1 header)
+    the stages of the request are returned in a Server-Timing header, and
+    JSON object responses get them in a "profile" field.
+
+    A plain ASGI middleware, so file responses can still use the zero-copy
+    extensions of the server.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request = Request(scope)
+        profile = request.query_params.get("profile") in ("1", "true") or request.headers.get("x-sapcad-profile") == "1"
+        start = time.perf_counter()
+        state = {"status": 500, "start": None, "body": []}
+
+        with _profile(profile) as trace:
+            async def send_message(message):
+                if message["type"] == "http.response.start":
+                    state["status"] = message["status"]
+                    if trace is not None:
+                        headers = MutableHeaders(scope=message)
+                        headers["Server-Timing"] = trace.server_timing()
+                        # JSON bodies are held back to add the profile
+                        if headers.get("content-type", "").startswith("application/json"):
+                            state["start"] = message
+                            return
+                elif message["type"] == "http.response.body" and state["start"] is not None:
+                    state["body"].append(message.get("body", b""))
+                    if message.get("more_body"):
+                        return
+                    body = b"".join(state["body"])
+                    content = json.loads(body)
+                    if isinstance(content, dict):
+                        content["profile"] = trace.to_dict()
+                        body = json.dumps(content).encode("utf-8")
+                    headers = MutableHeaders(scope=state["start"])
+                    headers["content-length"] = str(len(body))
+                    await send(state["start"])
+                    message = {"type": "http.response.body", "body": body, "more_body": False}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_message)
+            finally:
+                HTTP_REQUEST_MS.observe(
+                    (time.perf_counter() - start) * 1000, method=request.method,
+                    route=getattr(scope.get("route"), "path", "unmatched"), status=str(state["status"])
+                )
+
+app.add_middleware(RecordRequests)
+
 # Create upload directory if it doesn't exist
 UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
-# Dictionary to store information about uploaded files
-uploaded_files = {}
+# Content-addressed storage of uploaded files and resumable uploads in progress
+content_store = ContentStore(UPLOAD_DIR)
+upload_sessions = UploadSessions(content_store)
+
+# Registry of uploaded and modified files, kept across restarts
+REGISTRY_PATH = os.environ.get("SAPCAD_REGISTRY_PATH", os.path.join(UPLOAD_DIR, "registry.sqlite3"))
+uploaded_files = FileRegistry(REGISTRY_PATH)
+
+# Modified versions, packed into the version store once unused and
+# materialized again on demand
+version_store = VersionStore(
+    uploaded_files, os.path.join(UPLOAD_DIR, "versions"), run_ifc, lambda file_id: _lineage_root(file_id)
+)
+
+# Jobs are visible to every server worker through the registry
+job_manager.store = uploaded_files
+
+# Uploads still being processed by this worker, by content hash
+pending_uploads = {}
+
+# Tessellated meshes by content hash, and tessellations in progress
+mesh_cache = MeshCache(os.path.join(UPLOAD_DIR, "meshes"))
+pending_meshes = {}
+
+# Compressed copies of downloaded files by content hash
+encoded_cache = EncodedCache(os.path.join(UPLOAD_DIR, "encoded"))
+
+# Editing sessions by session ID, and the delay after the last edit before a session is written
+edit_sessions = {}
+SESSION_FLUSH_DELAY = float(os.environ.get("SAPCAD_SESSION_FLUSH_SECONDS", "5"))
 
 # Dictionary to store active WebSocket connections
 connected_clients = {}
@@ -44,51 +203,242 @@ async def read_root():
         """
     )
 
-@app.post("/upload/")
-async def upload_file(file: UploadFile = File(...)):
+def _lineage_root(file_id: str):
     """
-    Endpoint to upload an IFC file.
-    The file will be saved in the uploads directory.
+    ID of the original upload a file derives from.
+    IFC work on a whole lineage is routed to the same worker process,
+    where the models of the chain stay in that worker's model cache.
     """
+    seen = set()
+    while file_id in uploaded_files and file_id not in seen:
+        seen.add(file_id)
+        parent_id = uploaded_files[file_id].get("parent_file_id")
+        if not parent_id:
+            break
+        file_id = parent_id
+    return file_id
+
+async def _file_path(file_id: str):
+    """Path of the content of a file, materialized first if its version was packed"""
     try:
-        # Generate unique filename to prevent overwrites
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        unique_id = uuid.uuid4().hex[:8]
-        original_filename = file.filename
-        safe_filename = f"{timestamp}_{unique_id}_{original_filename}"
-
-        # Save the uploaded file
-        file_path = os.path.join(UPLOAD_DIR, safe_filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # Process the IFC file to extract metadata
-        metadata = process_ifc_file(file_path)
-
-        # Store reference to the uploaded file
-        file_info = {
-            "original_filename": original_filename,
-            "stored_filename": safe_filename,
-            "file_path": file_path,
-            "upload_time": timestamp,
-            "metadata": metadata
-        }
+        return await version_store.ensure(file_id)
+    except VersionUnavailable as e:
+        raise HTTPException(status_code=410, detail=str(e))
+
+def _job_progress(job, start: float, end: float, stages: tuple):
+    """
+    Progress listener of an IFC call (see run_ifc) reporting the stages the
+    worker goes through as stages of a job. The call covers the job progress
+    from start to end, divided evenly among the given stages; other stages
+    the call reports are not shown.
+    """
+    async def update(event):
+        if event["stage"] not in stages:
+            return
+        position = stages.index(event["stage"]) + (event.get("progress") or 0.0)
+        progress = max(job.progress, start + (end - start) * position / len(stages))
+        await job_manager.update(job, event["stage"], progress, event.get("progress"))
+    return update
+
+def _operation_progress(channel: MessageChannel, operation: str, **fields):
+    """Progress listener of an IFC call sending its stages to a WebSocket client"""
+    async def send(event):
+        await channel.send({"type": "progress", "operation": operation, **fields, **event})
+    return send
 
-        file_id = unique_id
-        uploaded_files[file_id] = file_info
+async def _process_upload_job(job, file_id: str, file_info: dict):
+    """Extract the metadata of an uploaded file and register it"""
+    await job_manager.update(job, "extracting metadata", 0.1)
+    # Only counts and project info, entities are listed with /files/{file_id}/entities
+    metadata = await run_ifc(
+        process_ifc_file, file_info["file_path"], file_id, False, key=file_id,
+        progress=_job_progress(job, 0.1, 0.7, ("parsing", "extracting metadata"))
+    )
+
+    file_info["metadata"] = metadata
+    uploaded_files[file_id] = file_info
+    if "error" not in metadata:
+        uploaded_files.register_content(file_info["content_hash"], file_id)
+
+        # Base fields of the entities, so they can be listed without the model
+        await job_manager.update(job, "indexing entities", 0.7)
+        rows = await run_ifc(
+            list_entity_rows, file_info["file_path"], file_id, key=file_id,
+            progress=_job_progress(job, 0.7, 0.95, ("indexing entities",))
+        )
+        if isinstance(rows, list):
+            uploaded_files.put_entities(file_id, rows)
 
-        # Return success response with file ID and metadata
+    return {
+        "status": "success",
+        "message": "File uploaded successfully",
+        "file_id": file_id,
+        "filename": file_info["original_filename"],
+        "metadata": metadata
+    }
+
+async def _store_upload(original_filename: str, content_hash: str, temp_path: str, background: bool):
+    """
+    Register a received upload by its content hash.
+    Content that was already uploaded reuses the stored file and its extracted metadata.
+    """
+    original_filename = os.path.basename(original_filename or "model.ifc")
+
+    # Identical content currently being processed: wait for that upload instead
+    pending_job = pending_uploads.get(content_hash)
+    if pending_job and not background:
+        await job_manager.wait(pending_job)
+        pending_job = None
+
+    existing_id = uploaded_files.find_content(content_hash)
+    if existing_id in uploaded_files:
+        content_store.discard(temp_path)
+        file_info = uploaded_files[existing_id]
         return JSONResponse({
             "status": "success",
-            "message": "File uploaded successfully",
-            "file_id": file_id,
+            "message": "File already uploaded, reusing stored file",
+            "file_id": existing_id,
+            "filename": file_info["original_filename"],
+            "metadata": file_info["metadata"],
+            "deduplicated": True
+        })
+    if pending_job:
+        content_store.discard(temp_path)
+        return JSONResponse(status_code=202, content={
+            "status": "accepted",
+            "job_id": pending_job.id,
+            "file_id": pending_job.file_id,
             "filename": original_filename,
-            "metadata": metadata
+            "deduplicated": True
         })
 
+    # Move the file to its content address
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    file_id = uuid.uuid4().hex[:8]
+    file_path = content_store.commit(temp_path, content_hash, original_filename)
+
+    # Reference to the uploaded file, registered once the metadata is extracted
+    file_info = {
+        "original_filename": original_filename,
+        "stored_filename": os.path.relpath(file_path, UPLOAD_DIR),
+        "file_path": file_path,
+        "upload_time": timestamp,
+        "content_hash": content_hash
+    }
+
+    # Process the IFC file to extract metadata
+    job = job_manager.submit(
+        "upload", lambda job: _process_upload_job(job, file_id, file_info), file_id
+    )
+    pending_uploads[content_hash] = job
+    job.task.add_done_callback(lambda _: pending_uploads.pop(content_hash, None))
+
+    if background:
+        return JSONResponse(status_code=202, content={
+            "status": "accepted",
+            "job_id": job.id,
+            "file_id": file_id,
+            "filename": original_filename
+        })
+
+    await job_manager.wait(job)
+    if job.status == "failed":
+        raise Exception(job.error)
+
+    # Return success response with file ID and metadata
+    return JSONResponse(job.result)
+
+async def _iter_upload(file: UploadFile):
+    """Read an uploaded file in chunks"""
+    while True:
+        chunk = await file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+@app.post("/upload/")
+async def upload_file(file: UploadFile = File(...), background: bool = False):
+    """
+    Endpoint to upload an IFC file.
+    The file is hashed while it is written to the uploads directory, and
+    content that was uploaded before is not stored or processed again.
+    With background=true the metadata is extracted in a job and the job ID is returned.
+    """
+    try:
+        content_hash, size, temp_path = await content_store.write_stream(_iter_upload(file))
+        return await _store_upload(file.filename, content_hash, temp_path, background)
+
     except Exception as e:
         return HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
+@app.post("/uploads/")
+async def create_chunked_upload(filename: str = Form(...), size: int = Form(None)):
+    """
+    Start a resumable upload for large files.
+    Chunks are then sent in order with PUT /uploads/{upload_id}?offset=N.
+    """
+    session = upload_sessions.create(os.path.basename(filename), size)
+    return session.to_dict()
+
+@app.get("/uploads/{upload_id}")
+async def get_chunked_upload(upload_id: str):
+    """Get the number of bytes received so far, to resume an interrupted upload"""
+    session = upload_sessions.get(upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session.to_dict()
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, offset: int = 0):
+    """Append the request body to an upload, streaming it to disk"""
+    session = upload_sessions.get(upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+    async with session.lock:
+        if offset != session.offset:
+            return JSONResponse(status_code=409, content={
+                "error": "Offset does not match the received data",
+                **session.to_dict()
+            })
+        try:
+            await session.append(request.stream())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    return session.to_dict()
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_chunked_upload(upload_id: str, background: bool = False):
+    """Finish a resumable upload and process it like a regular upload"""
+    session = upload_sessions.get(upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+    async with session.lock:
+        if session.size is not None and session.offset != session.size:
+            return JSONResponse(status_code=409, content={
+                "error": "Upload is incomplete",
+                **session.to_dict()
+            })
+        content_hash, temp_path = await session.finish()
+        upload_sessions.remove(upload_id)
+
+    try:
+        return await _store_upload(session.filename, content_hash, temp_path, background)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+@app.delete("/uploads/{upload_id}")
+async def abort_chunked_upload(upload_id: str):
+    """Abort a resumable upload and delete the received data"""
+    session = upload_sessions.get(upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    session.abort()
+    upload_sessions.remove(upload_id)
+    return {"status": "aborted", "upload_id": upload_id}
+
 @app.get("/files/")
 async def list_files():
     """Get a list of all uploaded files"""
@@ -115,35 +465,376 @@ async def get_file_info(file_id: str):
         "metadata": file_info["metadata"]
     }
 
-@app.post("/modify/{file_id}")
-async def modify_file(file_id: str, instruction: str = Form(...)):
+@app.api_route("/files/{file_id}/content", methods=["GET", "HEAD"])
+async def get_file_content(file_id: str, request: Request, download: bool = False):
     """
-    Modify an IFC file based on a natural language instruction.
+    Get the IFC file of an upload or of a modified version.
+
+    The ETag is the content hash, and the content of a file ID never
+    changes: a client sending it back in If-None-Match gets a 304 without
+    the file being read. Single byte ranges are served with 206. Without a
+    Range header the file is compressed with zstd or gzip if the client
+    accepts it, compressed copies are kept for the next requests.
+    With download=true the file is sent as an attachment.
+    """
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+    file_info = uploaded_files[file_id]
+    content_hash = file_info.get("content_hash") or file_id
+    range_header = request.headers.get("range")
+    # Ranges are of the file itself
+    encoding = None if range_header else negotiate_encoding(request.headers.get("accept-encoding"))
+    headers = {
+        "ETag": entity_tag(content_hash, encoding),
+        "Cache-Control": CONTENT_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": content_disposition(file_info["original_filename"], download)
+    }
+    if not_modified(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    file_path = await _file_path(file_id)
+    media_type = "application/x-step"
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        encoded_path = encoded_cache.lookup(content_hash, encoding)
+        if encoded_path:
+            return ContentResponse(encoded_path, os.path.getsize(encoded_path), headers=headers, media_type=media_type)
+        if request.method == "HEAD":
+            # The compressed size is only known once it was compressed
+            response = Response(headers=headers, media_type=media_type)
+            del response.headers["content-length"]
+            return response
+        return StreamingResponse(
+            encoded_cache.encode(file_path, content_hash, encoding), headers=headers, media_type=media_type
+        )
+
+    size = os.path.getsize(file_path)
+    # If-Range: the range only applies to the version the client has part of
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range == headers["ETag"]):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            first, last = byte_range
+            headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+            return ContentResponse(
+                file_path, size, status_code=206, headers=headers, media_type=media_type,
+                offset=first, length=last - first + 1
+            )
+    return ContentResponse(file_path, size, headers=headers, media_type=media_type)
+
+@app.get("/files/{file_id}/entities")
+async def list_file_entities(file_id: str, types: str = None, cursor: str = None, limit: int = 100, fields: str = None):
+    """
+    List the entities of a file one page at a time.
+
+    Args:
+        types: Comma separated entity types to list (e.g. 'IfcWall,IfcDoor')
+        cursor: next_cursor of the previous page
+        limit: Page size (at most 1000)
+        fields: Comma separated fields to return, e.g. 'GlobalId,Name,Properties'.
+            Material, Color and Properties are only loaded when requested.
+    """
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    entity_types = [t.strip() for t in types.split(",") if t.strip()] if types else None
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    limit = max(1, min(limit, 1000))
+
+    # The base fields are served from the registry, without the parsed model
+    if all(f in BASE_FIELDS for f in field_list or BASE_FIELDS) and uploaded_files.has_entities(file_id):
+        entity_types = [t for t in (entity_types or ENTITY_TYPES) if t in ENTITY_TYPES]
+        cursor_type, cursor_id = None, None
+        if cursor:
+            cursor_type, _, cursor_id = cursor.partition(":")
+            if cursor_type not in entity_types or not cursor_id.isdigit():
+                raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+            cursor_id = int(cursor_id)
+        page, next_cursor = uploaded_files.list_entities(file_id, entity_types, cursor_type, cursor_id, limit)
+        if field_list:
+            page = [{k: v for k, v in e.items() if k in field_list or k in ("id", "type")} for e in page]
+        return {"file_id": file_id, "entities": page, "count": len(page), "next_cursor": next_cursor}
+
+    result = await run_ifc(
+        list_ifc_entities, await _file_path(file_id), file_id, entity_types, cursor, limit, field_list,
+        key=_lineage_root(file_id)
+    )
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+    return {"file_id": file_id, **result}
+
+@app.get("/files/{file_id}/entities/{entity_id}")
+async def get_file_entity(file_id: str, entity_id: int):
+    """Get all details of one entity, including its property sets and materials"""
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    result = await run_ifc(
+        get_ifc_entity, await _file_path(file_id), file_id, entity_id,
+        key=_lineage_root(file_id)
+    )
+    if "error" in result:
+        raise HTTPException(status_code=404, detail=result["error"])
+    return result
+
+@app.post("/files/{file_id}/query")
+async def query_file_entities(file_id: str, request: Request):
+    """
+    Find entities with a filter over type, attributes, property sets,
+    materials and storeys, answered from the entity index of the model.
+
+    The body is {"filter": "IfcDoor[storey=\"Level 2\"][Pset_DoorCommon.FireRating=EI30]",
+    "limit": 100, "cursor": ..., "fields": [...]}, see entity_index for the
+    filter syntax. Returns the number of matches, their counts by type,
+    storey and material, and one page of them.
+    """
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Body must be a JSON object")
+
+    selector = body.get("filter") or body.get("selector") or "*"
+    try:
+        limit = max(1, min(int(body.get("limit", 100)), 1000))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="limit must be an integer")
+    result = await run_ifc(
+        query_entities, await _file_path(file_id), file_id, selector, body.get("cursor"), limit,
+        body.get("fields"), key=_lineage_root(file_id)
+    )
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+    return {"file_id": file_id, **result}
+
+def _format_query(result: dict):
+    """Text of a query result for the chat context"""
+    lines = [f"Entity query {result['selector']}: {result['count']} matching entities"]
+    for group, counts in result["counts"].items():
+        if counts:
+            lines.append(f"By {group}: " + ", ".join(f"{k}: {v}" for k, v in sorted(counts.items())))
+    for entity in result["entities"]:
+        storey = f", {entity['Storey']}" if entity.get("Storey") else ""
+        lines.append(f"- #{entity['id']} {entity.get('Name')} ({entity['type']}{storey})")
+    if result["count"] > len(result["entities"]):
+        lines.append(f"  (and {result['count'] - len(result['entities'])} more)")
+    return "\n".join(lines)
+
+async def _chat_context(file_id: str, user_message: str):
+    """
+    Context of a chat reply: the summary of the file, and when the message
+    asks about entities the result of an entity query, so the answer is
+    grounded in the model instead of guessed from the summary.
+
+    Returns:
+        Tuple of the context and the query that was run, if any
+    """
+    if not file_id or file_id not in uploaded_files:
+        return "", None
+    with span("chat_context"):
+        return await _build_chat_context(file_id, user_message)
+
+async def _build_chat_context(file_id: str, user_message: str):
+    file_path = await _file_path(file_id)
+    key = _lineage_root(file_id)
+    context = await run_ifc(get_entity_summary, file_path, file_id, key=key)
+
+    selector = fast_parser.parse_query(user_message)
+    if not selector:
+        return context, None
+    result = await run_ifc(query_entities, file_path, file_id, selector, None, CHAT_QUERY_LIMIT, None, key=key)
+    if "error" in result:
+        return context, None
+    query = {"selector": selector, "count": result["count"], "counts": result["counts"]}
+    return f"{context}\n\n{_format_query(result)}", query
+
+async def _mesh_job(job, file_id: str, mesh_path: str):
+    """Tessellate a file into its cached mesh"""
+    file_info = uploaded_files[file_id]
+    await job_manager.update(job, "tessellating", 0.1)
+    stats = await run_ifc(
+        tessellate_ifc_file, await _file_path(file_id), mesh_path, file_id, file_info.get("content_hash"),
+        key=_lineage_root(file_id), progress=_job_progress(job, 0.1, 0.95, ("parsing", "tessellating"))
+    )
+    if "error" in stats:
+        raise Exception(stats["error"])
+    mesh_cache.record(stats)
+    return stats
+
+@app.get("/files/{file_id}/mesh")
+async def get_file_mesh(file_id: str, background: bool = False):
+    """
+    Get the triangulated geometry of a file for the viewer.
+
+    The mesh is a JSON header listing every element with its ranges,
+    followed by float32 positions and uint32 indices (see tessellation.write_mesh).
+    Meshes are cached by content hash. With background=true a missing mesh
+    is tessellated in a job and the job ID is returned.
+    """
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+    content_hash = uploaded_files[file_id].get("content_hash")
+
+    mesh_path = mesh_cache.lookup(content_hash)
+    if mesh_path:
+        return FileResponse(mesh_path, media_type="application/octet-stream", headers={"X-Mesh-Cache": "hit"})
+
+    # Tessellate once, also when several clients ask for the same content
+    job = pending_meshes.get(content_hash)
+    if job is None:
+        job = job_manager.submit(
+            "tessellate", lambda job: _mesh_job(job, file_id, mesh_cache.path(content_hash)), file_id
+        )
+        pending_meshes[content_hash] = job
+        job.task.add_done_callback(lambda _: pending_meshes.pop(content_hash, None))
+
+    if background:
+        return JSONResponse(status_code=202, content={"status": "accepted", "job_id": job.id})
+
+    await job_manager.wait(job)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return FileResponse(mesh_cache.path(content_hash), media_type="application/octet-stream", headers={
+        "X-Mesh-Cache": "miss",
+        "X-Tessellation-Ms": str(job.result["tessellation_ms"]),
+        "X-Triangle-Count": str(job.result["triangle_count"])
+    })
+
+@app.get("/files/{file_id}/mesh/info")
+async def get_file_mesh_info(file_id: str):
+    """Get the tessellation statistics and element ranges of a file's cached mesh"""
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+    mesh_path = mesh_cache.path(uploaded_files[file_id].get("content_hash"))
+    if not os.path.exists(mesh_path):
+        raise HTTPException(status_code=404, detail="Mesh not tessellated yet")
+    return read_mesh_header(mesh_path)
+
+@app.get("/mesh/stats")
+async def mesh_stats():
+    """Hits, misses, tessellation time and triangle counts of the mesh cache"""
+    return mesh_cache.stats()
+
+def _pinned_versions():
+    """Files of the open editing sessions, kept by the retention policy"""
+    pinned = set()
+    for session in edit_sessions.values():
+        pinned.update((session["file_id"], session["base_file_id"]))
+    return pinned
+
+@app.get("/files/{file_id}/storage")
+async def get_file_storage(file_id: str):
+    """
+    Storage used by the lineage of a file: every version derived from the
+    same upload with its storage state (plain, delta, full or pruned) and
+    the bytes on disk against the size of all versions as plain files.
     """
     if file_id not in uploaded_files:
         raise HTTPException(status_code=404, detail="File not found")
+    reports = version_store.report(_lineage_root(file_id))
+    return reports[0]
 
+@app.get("/storage")
+async def storage_stats():
+    """Storage used per lineage chain, and the counters and policy of the version store"""
+    lineages = version_store.report()
+    for lineage in lineages:
+        lineage.pop("versions")
+    totals = {
+        key: sum(lineage[key] for lineage in lineages)
+        for key in ("logical_bytes", "stored_bytes", "plain_bytes", "packed_bytes", "materialized_bytes")
+    }
+    return {"lineages": lineages, "totals": totals, "version_store": version_store.stats()}
+
+@app.post("/storage/gc")
+async def collect_versions():
+    """Run a garbage collection pass of the version store now"""
+    return await version_store.collect(_pinned_versions())
+
+async def _parse_instruction(file_id: str, instruction: str, session: dict = None, cancel_event=None):
+    """
+    Turn a natural language instruction into modification data.
+    Common commands are resolved by the fast-path rules, everything else
+    goes to the LLM with the parts of the file relevant to the instruction.
+    Within an editing session the context comes from the edited model.
+    Parsing is queued ahead of chat replies; cancel_event drops it while queued.
+    """
+    file_info = uploaded_files[file_id]
+    metadata = session["metadata"] if session else file_info.get("metadata", {})
+
+    modification_data = fast_parser.parse(instruction, metadata)
+    if modification_data:
+        return modification_data
+
+    # Pick the parts of the file relevant to the instruction for the prompt
+    if session:
+        context = await run_ifc(
+            build_session_context, session["session_id"], instruction, key=session["key"]
+        )
+        # Unsaved edits change the content, so parses are cached per session version
+        content_hash = f"{file_info.get('content_hash')}:{session['session_id']}:{session['version']}"
+    else:
+        context = await run_ifc(
+            build_modification_context, await _file_path(file_id), file_id, instruction, key=_lineage_root(file_id)
+        )
+        content_hash = file_info.get("content_hash")
+    try:
+        result = await run_inference(
+            parse_modification_request, instruction, metadata, context, content_hash,
+            priority=PRIORITY_PARSE, cancel_event=cancel_event, coalesce=True
+        )
+    except Exception as e:
+        record_llm("parse", None, type(e).__name__)
+        raise
+    prompt_stats = result.get("prompt_stats", {})
+    if "error" in result:
+        outcome = "error"
+    elif prompt_stats.get("result_cache") == "hit":
+        outcome = "cached"
+    else:
+        outcome = "completed"
+    record_llm("parse", prompt_stats, outcome)
+    return result
+
+def _renames(delta: dict):
+    """Entity id -> new name of the elements renamed by a modification"""
+    return {e["id"]: e["Name"] for e in delta.get("elements", {}).values() if "Name" in e}
+
+async def _modify_job(job, file_id: str, instruction: str):
+    """
+    Parse a natural language instruction and apply it to a file.
+    The modified file is registered under a new file ID.
+    """
     file_info = uploaded_files[file_id]
-    file_path = file_info["file_path"]
+    file_path = await _file_path(file_id)
 
-    # Parse the modification request using AI
-    metadata = file_info.get("metadata", {})
-    modification_data = parse_modification_request(instruction, metadata)
+    # Parse the modification request, with the AI only if the rules can't
+    await job_manager.update(job, "parsing instruction", 0.1)
+    modification_data = await _parse_instruction(file_id, instruction)
 
-    # Modify the IFC file
-    result = modify_ifc_entities(file_path, modification_data)
+    # Generate a new ID for the modified file
+    new_file_id = uuid.uuid4().hex[:8]
+
+    # Modify the IFC file and extract the metadata of the result
+    await job_manager.update(job, "applying modification", 0.4)
+    result, new_metadata = await run_ifc(
+        modify_and_process_ifc_file, file_path, modification_data, file_id, new_file_id,
+        key=_lineage_root(file_id), progress=_job_progress(job, 0.4, 0.95, MODIFY_STAGES)
+    )
 
     # Update reference if modification was successful
     if "error" not in result and "modified_file" in result:
         # Update the file path reference
         new_file_path = result["modified_file"]
-
-        # Generate a new ID for the modified file
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        new_file_id = uuid.uuid4().hex[:8]
-
-        # Process the new file to update metadata
-        new_metadata = process_ifc_file(new_file_path)
 
         # Store reference to the modified file
         new_file_info = {
@@ -152,177 +843,836 @@ async def modify_file(file_id: str, instruction: str = Form(...)):
             "file_path": new_file_path,
             "upload_time": timestamp,
             "metadata": new_metadata,
-            "parent_file_id": file_id
+            "parent_file_id": file_id,
+            "content_hash": result.get("content_hash")
         }
 
         uploaded_files[new_file_id] = new_file_info
+        if result.get("content_hash"):
+            uploaded_files.register_content(result["content_hash"], new_file_id, replace=False)
         result["new_file_id"] = new_file_id
+        result["delta"]["parent_file_id"] = file_id
+        uploaded_files.derive_entities(new_file_id, file_id, _renames(result["delta"]))
 
+    if "prompt_stats" in modification_data:
+        result["prompt_stats"] = modification_data["prompt_stats"]
     return result
 
+@app.post("/modify/{file_id}")
+async def modify_file(file_id: str, instruction: str = Form(...), background: bool = Form(False)):
+    """
+    Modify an IFC file based on a natural language instruction.
+    With background=true the modification runs as a job and the job ID is returned.
+    """
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    job = job_manager.submit("modify", lambda job: _modify_job(job, file_id, instruction), file_id)
+    if background:
+        return JSONResponse(status_code=202, content={"status": "accepted", "job_id": job.id})
+
+    await job_manager.wait(job)
+    if job.status == "failed":
+        return {"error": job.error}
+    return job.result
+
+async def _batch_job(job, file_id: str, operations: list):
+    """
+    Apply a list of modifications to a file in one open/write cycle.
+    Structured operations are applied as given, operations with an
+    "instruction" are parsed first. The result is registered as one new file.
+    """
+    file_info = uploaded_files[file_id]
+
+    await job_manager.update(job, "parsing instructions", 0.1)
+    modifications = []
+    parse_stats = {}
+    for index, operation in enumerate(operations):
+        if "instruction" in operation:
+            start = time.perf_counter()
+            modification_data = await _parse_instruction(file_id, operation["instruction"])
+            parse_stats[index] = {
+                "parse_ms": round((time.perf_counter() - start) * 1000, 3),
+                **({"prompt_stats": modification_data.pop("prompt_stats")} if "prompt_stats" in modification_data else {})
+            }
+            modifications.append(modification_data)
+        else:
+            modifications.append(operation)
+
+    new_file_id = uuid.uuid4().hex[:8]
+    await job_manager.update(job, "applying modifications", 0.4)
+    result, new_metadata = await run_ifc(
+        modify_ifc_batch, await _file_path(file_id), modifications, file_id, new_file_id, key=_lineage_root(file_id),
+        progress=_job_progress(job, 0.4, 0.95, BATCH_STAGES)
+    )
+    for operation_result in result.get("operations", []):
+        operation_result.update(parse_stats.get(operation_result["index"], {}))
+
+    if "error" not in result and "modified_file" in result:
+        new_file_path = result["modified_file"]
+        uploaded_files[new_file_id] = {
+            "original_filename": f"modified_{file_info['original_filename']}",
+            "stored_filename": os.path.basename(new_file_path),
+            "file_path": new_file_path,
+            "upload_time": datetime.now().strftime("%Y%m%d%H%M%S"),
+            "metadata": new_metadata,
+            "parent_file_id": file_id,
+            "content_hash": result.get("content_hash")
+        }
+        if result.get("content_hash"):
+            uploaded_files.register_content(result["content_hash"], new_file_id, replace=False)
+        result["new_file_id"] = new_file_id
+        result["delta"]["parent_file_id"] = file_id
+        uploaded_files.derive_entities(new_file_id, file_id, _renames(result["delta"]))
+    return result
+
+def _operation_error(operation: dict):
+    """Why an operation of a batch can't be applied, or None"""
+    if "instruction" in operation:
+        if not isinstance(operation["instruction"], str) or not operation["instruction"].strip():
+            return "An instruction must be a non-empty string"
+        return None
+    prop = operation.get("property")
+    if not isinstance(prop, str) or prop.lower() not in MODIFIABLE_PROPERTIES:
+        return f"The property must be one of {', '.join(MODIFIABLE_PROPERTIES)}"
+    if not isinstance(operation.get("new_value"), str) or not operation["new_value"]:
+        return "The new value must be a non-empty string"
+    if not (operation.get("entity_type") or operation.get("selector")):
+        return "An entity_type or selector is required"
+    return None
+
+@app.post("/modify/{file_id}/batch")
+async def modify_file_batch(file_id: str, request: Request, background: bool = False):
+    """
+    Apply many modifications to a file at once, writing a single new file.
+
+    The body is a JSON list of operations, or {"operations": [...]}. An
+    operation is a modification ({"entity_type", "entity_ids", "property",
+    "new_value"}), applied without the LLM, or {"instruction": "..."} to
+    have it parsed. The result lists the outcome and timing of every operation.
+    """
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be JSON")
+    operations = body.get("operations") if isinstance(body, dict) else body
+    if not isinstance(operations, list) or not operations or not all(isinstance(op, dict) for op in operations):
+        raise HTTPException(status_code=400, detail="Expected a non-empty list of operations")
+    for index, operation in enumerate(operations):
+        error = _operation_error(operation)
+        if error:
+            raise HTTPException(status_code=400, detail=f"Operation {index}: {error}")
+
+    job = job_manager.submit("modify_batch", lambda job: _batch_job(job, file_id, operations), file_id)
+    if background:
+        return JSONResponse(status_code=202, content={"status": "accepted", "job_id": job.id})
+
+    await job_manager.wait(job)
+    if job.status == "failed":
+        return {"error": job.error}
+    return job.result
+
+def _session_info(session: dict):
+    return {
+        "session_id": session["session_id"],
+        "file_id": session["file_id"],
+        "base_file_id": session["base_file_id"],
+        "version": session["version"],
+        "saved_version": session["saved_version"],
+        "dirty": session["version"] != session["saved_version"],
+        "flush_delay": SESSION_FLUSH_DELAY
+    }
+
+async def _open_edit_session(file_id: str):
+    """Open an editing session keeping the model of a file in memory"""
+    session_id = uuid.uuid4().hex[:8]
+    key = _lineage_root(file_id)
+    file_info = uploaded_files[file_id]
+    result = await run_ifc(
+        open_session, session_id, file_id, await _file_path(file_id), file_info.get("metadata", {}), key=key
+    )
+    if "error" in result:
+        return result
+
+    session = {
+        "session_id": session_id,
+        "key": key,
+        "base_file_id": file_id,
+        # Last file written from this session
+        "file_id": file_id,
+        "metadata": dict(file_info.get("metadata", {})),
+        "version": 0,
+        "saved_version": 0,
+        "lock": asyncio.Lock(),
+        "flush_handle": None,
+        # Task of the flush started by flush_handle, while it runs
+        "flush_task": None,
+        "listeners": []
+    }
+    edit_sessions[session_id] = session
+    return _session_info(session)
+
+def _schedule_flush(session: dict):
+    """Write the session once no edit arrived for SESSION_FLUSH_DELAY seconds"""
+    if session["flush_handle"]:
+        session["flush_handle"].cancel()
+        session["flush_handle"] = None
+    if SESSION_FLUSH_DELAY > 0:
+        loop = asyncio.get_running_loop()
+        session["flush_handle"] = loop.call_later(SESSION_FLUSH_DELAY, _start_flush, session)
+
+def _start_flush(session: dict):
+    session["flush_handle"] = None
+    session["flush_task"] = asyncio.ensure_future(_debounced_flush(session))
+
+async def _debounced_flush(session: dict):
+    """Flush started by _schedule_flush; nobody waits for it, so its listeners are told if it fails"""
+    try:
+        result = await _flush_edit_session(session)
+    except Exception as e:
+        result = {"error": str(e)}
+    finally:
+        session["flush_task"] = None
+    if "error" in result:
+        await _report_session_error(session, result["error"])
+
+async def _notify_session(session: dict, event: dict):
+    for listener in list(session["listeners"]):
+        try:
+            await listener(event)
+        except Exception:
+            session["listeners"].remove(listener)
+
+async def _report_session_error(session: dict, error: str):
+    """Tell the listeners of a session that its unsaved edits could not be written"""
+    print(f"Error writing session {session['session_id']}: {error}")
+    await _notify_session(session, {
+        "type": "session_error",
+        "message": f"Unsaved edits could not be written: {error}",
+        **_session_info(session)
+    })
+
+async def _flush_edit_session(session: dict, progress=None):
+    """
+    Write the edits of a session to a new file and register it.
+    Nothing is written when there are no unsaved edits.
+
+    Args:
+        progress: Optional listener of the progress of the write, see run_ifc
+    """
+    async with session["lock"]:
+        if session["flush_handle"]:
+            session["flush_handle"].cancel()
+            session["flush_handle"] = None
+        if session["version"] == session["saved_version"]:
+            return {"status": "unchanged", **_session_info(session)}
+
+        parent_id = session["file_id"]
+        new_file_id = uuid.uuid4().hex[:8]
+        result = await run_ifc(flush_session, session["session_id"], new_file_id, key=session["key"], progress=progress)
+        if "error" in result:
+            return result
+
+        new_file_path = result["modified_file"]
+        uploaded_files[new_file_id] = {
+            "original_filename": f"modified_{uploaded_files[session['base_file_id']]['original_filename']}",
+            "stored_filename": os.path.basename(new_file_path),
+            "file_path": new_file_path,
+            "upload_time": datetime.now().strftime("%Y%m%d%H%M%S"),
+            "metadata": result["metadata"],
+            "parent_file_id": parent_id,
+            "content_hash": result["content_hash"]
+        }
+        uploaded_files.register_content(result["content_hash"], new_file_id, replace=False)
+        uploaded_files.derive_entities(new_file_id, parent_id, _renames(result["delta"]))
+        session["file_id"] = new_file_id
+        session["saved_version"] = result["version"]
+
+    event = {
+        "type": "session_saved",
+        "new_file_id": new_file_id,
+        "parent_file_id": parent_id,
+        "flush_ms": result["flush_ms"],
+        "file_size": result["file_size"],
+        "file_size_delta": result["file_size_delta"],
+        # All element changes since the parent file
+        "delta": {**result["delta"], "parent_file_id": parent_id},
+        **_session_info(session)
+    }
+    await _notify_session(session, event)
+    return {"status": "saved", **event}
+
+async def _close_edit_session(session: dict):
+    """
+    Write unsaved edits and close a session. A session whose edits could
+    not be written stays open, and its listeners are told.
+    """
+    try:
+        result = await _flush_edit_session(session)
+    except Exception as e:
+        result = {"error": str(e)}
+    if "error" in result:
+        await _report_session_error(session, result["error"])
+        return result
+    edit_sessions.pop(session["session_id"], None)
+    await run_ifc(close_session, session["session_id"], key=session["key"])
+    return result
+
+async def _modify_session_job(job, session: dict, instruction: str):
+    """Parse an instruction and apply it to the model of an editing session"""
+    await job_manager.update(job, "parsing instruction", 0.1)
+    modification_data = await _parse_instruction(session["base_file_id"], instruction, session)
+
+    await job_manager.update(job, "applying modification", 0.5)
+    async with session["lock"]:
+        result = await run_ifc(
+            apply_session_edit, session["session_id"], modification_data, key=session["key"],
+            progress=_job_progress(job, 0.5, 0.95, SESSION_EDIT_STAGES)
+        )
+        if "error" not in result:
+            session["version"] = result["version"]
+            # Metadata patched for this edit, e.g. with a new material name
+            session["metadata"] = result.pop("metadata")
+            # The delta is against the previous version of the session (base_version).
+            # Only when that version was written is it the last written file; after
+            # unsaved edits it has no file, and session_id + base_version identify it.
+            if result["delta"]["base_version"] == session["saved_version"]:
+                result["delta"]["parent_file_id"] = session["file_id"]
+            _schedule_flush(session)
+
+    if "prompt_stats" in modification_data:
+        result["prompt_stats"] = modification_data["prompt_stats"]
+    result.update({"session_id": session["session_id"], "file_id": session["file_id"]})
+    return result
+
+@app.post("/files/{file_id}/sessions")
+async def create_edit_session(file_id: str):
+    """
+    Open an editing session on a file.
+    Edits to the session are applied to the model in memory and written to
+    a new file on save, or SAPCAD_SESSION_FLUSH_SECONDS after the last edit.
+    """
+    if file_id not in uploaded_files:
+        raise HTTPException(status_code=404, detail="File not found")
+    result = await _open_edit_session(file_id)
+    if "error" in result:
+        raise HTTPException(status_code=500, detail=result["error"])
+    return result
+
+@app.get("/sessions/{session_id}")
+async def get_edit_session(session_id: str):
+    """Get the version and saved state of an editing session"""
+    if session_id not in edit_sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return _session_info(edit_sessions[session_id])
+
+@app.post("/sessions/{session_id}/modify")
+async def modify_edit_session(session_id: str, instruction: str = Form(...)):
+    """Apply a natural language instruction to the model of an editing session"""
+    session = edit_sessions.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    job = job_manager.submit(
+        "modify", lambda job: _modify_session_job(job, session, instruction), session["file_id"]
+    )
+    await job_manager.wait(job)
+    if job.status == "failed":
+        return {"error": job.error}
+    return job.result
+
+@app.post("/sessions/{session_id}/save")
+async def save_edit_session(session_id: str):
+    """Write the unsaved edits of a session now, returning the new file ID"""
+    session = edit_sessions.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return await _flush_edit_session(session)
+
+@app.delete("/sessions/{session_id}")
+async def delete_edit_session(session_id: str):
+    """Write the unsaved edits of a session and close it"""
+    session = edit_sessions.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return await _close_edit_session(session)
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Get the status and progress of a job"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Get the result of a finished job"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not job.finished:
+        return JSONResponse(status_code=202, content=job.to_dict())
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return job.result
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """
+    Hit, miss and eviction counters of the parsed model cache of every IFC
+    worker, as of the last call the worker finished
+    """
+    return {"workers": ifc_worker_cache_stats()}
+
+@app.get("/llm/stats")
+async def llm_stats():
+    """
+    Hit, miss and eviction counters of the prompt state and result caches,
+    inference queue counters and fast-path parser hits
+    """
+    return {**get_llm_cache_stats(), "scheduler": inference_scheduler.stats(), "fast_path": fast_parser.stats()}
+
+def _set_cache_metrics(cache: str, stats: dict):
+    CACHE_LOOKUPS.set(stats.get("hits", 0), cache=cache, result="hit")
+    CACHE_LOOKUPS.set(stats.get("misses", stats.get("fallbacks", 0)), cache=cache, result="miss")
+    CACHE_HIT_RATIO.set(stats.get("hit_ratio", 0.0), cache=cache)
+    if "current_mb" in stats:
+        CACHE_SIZE_MB.set(stats["current_mb"], cache=cache)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    Metrics of this server worker in the Prometheus text format: durations
+    of the pipeline stages and requests, entities/s, LLM prompt tokens and
+    tokens/s, queue depth, cache hit ratios and WebSocket sessions.
+    The stages run in the IFC workers are reported here too.
+    """
+    scheduler = inference_scheduler.stats()
+    INFERENCE_QUEUE.set(scheduler["queued"], state="queued")
+    INFERENCE_QUEUE.set(scheduler["running"], state="running")
+    for outcome in ("completed", "failed", "rejected", "timed_out", "cancelled", "coalesced"):
+        INFERENCE_REQUESTS.set(scheduler[outcome], outcome=outcome)
+    JOBS_RUNNING.set(sum(1 for job in job_manager.jobs.values() if not job.finished))
+    WEBSOCKET_SESSIONS.set(len(connected_clients))
+
+    # The model caches live in the IFC workers, their last known counters are
+    # added up: asking the workers would wait for the work they are doing
+    workers = ifc_worker_cache_stats()
+    model_stats = {key: sum(w.get(key, 0) for w in workers) for key in ("hits", "misses", "current_mb")}
+    lookups = model_stats["hits"] + model_stats["misses"]
+    model_stats["hit_ratio"] = round(model_stats["hits"] / lookups, 4) if lookups else 0.0
+    _set_cache_metrics("model", model_stats)
+
+    llm_stats = await asyncio.to_thread(get_llm_cache_stats) if INFERENCE_SOCKET else get_llm_cache_stats()
+    for cache, key in (("prompt_state", "prompt_states"), ("modification_result", "modification_results")):
+        if isinstance(llm_stats.get(key), dict):
+            _set_cache_metrics(cache, llm_stats[key])
+    _set_cache_metrics("fast_path", fast_parser.stats())
+    _set_cache_metrics("mesh", mesh_cache.stats())
+    _set_cache_metrics("encoded_content", encoded_cache.stats())
+
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+# Load state of the subsystems that are warmed up at startup, reported by /ready
+readiness = {"ifc_engine": {"status": "loading"}}
+
+async def _load_ifc_engine():
+    """Start the IFC workers and import the IFC engine in each of them"""
+    start = time.perf_counter()
+    try:
+        workers = await run_on_all_ifc_workers(load_ifc_engine)
+        readiness["ifc_engine"] = {
+            "status": "ready",
+            "workers": len(workers),
+            "ifcopenshell": workers[0]["ifcopenshell"] if workers else None,
+            "load_ms": round((time.perf_counter() - start) * 1000, 3)
+        }
+    except Exception as e:
+        readiness["ifc_engine"] = {"status": "error", "error": str(e)}
+
+async def _collect_versions():
+    """Pack, evict and prune versions every GC_INTERVAL_SECONDS"""
+    while True:
+        await asyncio.sleep(GC_INTERVAL_SECONDS)
+        try:
+            await version_store.collect(_pinned_versions())
+        except Exception as e:
+            print(f"Error collecting versions: {e}")
+
+@app.on_event("startup")
+async def startup():
+    # Loading happens in the background, /ready reports when it is done
+    asyncio.create_task(_load_ifc_engine())
+    if GC_INTERVAL_SECONDS > 0:
+        asyncio.create_task(_collect_versions())
+    if WARM_UP and not INFERENCE_SOCKET:
+        # Ahead of any request queued meanwhile; the inference service warms up itself
+        asyncio.create_task(run_inference(warm_up, priority=PRIORITY_PARSE))
+
+@app.get("/ready")
+async def ready():
+    """
+    Whether this instance answers fast: the IFC engine is loaded in every
+    worker and the LLM is warmed up, or unavailable because no model is
+    installed. Answers 503 until then, for load balancer health checks.
+    """
+    if INFERENCE_SOCKET:
+        llm = await asyncio.to_thread(get_model_status)
+    else:
+        llm = get_model_status()
+    subsystems = {
+        "ifc_engine": readiness["ifc_engine"],
+        "llm": llm,
+        "caches": {
+            "status": "ready",
+            "registered_files": len(uploaded_files),
+            "mesh_cache": mesh_cache.stats(),
+            "edit_sessions": len(edit_sessions)
+        }
+    }
+    # Without warm-up the local model is loaded by the first chat
+    llm_ready = llm.get("status") in ("ready", "unavailable") or (not WARM_UP and not INFERENCE_SOCKET)
+    is_ready = subsystems["ifc_engine"]["status"] == "ready" and llm_ready
+    return JSONResponse({"ready": is_ready, "subsystems": subsystems}, status_code=200 if is_ready else 503)
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Write the edits that are still in memory
+    for session in list(edit_sessions.values()):
+        await _close_edit_session(session)
+    uploaded_files.close()
+    shutdown_executors()
+
+async def _suggest_modification(user_message: str, file_id: str, cancel_event=None):
+    """
+    Parse a chat message that looks like a modification request.
+    Returns a modification suggestion if the parser is confident enough.
+    """
+    # Check if this might be a modification request
+    if not file_id or file_id not in uploaded_files:
+        return None
+    if not any(kw in user_message.lower() for kw in ["change", "modify", "update", "make", "set", "color", "change to"]):
+        return None
+
+    # Try to parse as modification request
+    modification_data = await _parse_instruction(file_id, user_message, cancel_event=cancel_event)
+
+    # If confidence is reasonable, suggest modification
+    confidence = modification_data.get("confidence", 0)
+    try:
+        confidence = float(confidence)
+    except (TypeError, ValueError):
+        confidence = 0
+    if confidence <= 0.6:
+        return None
+
+    return {
+        "type": "modification_suggestion",
+        "entity_type": modification_data.get("entity_type", "unknown"),
+        "property": modification_data.get("property", "unknown"),
+        "new_value": modification_data.get("new_value", "unknown"),
+        "file_id": file_id
+    }
+
+async def _stream_chat_reply(channel: MessageChannel, message_id: str, user_message: str, file_id: str,
+                             cancel_event: threading.Event, suggest_modification: bool, profile: bool = False):
+    """
+    Stream a chat reply as chat_delta messages followed by a chat_done message.
+    Generation stops as soon as cancel_event is set. With profile the
+    chat_done message has the stage breakdown of the reply.
+    """
+    with _profile(profile) as trace:
+        await _send_chat_reply(channel, message_id, user_message, file_id, cancel_event, suggest_modification,
+                               trace)
+
+async def _send_chat_reply(channel: MessageChannel, message_id: str, user_message: str, file_id: str,
+                           cancel_event: threading.Event, suggest_modification: bool, trace=None):
+    try:
+        # Get file context if available
+        context, query = await _chat_context(file_id, user_message)
+
+        # Queue wait, token count and tokens/s of the reply
+        stats = {}
+        parts = []
+        async for delta in stream_inference(stream_chat_with_ai, user_message, context, cancel_event, stats,
+                                            priority=PRIORITY_CHAT, cancel_event=cancel_event, stats=stats):
+            if cancel_event.is_set():
+                break
+            parts.append(delta)
+            await channel.send({
+                "type": "chat_delta",
+                "message_id": message_id,
+                "delta": delta
+            })
+        record_llm("chat", stats, "cancelled" if cancel_event.is_set() else "completed")
+
+        response = {
+            "type": "chat_done",
+            "message_id": message_id,
+            "message": "".join(parts).strip(),
+            "cancelled": cancel_event.is_set(),
+            "stats": stats
+        }
+        if query:
+            response["query"] = query
+        if suggest_modification and not cancel_event.is_set():
+            modification_summary = await _suggest_modification(user_message, file_id, cancel_event)
+            if modification_summary:
+                response["modification"] = modification_summary
+        if trace is not None:
+            response["profile"] = trace.to_dict()
+        await channel.send(response)
+
+    except Exception as e:
+        # Most likely the client went away, make sure generation stops
+        cancel_event.set()
+        try:
+            await channel.send({
+                "type": "error",
+                "message_id": message_id,
+                "message": f"An error occurred: {str(e)}"
+            })
+        except Exception:
+            pass
+
+def _start_chat_stream(chat_stream: dict, channel: MessageChannel, user_message: str, file_id: str,
+                       suggest_modification: bool, profile: bool = False):
+    """Start streaming a reply, cancelling the reply still in progress for this client"""
+    if chat_stream["cancel_event"]:
+        chat_stream["cancel_event"].set()
+
+    message_id = uuid.uuid4().hex[:8]
+    cancel_event = threading.Event()
+    chat_stream["cancel_event"] = cancel_event
+    chat_stream["task"] = asyncio.create_task(_stream_chat_reply(
+        channel, message_id, user_message, file_id, cancel_event, suggest_modification, profile
+    ))
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await websocket.accept()
+    # JSON text frames, or MessagePack binary frames if the client asks for them
+    channel = await MessageChannel.accept(websocket)
     connected_clients[client_id] = websocket
+    WEBSOCKET_SESSIONS.set(len(connected_clients))
 
     # Keep track of current file context
     current_file_id = None
 
+    # Forward progress of jobs started or followed by this client
+    async def send_progress(event):
+        await channel.send(event)
+
+    # Reply currently being streamed to this client
+    chat_stream = {"task": None, "cancel_event": None}
+
+    # Editing session of this client, its saves move the file context to the written file
+    edit_session = None
+
+    async def session_event(event):
+        nonlocal current_file_id
+        if event["type"] == "session_saved":
+            current_file_id = event["new_file_id"]
+        await channel.send(event)
+
     try:
         while True:
             # Receive message from client
-            data = await websocket.receive_text()
+            try:
+                message_data = await channel.receive()
+            except ValueError as e:
+                await channel.send({"type": "error", "message": str(e)})
+                continue
 
             try:
-                # Try to parse as JSON to handle structured messages
-                message_data = json.loads(data)
+                # Treat as plain text message if not a structured message
+                if isinstance(message_data, str):
+                    _start_chat_stream(chat_stream, channel, message_data, current_file_id, False)
 
                 # Check if this is a file selection message
-                if "set_file_context" in message_data:
+                elif "set_file_context" in message_data:
                     file_id = message_data["set_file_context"]
                     if file_id in uploaded_files:
+                        # Edits to the previous file are written before switching
+                        if edit_session is not None:
+                            await _close_edit_session(edit_session)
+                            # A session that could not be written stays open, no longer for this connection
+                            if session_event in edit_session["listeners"]:
+                                edit_session["listeners"].remove(session_event)
+                            edit_session = None
                         current_file_id = file_id
-                        file_summary = get_entity_summary(uploaded_files[file_id]["file_path"])
+                        # Parsing a file that is not in memory takes a while, report how far it got
+                        file_summary = await run_ifc(
+                            get_entity_summary, await _file_path(file_id), file_id,
+                            key=_lineage_root(file_id),
+                            progress=_operation_progress(channel, "file_context", file_id=file_id)
+                        )
                         response = {
                             "type": "file_context",
                             "file_id": file_id,
                             "filename": uploaded_files[file_id]["original_filename"],
                             "summary": file_summary
                         }
-                        await websocket.send_json(response)
+                        await channel.send(response)
                     else:
-                        await websocket.send_json({
+                        await channel.send({
                             "type": "error",
                             "message": f"File with ID {file_id} not found"
                         })
 
+                # Cancel the reply that is being generated
+                elif "cancel" in message_data:
+                    if chat_stream["cancel_event"]:
+                        chat_stream["cancel_event"].set()
+
                 # Handle normal chat message
                 elif "message" in message_data:
                     user_message = message_data["message"]
 
-                    # Get file context if available
-                    context = ""
-                    if current_file_id and current_file_id in uploaded_files:
-                        context = get_entity_summary(uploaded_files[current_file_id]["file_path"])
-
-                    # Get AI response
-                    ai_response = chat_with_ai(user_message, context)
-
-                    # Check if this might be a modification request
-                    if current_file_id and any(kw in user_message.lower() for kw in ["change", "modify", "update", "make", "set", "color", "change to"]):
-                        # Try to parse as modification request
-                        metadata = uploaded_files[current_file_id].get("metadata", {})
-                        modification_data = parse_modification_request(user_message, metadata)
-
-                        # If confidence is reasonable, suggest modification
-                        confidence = modification_data.get("confidence", 0)
-                        if confidence > 0.6:
-                            modification_summary = {
-                                "type": "modification_suggestion",
-                                "entity_type": modification_data.get("entity_type", "unknown"),
-                                "property": modification_data.get("property", "unknown"),
-                                "new_value": modification_data.get("new_value", "unknown"),
-                                "file_id": current_file_id
-                            }
+                    if message_data.get("stream", True):
+                        # Stream the reply token by token while still receiving messages
+                        _start_chat_stream(chat_stream, channel, user_message, current_file_id, True,
+                                           bool(message_data.get("profile")))
+                    else:
+                        with _profile(message_data.get("profile")) as trace:
+                            # Get file context if available
+                            context, query = await _chat_context(current_file_id, user_message)
 
-                            # Add modification suggestion to AI response
-                            await websocket.send_json({
-                                "type": "chat_response",
-                                "message": ai_response,
-                                "modification": modification_summary
-                            })
-                        else:
-                            # Just send normal response
-                            await websocket.send_json({
+                            # Get AI response
+                            with span("llm_chat"):
+                                ai_response = await run_inference(
+                                    chat_with_ai, user_message, context, priority=PRIORITY_CHAT
+                                )
+                            record_llm("chat", None)
+                            response = {
                                 "type": "chat_response",
                                 "message": ai_response
-                            })
-                    else:
-                        # Just send normal response
-                        await websocket.send_json({
-                            "type": "chat_response",
-                            "message": ai_response
-                        })
+                            }
+                            if query:
+                                response["query"] = query
+
+                            # Add modification suggestion to AI response
+                            modification_summary = await _suggest_modification(user_message, current_file_id)
+                            if modification_summary:
+                                response["modification"] = modification_summary
+                        if trace is not None:
+                            response["profile"] = trace.to_dict()
+                        await channel.send(response)
 
                 # Handle modification request
                 elif "modify_file" in message_data:
                     if not current_file_id:
-                        await websocket.send_json({
+                        await channel.send({
                             "type": "error",
                             "message": "No file selected for modification"
                         })
                     else:
                         instruction = message_data["modify_file"]
-                        file_path = uploaded_files[current_file_id]["file_path"]
-
-                        # Parse the modification request
-                        metadata = uploaded_files[current_file_id].get("metadata", {})
-                        modification_data = parse_modification_request(instruction, metadata)
-
-                        # Modify the file
-                        result = modify_ifc_entities(file_path, modification_data)
-
-                        # Handle successful modification
-                        if "error" not in result and "modified_file" in result:
-                            # Generate new file ID and store reference
-                            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-                            new_file_id = uuid.uuid4().hex[:8]
-                            new_file_path = result["modified_file"]
-
-                            # Process the new file
-                            new_metadata = process_ifc_file(new_file_path)
-
-                            # Store reference to the modified file
-                            new_file_info = {
-                                "original_filename": f"modified_{uploaded_files[current_file_id]['original_filename']}",
-                                "stored_filename": os.path.basename(new_file_path),
-                                "file_path": new_file_path,
-                                "upload_time": timestamp,
-                                "metadata": new_metadata,
-                                "parent_file_id": current_file_id
-                            }
 
-                            uploaded_files[new_file_id] = new_file_info
+                        # Edits of this connection go to one editing session on the current file
+                        if edit_session is None or edit_session["session_id"] not in edit_sessions:
+                            opened = await _open_edit_session(current_file_id)
+                            edit_session = edit_sessions.get(opened.get("session_id"))
+                            if edit_session:
+                                edit_session["listeners"].append(session_event)
 
-                            # Update current file context to the new file
-                            current_file_id = new_file_id
+                        if edit_session is None:
+                            result = opened
+                            job = None
+                        else:
+                            # Parse and apply the modification as a job, streaming its progress
+                            session = edit_session
+                            with _profile(message_data.get("profile")) as trace:
+                                job = job_manager.submit(
+                                    "modify", lambda job: _modify_session_job(job, session, instruction),
+                                    current_file_id, listener=send_progress
+                                )
+                                await job_manager.wait(job)
+                            result = job.result if job.status == "completed" else {"error": job.error}
+                            if trace is not None:
+                                result = {**result, "profile": trace.to_dict()}
 
-                            # Send success response
-                            await websocket.send_json({
+                        if "error" not in result:
+                            # The file is written with the next save or after the flush delay
+                            await channel.send({
                                 "type": "modification_result",
                                 "status": "success",
                                 "message": f"File modified successfully. {result.get('entities_modified', 0)} entities updated.",
-                                "new_file_id": new_file_id,
-                                "details": result
+                                "session_id": result["session_id"],
+                                "version": result["version"],
+                                "pending_save": True,
+                                "delta": result["delta"],
+                                "job_id": job.id,
+                                # The delta, possibly with geometry, is only sent once
+                                "details": {key: value for key, value in result.items() if key != "delta"}
                             })
                         else:
                             # Send error response
-                            await websocket.send_json({
+                            await channel.send({
                                 "type": "modification_result",
                                 "status": "error",
                                 "message": result.get("error", "Unknown error during modification"),
+                                "job_id": job.id if job else None,
                                 "details": result
                             })
 
-            except json.JSONDecodeError:
-                # Treat as plain text message if not JSON
-                context = ""
-                if current_file_id and current_file_id in uploaded_files:
-                    context = get_entity_summary(uploaded_files[current_file_id]["file_path"])
+                # Write the edits of this connection's session now
+                elif "save_session" in message_data:
+                    if edit_session is None:
+                        await channel.send({
+                            "type": "error",
+                            "message": "No editing session to save"
+                        })
+                    else:
+                        result = await _flush_edit_session(edit_session, _operation_progress(
+                            channel, "save_session", session_id=edit_session["session_id"]
+                        ))
+                        if result.get("status") == "unchanged":
+                            await channel.send({"type": "session_saved", **result})
+                        elif "error" in result:
+                            await channel.send({"type": "error", "message": result["error"]})
+
+                # Follow the progress of a job submitted over HTTP
+                elif "subscribe_job" in message_data:
+                    job = job_manager.subscribe(message_data["subscribe_job"], send_progress)
+                    if job:
+                        await channel.send({"type": "job_progress", **job.to_dict()})
+                    else:
+                        await channel.send({
+                            "type": "error",
+                            "message": f"Job with ID {message_data['subscribe_job']} not found"
+                        })
 
-                ai_response = chat_with_ai(data, context)
-                await websocket.send_json({
-                    "type": "chat_response",
-                    "message": ai_response
-                })
+            except HTTPException as e:
+                # E.g. a version removed by the retention policy
+                await channel.send({"type": "error", "message": e.detail})
 
     except WebSocketDisconnect:
         # Remove client from connected clients
         if client_id in connected_clients:
             del connected_clients[client_id]
+        WEBSOCKET_SESSIONS.set(len(connected_clients))
+        job_manager.unsubscribe(send_progress)
+        # Stop generating a reply nobody will read
+        if chat_stream["cancel_event"]:
+            chat_stream["cancel_event"].set()
+        # Write the edits of this client
+        if edit_session is not None:
+            edit_session["listeners"].clear()
+            await _close_edit_session(edit_session)
     except Exception as e:
         print(f"WebSocket error: {str(e)}")
-        await websocket.send_json({
+        connected_clients.pop(client_id, None)
+        WEBSOCKET_SESSIONS.set(len(connected_clients))
+        job_manager.unsubscribe(send_progress)
+        if chat_stream["cancel_event"]:
+            chat_stream["cancel_event"].set()
+        if edit_session is not None:
+            edit_session["listeners"].clear()
+            await _close_edit_session(edit_session)
+        await channel.send({
             "type": "error",
             "message": f"An error occurred: {str(e)}"
         })
@@ -336,5 +1686,9 @@ if __name__ == "__main__":
     print(f"Upload directory: {UPLOAD_DIR}")
     print(f"Visit http://localhost:8000 to verify the server is running")
 
-    # Start the server
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Start the server. Several workers share the file registry, and should
+    # share one inference service (python inference_service.py) as well.
+    workers = int(os.environ.get("SAPCAD_WEB_WORKERS", "1"))
+    if workers > 1 and not INFERENCE_SOCKET:
+        print("Warning: without SAPCAD_INFERENCE_SOCKET every worker loads its own copy of the model")
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)
\ No newline at end of file
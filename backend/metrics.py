@@ -0,0 +1,301 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Bucket bounds of the duration histograms, in milliseconds
+DURATION_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labels: tuple):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict):
+        return tuple((name, labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self):
+        """(suffix, labels, value) of every sample"""
+        with self._lock:
+            return [("", key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_label_text(labels)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """A count that only goes up"""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """Set the total of a count kept elsewhere, e.g. the hits of a cache"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    """A value that goes up and down"""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, with their sum and count"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DURATION_BUCKETS_MS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(("_bucket", key + (("le", _number(float(bound))),), cumulative))
+                samples.append(("_sum", key, total))
+                samples.append(("_count", key, count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Metrics of this process, rendered in the Prometheus text format.
+
+    Collectors are called before rendering, to set gauges from statistics
+    that are only read on a scrape (queue depth, cache hit ratios).
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def _add(self, metric: _Metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames=()):
+        return self._add(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=DURATION_BUCKETS_MS):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_MS = registry.histogram(
+    "sapcad_stage_duration_ms", "Duration of a pipeline stage in milliseconds", ["stage"]
+)
+ENTITIES_PER_SECOND = registry.histogram(
+    "sapcad_entities_per_second", "Entities processed per second by a stage", ["stage"],
+    buckets=(1000, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000)
+)
+ENTITIES_TOTAL = registry.counter(
+    "sapcad_entities_processed_total", "Entities processed by a stage", ["stage"]
+)
+PROMPT_TOKENS = registry.histogram(
+    "sapcad_llm_prompt_tokens", "Tokens of an LLM prompt", ["kind"],
+    buckets=(64, 128, 256, 512, 1024, 2048, 3072, 4096)
+)
+COMPLETION_TOKENS = registry.counter(
+    "sapcad_llm_completion_tokens_total", "Tokens generated by the LLM", ["kind"]
+)
+TOKENS_PER_SECOND = registry.histogram(
+    "sapcad_llm_tokens_per_second", "Decoding speed of an LLM request", ["kind"],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 200)
+)
+LLM_REQUESTS = registry.counter(
+    "sapcad_llm_requests_total", "LLM requests by kind and outcome", ["kind", "outcome"]
+)
+
+# Stage names of the statistics reported by the LLM, see record_llm
+_LLM_STAGES = {
+    "queue_wait_ms": "llm_queue",
+    "prompt_build_ms": "llm_prompt_build",
+    "prefix_ms": "llm_prefix_cache",
+    "prefill_ms": "llm_prefill",
+    "decode_ms": "llm_decode"
+}
+
+
+# Spans. A trace collects the spans of one request when it is profiled, and
+# the spans of a call in an IFC worker process, which are sent back with its
+# result and recorded in the server process (see jobs.run_ifc).
+
+_trace = contextvars.ContextVar("sapcad_trace", default=None)
+
+
+class Trace:
+    """Durations of the stages of a request, in the order they ended"""
+
+    def __init__(self, remote: bool = False):
+        # A remote trace is recorded by another process, its observations are kept for it
+        self.remote = remote
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self.samples = []
+
+    def to_dict(self):
+        stages = {}
+        for stage, ms in self.spans:
+            stages[stage] = round(stages.get(stage, 0.0) + ms, 3)
+        return {
+            "total_ms": round((time.perf_counter() - self.started_at) * 1000, 3),
+            "stages": stages,
+            "spans": [{"stage": stage, "ms": round(ms, 3)} for stage, ms in self.spans]
+        }
+
+    def server_timing(self):
+        """Value of a Server-Timing header, shown by the browser developer tools"""
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.to_dict()["stages"].items())
+
+
+@contextmanager
+def collect_trace(remote: bool = False):
+    """Collect the spans of the current context, and of the tasks it starts, into a trace"""
+    trace = Trace(remote)
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+def current_trace():
+    return _trace.get()
+
+
+def record_span(stage: str, ms: float):
+    """Record the duration of a stage measured elsewhere"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.spans.append((stage, ms))
+        if trace.remote:
+            return
+    STAGE_MS.observe(ms, stage=stage)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block as a pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, (time.perf_counter() - start) * 1000)
+
+
+def observe(metric, value: float, **labels):
+    """Observe a histogram or increment a counter, from any process"""
+    trace = _trace.get()
+    if trace is not None and trace.remote:
+        trace.samples.append((metric.name, value, labels))
+    elif isinstance(metric, Histogram):
+        metric.observe(value, **labels)
+    else:
+        metric.inc(value, **labels)
+
+
+def record_throughput(stage: str, entities: int, seconds: float):
+    """Record the number of entities a stage processed and its rate"""
+    observe(ENTITIES_TOTAL, entities, stage=stage)
+    if entities and seconds > 0:
+        observe(ENTITIES_PER_SECOND, entities / seconds, stage=stage)
+
+
+def record_remote(spans, samples):
+    """Record the spans and observations of a remote trace"""
+    for stage, ms in spans:
+        record_span(stage, ms)
+    for name, value, labels in samples:
+        metric = registry.metrics.get(name)
+        if metric is not None:
+            observe(metric, value, **labels)
+
+
+def record_llm(kind: str, stats: dict, outcome: str = "completed"):
+    """
+    Record the statistics of an LLM request (prompt_stats of a parsed
+    modification, stats of a streamed chat reply) as stages and metrics.
+    """
+    LLM_REQUESTS.inc(kind=kind, outcome=outcome)
+    if not stats:
+        return
+    for key, stage in _LLM_STAGES.items():
+        if isinstance(stats.get(key), (int, float)):
+            record_span(stage, stats[key])
+    if stats.get("prompt_tokens"):
+        PROMPT_TOKENS.observe(stats["prompt_tokens"], kind=kind)
+    if stats.get("completion_tokens"):
+        COMPLETION_TOKENS.inc(stats["completion_tokens"], kind=kind)
+    if stats.get("tokens_per_s"):
+        TOKENS_PER_SECOND.observe(stats["tokens_per_s"], kind=kind)
@@ -0,0 +1,186 @@
+import ifcopenshell
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from metrics import span
+from progress import report_progress
+
+# Memory budget for parsed models kept in memory (in MB)
+MODEL_CACHE_BUDGET_MB = int(os.environ.get("SAPCAD_MODEL_CACHE_MB", "2048"))
+
+# A parsed IFC model takes several times the size of the file on disk.
+# This factor is used to estimate the memory footprint of a cached model.
+MODEL_SIZE_FACTOR = float(os.environ.get("SAPCAD_MODEL_SIZE_FACTOR", "4.0"))
+
+
+class _CacheEntry:
+    """A parsed model together with the bookkeeping needed by the cache"""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.model = None
+        self.size = 0
+        # Serializes loading and use of the model across sessions
+        self.lock = threading.RLock()
+
+
+class ModelCache:
+    """
+    LRU cache of parsed IFC models keyed by file_id.
+
+    Models are evicted least recently used first once the estimated memory
+    of all cached models exceeds the configured budget. Every cached model
+    has its own lock, so concurrent sessions share one parsed copy of a file
+    instead of opening it again, while access to the model is serialized.
+    """
+
+    def __init__(self, budget_bytes: int, size_factor: float = MODEL_SIZE_FACTOR):
+        self.budget_bytes = budget_bytes
+        self.size_factor = size_factor
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _estimate_size(self, file_path: str):
+        """Estimate the memory used by the parsed model of a file"""
+        try:
+            return int(os.path.getsize(file_path) * self.size_factor)
+        except OSError:
+            return 0
+
+    def _entry(self, file_id: str, file_path: str):
+        """Get or create the entry for a file and mark it as recently used"""
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is None or entry.file_path != file_path:
+                if entry is not None:
+                    self._current_bytes -= entry.size
+                entry = _CacheEntry(file_path)
+                self._entries[file_id] = entry
+            self._entries.move_to_end(file_id)
+            return entry
+
+    def _load(self, file_id: str, entry: _CacheEntry):
+        """Parse the model of an entry if it is not loaded yet (entry lock held)"""
+        if entry.model is not None:
+            with self._lock:
+                self.hits += 1
+            return entry.model
+
+        # The parser does not report how far it got, only that it runs
+        report_progress("parsing")
+        with span("ifc_open"):
+            model = ifcopenshell.open(entry.file_path)
+        size = self._estimate_size(entry.file_path)
+
+        with self._lock:
+            self.misses += 1
+            if self._entries.get(file_id) is entry:
+                entry.model = model
+                entry.size = size
+                self._current_bytes += size
+                self._evict(keep=file_id)
+        return model
+
+    def _evict(self, keep: str = None):
+        """Drop least recently used models until the budget is respected (cache lock held)"""
+        for file_id in list(self._entries.keys()):
+            if self._current_bytes <= self.budget_bytes:
+                break
+            if file_id == keep:
+                continue
+            entry = self._entries.pop(file_id)
+            if entry.model is not None:
+                self._current_bytes -= entry.size
+                self.evictions += 1
+
+        # A model larger than the whole budget is handed out but not kept
+        if keep in self._entries and self._current_bytes > self.budget_bytes:
+            entry = self._entries.pop(keep)
+            self._current_bytes -= entry.size
+            self.evictions += 1
+
+    def get(self, file_id: str, file_path: str):
+        """
+        Get the parsed model for a file, opening it on a cache miss.
+
+        Args:
+            file_id: ID of the uploaded file
+            file_path: Path to the IFC file on disk
+
+        Returns:
+            The parsed ifcopenshell model
+        """
+        entry = self._entry(file_id, file_path)
+        with entry.lock:
+            return self._load(file_id, entry)
+
+    @contextmanager
+    def open_model(self, file_id: str, file_path: str):
+        """
+        Context manager yielding the cached model while holding its lock,
+        so that other sessions using the same file wait for us to finish.
+        """
+        entry = self._entry(file_id, file_path)
+        with entry.lock:
+            yield self._load(file_id, entry)
+
+    def take(self, file_id: str, file_path: str):
+        """
+        Remove a model from the cache and return it for exclusive use.
+        Used before modifying a model in place, so no other session sees
+        the changes on what is still registered as the original file.
+        """
+        entry = self._entry(file_id, file_path)
+        with entry.lock:
+            model = self._load(file_id, entry)
+            self.invalidate(file_id)
+            return model
+
+    def put(self, file_id: str, file_path: str, model):
+        """Register an already parsed model, e.g. the result of a modification"""
+        size = self._estimate_size(file_path)
+        with self._lock:
+            old = self._entries.pop(file_id, None)
+            if old is not None and old.model is not None:
+                self._current_bytes -= old.size
+            entry = _CacheEntry(file_path)
+            entry.model = model
+            entry.size = size
+            self._entries[file_id] = entry
+            self._current_bytes += size
+            self._evict(keep=file_id)
+
+    def invalidate(self, file_id: str):
+        """Forget the cached model of a file"""
+        with self._lock:
+            entry = self._entries.pop(file_id, None)
+            if entry is not None and entry.model is not None:
+                self._current_bytes -= entry.size
+
+    def stats(self):
+        """Counters used to size the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": sum(1 for e in self._entries.values() if e.model is not None),
+                "current_mb": round(self._current_bytes / (1024 * 1024), 2),
+                "budget_mb": round(self.budget_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+# Shared cache used by all request handlers and WebSocket sessions
+model_cache = ModelCache(MODEL_CACHE_BUDGET_MB * 1024 * 1024)
+
+
+def cache_stats():
+    """Statistics of the cache of the current process"""
+    return {"pid": os.getpid(), **model_cache.stats()}
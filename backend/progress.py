@@ -0,0 +1,75 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+# Seconds between two progress events of a call; the first report of a stage is always sent
+REPORT_INTERVAL = 0.25
+
+# The reporter of the current call, set in the IFC workers while a caller
+# listens to the progress of the call (see jobs.run_ifc)
+_reporter = contextvars.ContextVar("sapcad_progress", default=None)
+
+
+class _Reporter:
+    """Sends the progress events of a call, at most one per REPORT_INTERVAL"""
+
+    def __init__(self, send):
+        self.send = send
+        self.stages = set()
+        self.reported_at = 0.0
+        self.last = None
+
+    def report(self, stage: str, fraction: float = None, **details):
+        now = time.perf_counter()
+        if stage in self.stages and now - self.reported_at < REPORT_INTERVAL:
+            return
+        fraction = None if fraction is None else round(fraction, 3)
+        if (stage, fraction) == self.last:
+            # Nothing new to tell
+            return
+        self.stages.add(stage)
+        self.reported_at = now
+        self.last = (stage, fraction)
+        event = {"stage": stage, "progress": fraction, **details}
+        try:
+            self.send(event)
+        except Exception as e:
+            # Progress is informative, losing it must not fail the work
+            print(f"Error reporting progress: {e}")
+
+
+@contextmanager
+def report_to(send):
+    """Report the progress of the current context to send, called with every event"""
+    token = _reporter.set(_Reporter(send))
+    try:
+        yield
+    finally:
+        _reporter.reset(token)
+
+
+def report_progress(stage: str, fraction: float = None, **details):
+    """
+    Report the stage a call is in.
+
+    Args:
+        stage: Name of the stage shown to users, e.g. "writing file"
+        fraction: Part of the stage done, from 0 to 1, None if unknown
+        details: Further fields of the event
+    """
+    reporter = _reporter.get()
+    if reporter is not None:
+        reporter.report(stage, fraction, **details)
+
+
+def iter_progress(stage: str, items):
+    """Iterate over a sequence, reporting the part of it done as the progress of a stage"""
+    reporter = _reporter.get()
+    if reporter is None:
+        yield from items
+        return
+    total = len(items)
+    for done, item in enumerate(items):
+        reporter.report(stage, done / total, done=done, total=total)
+        yield item
+    reporter.report(stage, 1.0, done=total, total=total)
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Memory budget of saved llama.cpp states (in MB)
+PROMPT_STATE_BUDGET_MB = int(os.environ.get("SAPCAD_PROMPT_STATE_MB", "1024"))
+
+# Number of parsed modification requests kept
+RESULT_CACHE_SIZE = int(os.environ.get("SAPCAD_RESULT_CACHE_SIZE", "1000"))
+
+
+def _state_size(state):
+    """
+    Memory held by a saved state: the llama.cpp state, and the copies of the
+    logits (n_batch x n_vocab floats) and input tokens it keeps as numpy arrays
+    """
+    size = int(getattr(state, "llama_state_size", 0))
+    for array in (getattr(state, "scores", None), getattr(state, "input_ids", None)):
+        size += int(getattr(array, "nbytes", 0))
+    return size
+
+
+class PromptStateCache:
+    """
+    LRU cache of llama.cpp states after evaluating a prompt prefix.
+
+    The file context at the start of a prompt is the same for every turn on
+    the same file. Its evaluated state is saved once and loaded again before
+    the next completion with that prefix, so llama.cpp only has to evaluate
+    the new part of the prompt. States are evicted least recently used first
+    once they exceed the memory budget.
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._states = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def prepare(self, model, prefix: str):
+        """
+        Bring the model into the state of having evaluated the prefix.
+
+        The completion for prefix + suffix that follows only evaluates the
+        suffix, because llama.cpp reuses the longest matching token prefix.
+
+        Returns:
+            Dictionary with 'prefix_cache' (hit/miss) and 'prefix_ms'
+        """
+        start = time.perf_counter()
+        key = hashlib.sha1(prefix.encode("utf-8")).hexdigest()
+
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if state is not None:
+            model.load_state(state)
+            return {"prefix_cache": "hit", "prefix_ms": round((time.perf_counter() - start) * 1000, 3)}
+
+        # Evaluate the prefix from scratch and keep its state
+        tokens = model.tokenize(prefix.encode("utf-8"))
+        model.reset()
+        model.eval(tokens)
+        state = model.save_state()
+        size = _state_size(state)
+
+        with self._lock:
+            self._states[key] = state
+            self._current_bytes += size
+            while self._current_bytes > self.budget_bytes and len(self._states) > 1:
+                _, evicted = self._states.popitem(last=False)
+                self._current_bytes -= _state_size(evicted)
+                self.evictions += 1
+
+        return {"prefix_cache": "miss", "prefix_ms": round((time.perf_counter() - start) * 1000, 3)}
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._states),
+                "current_mb": round(self._current_bytes / (1024 * 1024), 2),
+                "budget_mb": round(self.budget_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+def normalize_instruction(instruction: str):
+    """Lowercase an instruction and collapse whitespace and trailing punctuation"""
+    instruction = re.sub(r"\s+", " ", (instruction or "").strip().lower())
+    return instruction.rstrip(".!? ")
+
+
+class ResultCache:
+    """
+    LRU cache of parsed modification requests.
+
+    Keyed on the content hash of the file, the normalized instruction and
+    the version of the prompt template, so the same instruction on the same
+    content is only sent to the LLM once.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, content_hash: str, instruction: str, template_version: str):
+        return (content_hash, normalize_instruction(instruction), template_version)
+
+    def get(self, key):
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+            return dict(result)
+
+    def put(self, key, result: dict):
+        with self._lock:
+            self._results[key] = dict(result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._results),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+prompt_state_cache = PromptStateCache(PROMPT_STATE_BUDGET_MB * 1024 * 1024)
+result_cache = ResultCache(RESULT_CACHE_SIZE)
@@ -0,0 +1,339 @@
+import json
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id TEXT PRIMARY KEY,
+    original_filename TEXT NOT NULL,
+    stored_filename TEXT,
+    file_path TEXT NOT NULL,
+    upload_time TEXT,
+    content_hash TEXT,
+    parent_file_id TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash);
+CREATE INDEX IF NOT EXISTS files_parent ON files (parent_file_id);
+
+CREATE TABLE IF NOT EXISTS entities (
+    file_id TEXT NOT NULL,
+    entity_type TEXT NOT NULL,
+    entity_id INTEGER NOT NULL,
+    global_id TEXT,
+    name TEXT,
+    PRIMARY KEY (file_id, entity_type, entity_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entities_global_id ON entities (file_id, global_id);
+
+-- Files whose entity rows are complete
+CREATE TABLE IF NOT EXISTS entity_sets (
+    file_id TEXT PRIMARY KEY,
+    entity_count INTEGER NOT NULL
+);
+
+-- Content hash -> file ID, used to deduplicate uploads
+CREATE TABLE IF NOT EXISTS contents (
+    content_hash TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL
+);
+
+-- Last known state of the jobs of all server workers
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    result TEXT,
+    updated_at REAL NOT NULL
+);
+
+-- How the content of each modified file is stored, see version_store
+CREATE TABLE IF NOT EXISTS versions (
+    file_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    base_file_id TEXT,
+    blob_path TEXT,
+    plain_size INTEGER,
+    stored_size INTEGER,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS versions_base ON versions (base_file_id);
+"""
+
+# Columns of the versions table
+_VERSION_COLUMNS = ["file_id", "state", "base_file_id", "blob_path", "plain_size", "stored_size", "created_at",
+                    "accessed_at"]
+
+# Columns of the files table, in the order of the file record keys
+_FILE_COLUMNS = ["original_filename", "stored_filename", "file_path", "upload_time", "content_hash", "parent_file_id"]
+
+
+class FileRegistry(MutableMapping):
+    """
+    Persistent registry of the uploaded and modified files.
+
+    Behaves like the dict of file records it replaces. Every assignment is
+    written through to SQLite, and records registered by another server
+    worker are read from the database on first use, so all workers share
+    the same files. The server comes up with all files known after a
+    restart without parsing them again. The base fields of the entities of
+    a file (id, type, GlobalId, Name) are kept in an indexed table, so
+    listing them does not need the parsed model.
+
+    File records are never changed after registration, which is what makes
+    caching them in memory safe. How the content of a modified file is
+    stored changes over its life, so that is kept in the versions table,
+    which is always read from the database.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # Other workers may hold the write lock for a moment
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._files = {}
+        # Stores from before the contents table get it filled from the file records
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO contents SELECT content_hash, file_id FROM files "
+                "WHERE content_hash IS NOT NULL AND metadata NOT LIKE '{\"error\"%' ORDER BY rowid"
+            )
+        self._load()
+
+    def _record(self, row):
+        record = dict(zip(_FILE_COLUMNS, row[1:-1]))
+        record["metadata"] = json.loads(row[-1]) if row[-1] else {}
+        return record
+
+    def _load(self):
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT file_id, {', '.join(_FILE_COLUMNS)}, metadata FROM files"
+            ).fetchall()
+        for row in rows:
+            self._files[row[0]] = self._record(row)
+
+    # Mapping interface, records are cached in memory
+
+    def __getitem__(self, file_id: str):
+        record = self._files.get(file_id)
+        if record is None:
+            with self._lock:
+                row = self._db.execute(
+                    f"SELECT file_id, {', '.join(_FILE_COLUMNS)}, metadata FROM files WHERE file_id = ?",
+                    (file_id,)
+                ).fetchone()
+            if row is None:
+                raise KeyError(file_id)
+            record = self._files[file_id] = self._record(row)
+        return record
+
+    def __contains__(self, file_id):
+        try:
+            self[file_id]
+            return True
+        except KeyError:
+            return False
+
+    def __setitem__(self, file_id: str, record: dict):
+        values = [record.get(k) for k in _FILE_COLUMNS]
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO files (file_id, {', '.join(_FILE_COLUMNS)}, metadata) "
+                f"VALUES (?, {', '.join('?' for _ in _FILE_COLUMNS)}, ?)",
+                [file_id, *values, json.dumps(record.get("metadata", {}))]
+            )
+        self._files[file_id] = record
+
+    def __delitem__(self, file_id: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+            self._db.execute("DELETE FROM entities WHERE file_id = ?", (file_id,))
+            self._db.execute("DELETE FROM entity_sets WHERE file_id = ?", (file_id,))
+            self._db.execute("DELETE FROM versions WHERE file_id = ?", (file_id,))
+        self._files.pop(file_id, None)
+
+    def __iter__(self):
+        with self._lock:
+            rows = self._db.execute("SELECT file_id FROM files ORDER BY rowid").fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    # Content index
+
+    def find_content(self, content_hash: str):
+        """ID of the file registered for this content, or None"""
+        with self._lock:
+            row = self._db.execute("SELECT file_id FROM contents WHERE content_hash = ?", (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def register_content(self, content_hash: str, file_id: str, replace: bool = True):
+        """Register a file for its content hash, keeping an existing one unless replace is set"""
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO contents VALUES (?, ?)",
+                (content_hash, file_id)
+            )
+
+    # Jobs
+
+    def save_job(self, record: dict, result=None):
+        """Store the state of a job, so every worker can report it"""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)",
+                (record["job_id"], json.dumps(record), json.dumps(result, default=str) if result is not None else None,
+                 time.time())
+            )
+
+    def load_job(self, job_id: str):
+        """
+        Returns:
+            Tuple of the stored job record and its result, or None
+        """
+        with self._lock:
+            row = self._db.execute("SELECT record, result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1]) if row[1] else None
+
+    def prune_jobs(self, max_age: float):
+        """Forget jobs not updated for max_age seconds"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM jobs WHERE updated_at < ?", (time.time() - max_age,))
+
+    def forget_content(self, file_id: str):
+        """Stop deduplicating uploads against a file whose content was removed"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM contents WHERE file_id = ?", (file_id,))
+
+    # Versions
+
+    def track_versions(self):
+        """Add the modified files registered since the last call to the versions table, as plain files"""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO versions (file_id, state, created_at, accessed_at) "
+                "SELECT file_id, 'plain', ?, ? FROM files WHERE parent_file_id IS NOT NULL ORDER BY rowid",
+                (now, now)
+            )
+
+    def get_version(self, file_id: str):
+        """Storage state of a modified file, or None if it is not tracked"""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(_VERSION_COLUMNS)} FROM versions WHERE file_id = ?", (file_id,)
+            ).fetchone()
+        return dict(zip(_VERSION_COLUMNS, row)) if row else None
+
+    def list_versions(self):
+        """Storage state of all tracked files, oldest first"""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(_VERSION_COLUMNS)} FROM versions ORDER BY created_at, rowid"
+            ).fetchall()
+        return [dict(zip(_VERSION_COLUMNS, row)) for row in rows]
+
+    def update_version(self, file_id: str, **fields):
+        with self._lock, self._db:
+            self._db.execute(
+                f"UPDATE versions SET {', '.join(f'{k} = ?' for k in fields)} WHERE file_id = ?",
+                [*fields.values(), file_id]
+            )
+
+    def touch_version(self, file_id: str):
+        """Mark a file as used now, which keeps it from being packed, evicted or pruned"""
+        with self._lock, self._db:
+            self._db.execute("UPDATE versions SET accessed_at = ? WHERE file_id = ?", (time.time(), file_id))
+
+    def blob_users(self, blob_path: str):
+        """IDs of the files stored in a blob"""
+        with self._lock:
+            rows = self._db.execute("SELECT file_id FROM versions WHERE blob_path = ?", (blob_path,)).fetchall()
+        return [row[0] for row in rows]
+
+    # Entity rows
+
+    def put_entities(self, file_id: str, rows):
+        """Store the (type, id, GlobalId, Name) rows of all entities of a file"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM entities WHERE file_id = ?", (file_id,))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?)",
+                ((file_id, *row) for row in rows)
+            )
+            self._db.execute("INSERT OR REPLACE INTO entity_sets VALUES (?, ?)", (file_id, len(rows)))
+
+    def derive_entities(self, file_id: str, parent_id: str, names: dict = None):
+        """
+        Copy the entity rows of the parent of a modified file, applying the
+        renames of the modification (entity id -> new name). Edits never add
+        or remove entities of the listed types, so nothing else differs.
+        """
+        if not self.has_entities(parent_id):
+            return False
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM entities WHERE file_id = ?", (file_id,))
+            self._db.execute(
+                "INSERT INTO entities SELECT ?, entity_type, entity_id, global_id, name "
+                "FROM entities WHERE file_id = ?", (file_id, parent_id)
+            )
+            self._db.executemany(
+                "UPDATE entities SET name = ? WHERE file_id = ? AND entity_id = ?",
+                ((name, file_id, int(entity_id)) for entity_id, name in (names or {}).items())
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO entity_sets SELECT ?, entity_count FROM entity_sets WHERE file_id = ?",
+                (file_id, parent_id)
+            )
+        return True
+
+    def delete_entities(self, file_id: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM entities WHERE file_id = ?", (file_id,))
+            self._db.execute("DELETE FROM entity_sets WHERE file_id = ?", (file_id,))
+
+    def has_entities(self, file_id: str):
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM entity_sets WHERE file_id = ?", (file_id,)).fetchone()
+        return row is not None
+
+    def list_entities(self, file_id: str, entity_types, cursor_type: str = None, cursor_id: int = None,
+                      limit: int = 100):
+        """
+        A page of entity rows in the order of list_ifc_entities: by the given
+        type order, then by id, resuming after the cursor.
+
+        Returns:
+            Tuple of the rows as dictionaries and the cursor of the next page
+        """
+        page = []
+        if cursor_type:
+            entity_types = entity_types[entity_types.index(cursor_type):]
+        with self._lock:
+            for entity_type in entity_types:
+                after = cursor_id if entity_type == cursor_type else -1
+                rows = self._db.execute(
+                    "SELECT entity_id, global_id, name FROM entities "
+                    "WHERE file_id = ? AND entity_type = ? AND entity_id > ? ORDER BY entity_id LIMIT ?",
+                    (file_id, entity_type, after, limit - len(page) + 1)
+                ).fetchall()
+                for entity_id, global_id, name in rows:
+                    if len(page) == limit:
+                        last = page[-1]
+                        return page, f"{last['type']}:{last['id']}"
+                    page.append({"GlobalId": global_id, "Name": name, "id": entity_id, "type": entity_type})
+        return page, None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,126 @@
+import ifcopenshell.util.element as element_util
+
+
+def _surface_colour(styled_item):
+    """Colour of the first surface shading in a styled item, or None"""
+    colour = None
+    for style in styled_item.Styles or []:
+        # IFC2X3 wraps styles in an IfcPresentationStyleAssignment
+        surface_styles = style.Styles if style.is_a("IfcPresentationStyleAssignment") else [style]
+        for surface_style in surface_styles:
+            if not surface_style.is_a("IfcSurfaceStyle"):
+                continue
+            for style_item in surface_style.Styles:
+                if style_item.is_a("IfcSurfaceStyleShading"):
+                    colour = {
+                        "Red": style_item.SurfaceColour.Red,
+                        "Green": style_item.SurfaceColour.Green,
+                        "Blue": style_item.SurfaceColour.Blue,
+                        "Alpha": 1.0 - (getattr(style_item, "Transparency", None) or 0.0)
+                    }
+    return colour
+
+
+def get_element_colour(model, entity):
+    """Colour of an element's styled representation items, read through their inverse references"""
+    colour = None
+    representation = getattr(entity, "Representation", None)
+    if representation:
+        for rep in representation.Representations:
+            for item in rep.Items:
+                for inverse in model.get_inverse(item):
+                    if inverse.is_a("IfcStyledItem"):
+                        colour = _surface_colour(inverse) or colour
+    return colour
+
+
+class RelationshipIndex:
+    """
+    Lookup tables of property sets, materials and styles of a model.
+
+    The relationship entities are scanned once, instead of walking the inverse
+    relationships of every element separately. A property set shared by many
+    elements is also only read once. The lookups give the same results as
+    element_util.get_psets and element_util.get_material.
+    """
+
+    def __init__(self, model):
+        # Element id -> {pset name: properties} of the occurrence itself
+        self.psets = {}
+        # Type object id -> {pset name: properties}
+        self.type_psets = {}
+        # Element id -> type object
+        self.element_types = {}
+        # Object id -> relating material (element or type object)
+        self.materials = {}
+        # Representation item id -> colour
+        self.colours = {}
+        self._build(model)
+
+    def _build(self, model):
+        # Typing relationships, used to inherit psets and materials from types
+        for rel in model.by_type("IfcRelDefinesByType"):
+            for obj in rel.RelatedObjects:
+                self.element_types[obj.id()] = rel.RelatingType
+
+        # Property sets attached to occurrences
+        for rel in model.by_type("IfcRelDefinesByProperties"):
+            definitions = rel.RelatingPropertyDefinition
+            if not isinstance(definitions, (list, tuple)):
+                definitions = [definitions]
+            for definition in definitions:
+                props = element_util.get_property_definition(definition)
+                for obj in rel.RelatedObjects:
+                    self.psets.setdefault(obj.id(), {}).setdefault(definition.Name, {}).update(props)
+
+        # Materials, the first association of an object wins like in get_material
+        for rel in model.by_type("IfcRelAssociatesMaterial"):
+            for obj in rel.RelatedObjects:
+                self.materials.setdefault(obj.id(), rel.RelatingMaterial)
+
+        # Colours of styled representation items
+        for styled_item in model.by_type("IfcStyledItem"):
+            if styled_item.Item is None:
+                continue
+            colour = _surface_colour(styled_item)
+            if colour:
+                self.colours[styled_item.Item.id()] = colour
+
+    def _get_type_psets(self, element_type):
+        type_id = element_type.id()
+        if type_id not in self.type_psets:
+            psets = {}
+            for definition in element_type.HasPropertySets or []:
+                psets.setdefault(definition.Name, {}).update(element_util.get_property_definition(definition))
+            self.type_psets[type_id] = psets
+        return self.type_psets[type_id]
+
+    def get_psets(self, entity):
+        """Property sets of an element, including those inherited from its type"""
+        psets = {}
+        element_type = self.element_types.get(entity.id())
+        if element_type is not None:
+            for name, props in self._get_type_psets(element_type).items():
+                psets[name] = dict(props)
+        for name, props in self.psets.get(entity.id(), {}).items():
+            psets.setdefault(name, {}).update(props)
+        return psets
+
+    def get_material(self, entity):
+        """Material of an element, falling back to the material of its type"""
+        material = self.materials.get(entity.id())
+        if material is None:
+            element_type = self.element_types.get(entity.id())
+            if element_type is not None:
+                material = self.materials.get(element_type.id())
+        return material
+
+    def get_colour(self, entity):
+        """Colour of the styled items of an element's representation, or None"""
+        colour = None
+        representation = getattr(entity, "Representation", None)
+        if representation:
+            for rep in representation.Representations:
+                for item in rep.Items:
+                    colour = self.colours.get(item.id(), colour)
+        return colour
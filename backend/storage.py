@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+
+from metrics import span
+
+# Size of the chunks read from uploads and written to disk
+CHUNK_SIZE = 1024 * 1024
+
+
+def _write_chunk(file_obj, hasher, chunk: bytes):
+    """Write a chunk and feed it to the hash (runs in a thread)"""
+    file_obj.write(chunk)
+    hasher.update(chunk)
+
+
+def hash_file(file_path: str):
+    """SHA-256 of a file on disk, read in chunks"""
+    hasher = hashlib.sha256()
+    with span("hash_file"), open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ContentStore:
+    """
+    Content-addressed storage of uploaded IFC files.
+
+    Uploads are streamed to a temporary file while their SHA-256 is computed,
+    then moved to <root>/<hash>/<filename>. Identical content is stored once.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.partial_dir = os.path.join(root, "partial")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+    async def write_stream(self, chunks):
+        """
+        Write an async iterator of byte chunks to a temporary file.
+
+        Returns:
+            Tuple of content hash, size in bytes and temporary path
+        """
+        loop = asyncio.get_running_loop()
+        temp_path = os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.part")
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, "wb") as f:
+                async for chunk in chunks:
+                    if not chunk:
+                        continue
+                    await loop.run_in_executor(None, _write_chunk, f, hasher, chunk)
+                    size += len(chunk)
+        except Exception:
+            self.discard(temp_path)
+            raise
+        return hasher.hexdigest(), size, temp_path
+
+    def find(self, content_hash: str):
+        """Path of a stored blob with this hash, or None"""
+        blob_dir = os.path.join(self.root, content_hash)
+        if os.path.isdir(blob_dir):
+            for name in os.listdir(blob_dir):
+                path = os.path.join(blob_dir, name)
+                if os.path.isfile(path):
+                    return path
+        return None
+
+    def commit(self, temp_path: str, content_hash: str, filename: str):
+        """Move a temporary file to its content address and return the final path"""
+        existing = self.find(content_hash)
+        if existing:
+            self.discard(temp_path)
+            return existing
+
+        blob_dir = os.path.join(self.root, content_hash)
+        os.makedirs(blob_dir, exist_ok=True)
+        file_path = os.path.join(blob_dir, os.path.basename(filename) or "model.ifc")
+        os.replace(temp_path, file_path)
+        return file_path
+
+    def discard(self, temp_path: str):
+        """Remove a temporary file if it exists"""
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+class ChunkedUpload:
+    """
+    A resumable upload assembled from chunks sent in order.
+
+    The partial data and a small JSON sidecar live in the partial directory,
+    so an upload can be resumed after a dropped connection or a restart.
+    """
+
+    def __init__(self, store: ContentStore, upload_id: str, filename: str, size: int = None):
+        self.store = store
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.data_path = os.path.join(store.partial_dir, f"{upload_id}.part")
+        self.meta_path = os.path.join(store.partial_dir, f"{upload_id}.json")
+        # Running hash of the bytes received by this process, rebuilt after a restart
+        self.hasher = hashlib.sha256()
+        self.hashed_offset = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.data_path)
+        except OSError:
+            return 0
+
+    def save_meta(self):
+        with open(self.meta_path, "w") as f:
+            json.dump({"upload_id": self.upload_id, "filename": self.filename, "size": self.size}, f)
+
+    def to_dict(self):
+        return {
+            "upload_id": self.upload_id,
+            "filename": self.filename,
+            "size": self.size,
+            "offset": self.offset,
+            "chunk_size": CHUNK_SIZE
+        }
+
+    async def append(self, chunks):
+        """Append an async iterator of byte chunks at the end of the upload"""
+        loop = asyncio.get_running_loop()
+        offset = self.offset
+        # Only keep hashing incrementally if the hash covers everything on disk
+        hasher = self.hasher if self.hashed_offset == offset else None
+        with open(self.data_path, "ab") as f:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                if self.size is not None and offset + len(chunk) > self.size:
+                    raise ValueError("Chunk exceeds the declared upload size")
+                if hasher:
+                    await loop.run_in_executor(None, _write_chunk, f, hasher, chunk)
+                    self.hashed_offset += len(chunk)
+                else:
+                    await loop.run_in_executor(None, f.write, chunk)
+                offset += len(chunk)
+
+    async def finish(self):
+        """
+        Hash the assembled upload and move it out of the partial directory.
+
+        Returns:
+            Tuple of content hash and temporary path of the complete file
+        """
+        if self.hashed_offset == self.offset:
+            content_hash = self.hasher.hexdigest()
+        else:
+            loop = asyncio.get_running_loop()
+            content_hash = await loop.run_in_executor(None, hash_file, self.data_path)
+
+        temp_path = os.path.join(self.store.tmp_dir, f"{self.upload_id}.part")
+        os.replace(self.data_path, temp_path)
+        self.store.discard(self.meta_path)
+        return content_hash, temp_path
+
+    def abort(self):
+        self.store.discard(self.data_path)
+        self.store.discard(self.meta_path)
+
+
+class UploadSessions:
+    """Registry of the resumable uploads in progress"""
+
+    def __init__(self, store: ContentStore):
+        self.store = store
+        self.sessions = {}
+
+    def create(self, filename: str, size: int = None):
+        upload_id = uuid.uuid4().hex
+        session = ChunkedUpload(self.store, upload_id, filename, size)
+        open(session.data_path, "wb").close()
+        session.save_meta()
+        self.sessions[upload_id] = session
+        return session
+
+    def get(self, upload_id: str):
+        """Get an upload, reloading it from its sidecar after a restart"""
+        session = self.sessions.get(upload_id)
+        if session is None:
+            meta_path = os.path.join(self.store.partial_dir, f"{os.path.basename(upload_id)}.json")
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                session = ChunkedUpload(self.store, meta["upload_id"], meta["filename"], meta.get("size"))
+                self.sessions[upload_id] = session
+        return session
+
+    def remove(self, upload_id: str):
+        self.sessions.pop(upload_id, None)
+
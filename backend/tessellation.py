@@ -0,0 +1,250 @@
+import json
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import uuid
+from array import array
+
+from metrics import record_span, record_throughput
+from progress import report_progress
+
+# Threads of the geometry iterator per tessellation
+TESSELLATION_THREADS = int(os.environ.get("SAPCAD_TESSELLATION_THREADS", str(multiprocessing.cpu_count())))
+
+# Bumped whenever the mesh layout changes, so cached meshes are rebuilt
+MESH_FORMAT_VERSION = 1
+MESH_MAGIC = b"SAPMESH1"
+
+# Geometry settings, created with the first tessellation. The geometry
+# engine is only imported by the processes that tessellate, the server
+# process just reads mesh files.
+_settings = None
+
+
+def geometry_engine():
+    """The ifcopenshell.geom module and the tessellation settings"""
+    global _settings
+    import ifcopenshell.geom
+
+    if _settings is None:
+        _settings = ifcopenshell.geom.settings()
+        _settings.set(_settings.USE_WORLD_COORDS, True)
+    return ifcopenshell.geom, _settings
+
+
+def _diffuse(material):
+    """Diffuse colour of a shape material as [r, g, b, a], or None"""
+    diffuse = getattr(material, "diffuse", None)
+    if diffuse is None:
+        return None
+    # Newer ifcopenshell versions wrap the colour in an object
+    rgb = [diffuse.r(), diffuse.g(), diffuse.b()] if hasattr(diffuse, "r") else list(diffuse)[:3]
+    transparency = getattr(material, "transparency", None) or 0.0
+    if transparency != transparency:  # NaN when not set
+        transparency = 0.0
+    return [round(c, 4) for c in rgb] + [round(1.0 - transparency, 4)]
+
+
+def write_mesh(output_path: str, header: dict, positions: array, indices: array):
+    """
+    Write a mesh file.
+
+    Layout: the 8 byte magic, the uint32 length of a JSON header (padded to
+    4 bytes), the header, float32 xyz positions and uint32 triangle indices,
+    all little endian. The header lists every element with its range in the
+    position and index buffers.
+    """
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 4)
+    if positions.itemsize != 4 or indices.itemsize != 4:
+        raise ValueError("Mesh buffers must hold 4 byte values")
+    if struct.pack("=I", 1) != struct.pack("<I", 1):
+        positions.byteswap()
+        indices.byteswap()
+
+    # Written next to the target and moved, so readers never see a partial mesh
+    temp_path = f"{output_path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(MESH_MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        positions.tofile(f)
+        indices.tofile(f)
+    os.replace(temp_path, output_path)
+
+
+def read_mesh_header(mesh_path: str):
+    """Read the JSON header of a mesh file"""
+    with open(mesh_path, "rb") as f:
+        if f.read(8) != MESH_MAGIC:
+            raise ValueError("Not a mesh file")
+        (length,) = struct.unpack("<I", f.read(4))
+        return json.loads(f.read(length))
+
+
+def tessellate_model(model, threads: int = None):
+    """
+    Triangulate every product of a model with the multi-threaded geometry iterator.
+
+    Returns:
+        Tuple of the element list, position buffer and index buffer
+    """
+    positions = array("f")
+    indices = array("I")
+    elements = []
+
+    geom, settings = geometry_engine()
+    iterator = geom.iterator(settings, model, threads or TESSELLATION_THREADS)
+    if not iterator.initialize():
+        # Nothing with a representation to tessellate
+        return elements, positions, indices
+
+    while True:
+        shape = iterator.get()
+        geometry = shape.geometry
+        verts = geometry.verts
+        faces = geometry.faces
+        if faces:
+            vertex_offset = len(positions) // 3
+            index_offset = len(indices)
+            positions.extend(verts)
+            # Indices address the shared position buffer
+            indices.extend(i + vertex_offset for i in faces)
+
+            materials = list(getattr(geometry, "materials", None) or [])
+            element = {
+                "id": shape.id,
+                "guid": shape.guid,
+                "type": shape.type,
+                "vertex_offset": vertex_offset,
+                "vertex_count": len(verts) // 3,
+                "index_offset": index_offset,
+                "index_count": len(faces)
+            }
+            color = _diffuse(materials[0]) if materials else None
+            if color:
+                element["color"] = color
+            elements.append(element)
+
+        # The iterator knows the share of the representations it went through
+        report_progress("tessellating", iterator.progress() / 100)
+        if not iterator.next():
+            break
+
+    return elements, positions, indices
+
+
+def tessellate_elements(model, entities):
+    """
+    Triangulate only some elements of a model, e.g. those whose shape an edit changed.
+
+    Returns:
+        Dictionary of GlobalId -> positions and indices of the element
+    """
+    geometry = {}
+    if not entities:
+        return geometry
+    geom, settings = geometry_engine()
+    iterator = geom.iterator(settings, model, TESSELLATION_THREADS, include=list(entities))
+    if not iterator.initialize():
+        return geometry
+    while True:
+        shape = iterator.get()
+        geometry[shape.guid] = {
+            "id": shape.id,
+            "positions": [round(v, 6) for v in shape.geometry.verts],
+            "indices": list(shape.geometry.faces)
+        }
+        if not iterator.next():
+            break
+    return geometry
+
+
+def tessellate_ifc_file(file_path: str, output_path: str, file_id: str = None, content_hash: str = None):
+    """
+    Tessellate an IFC file and write its mesh to output_path.
+
+    Returns:
+        Dictionary with the mesh statistics, or an error
+    """
+    import ifcopenshell
+    from model_cache import model_cache
+
+    try:
+        start = time.perf_counter()
+        if file_id:
+            # Hold the model's lock, other sessions may use the same model
+            with model_cache.open_model(file_id, file_path) as model:
+                elements, positions, indices = tessellate_model(model)
+        else:
+            elements, positions, indices = tessellate_model(ifcopenshell.open(file_path))
+        tessellation_ms = (time.perf_counter() - start) * 1000
+        record_span("tessellate", tessellation_ms)
+        record_throughput("tessellate", len(elements), tessellation_ms / 1000)
+
+        stats = {
+            "format_version": MESH_FORMAT_VERSION,
+            "content_hash": content_hash,
+            "element_count": len(elements),
+            "vertex_count": len(positions) // 3,
+            "triangle_count": len(indices) // 3,
+            "tessellation_ms": round(tessellation_ms, 3),
+            "threads": TESSELLATION_THREADS
+        }
+        write_mesh(output_path, {**stats, "elements": elements}, positions, indices)
+        stats["mesh_size"] = os.path.getsize(output_path)
+        return stats
+    except Exception as e:
+        return {"error": str(e)}
+
+
+class MeshCache:
+    """
+    Meshes on disk by content hash of the IFC file they were tessellated from.
+    Identical content, e.g. a re-upload, is only tessellated once.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.tessellations = 0
+        self.tessellation_ms = 0.0
+        self.triangles = 0
+
+    def path(self, content_hash: str):
+        return os.path.join(self.root, f"{content_hash}.v{MESH_FORMAT_VERSION}.mesh")
+
+    def lookup(self, content_hash: str):
+        """Path of the cached mesh of this content, or None; counts the hit or miss"""
+        path = self.path(content_hash)
+        found = os.path.exists(path)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return path if found else None
+
+    def record(self, stats: dict):
+        """Count a finished tessellation"""
+        with self._lock:
+            self.tessellations += 1
+            self.tessellation_ms += stats.get("tessellation_ms", 0)
+            self.triangles += stats.get("triangle_count", 0)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "tessellations": self.tessellations,
+                "tessellation_ms_total": round(self.tessellation_ms, 3),
+                "triangles_total": self.triangles
+            }
@@ -0,0 +1,78 @@
+import os
+import sys
+
+import ifcopenshell
+import ifcopenshell.api
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from entity_index import EntityIndex, SelectorError
+
+# Selector -> terms as (head, filters)
+PARSED = [
+    ("IfcWall", [("IfcWall", [])]),
+    ("#123", [("#123", [])]),
+    ("*[guid=2O2Fr$t4X7Zf8NOew3FLOH]", [("*", [("guid", "=", "2O2Fr$t4X7Zf8NOew3FLOH")])]),
+    ("IfcWall, IfcDoor", [("IfcWall", []), ("IfcDoor", [])]),
+    ('IfcDoor[storey="Level 2"][Pset_DoorCommon.FireRating=EI30]',
+     [("IfcDoor", [("storey", "=", "Level 2"), ("pset_doorcommon.firerating", "=", "EI30")])]),
+    ('IfcWall[name~="EXT-*"]', [("IfcWall", [("name", "~=", "EXT-*")])]),
+    ("IfcWall[ObjectType != 'Partition']", [("IfcWall", [("objecttype", "!=", "Partition")])]),
+    ("[*.LoadBearing=true]", [(None, [("*.loadbearing", "=", "true")])]),
+    # Commas inside values don't separate terms
+    ('IfcWall[material="Concrete, Cast-in-Place gray"]',
+     [("IfcWall", [("material", "=", "Concrete, Cast-in-Place gray")])]),
+    ("IfcWall[name='a,b'],#5", [("IfcWall", [("name", "=", "a,b")]), ("#5", [])]),
+    ("IfcWall[name=a,b]", [("IfcWall", [("name", "=", "a,b")])]),
+]
+
+INVALID = [
+    "",
+    "IfcWall,",
+    ",IfcWall",
+    "IfcWall,,IfcDoor",
+    "IfcWall IfcDoor",
+    'IfcWall[name="a,b"',
+    "IfcWall[name]",
+    "IfcWall]",
+    '[name="x"]junk',
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    model = ifcopenshell.file(schema="IFC4")
+    ifcopenshell.api.run("root.create_entity", model, ifc_class="IfcProject")
+    for name, material in (("W1", "Concrete, Cast-in-Place gray"), ("W2", "Concrete"), ("W3", None)):
+        wall = ifcopenshell.api.run("root.create_entity", model, ifc_class="IfcWall", name=name)
+        if material:
+            material = ifcopenshell.api.run("material.add_material", model, name=material)
+            ifcopenshell.api.run("material.assign_material", model, products=[wall], material=material)
+    return EntityIndex(model)
+
+
+@pytest.mark.parametrize("selector,terms", PARSED)
+def test_parse(index, selector, terms):
+    assert index.parse(selector) == terms
+
+
+@pytest.mark.parametrize("selector", INVALID)
+def test_invalid(index, selector):
+    with pytest.raises(SelectorError):
+        index.parse(selector)
+
+
+# Selector -> names of the selected walls
+SELECTED = [
+    ("IfcWall", ["W1", "W2", "W3"]),
+    ('IfcWall[material="Concrete, Cast-in-Place gray"]', ["W1"]),
+    ("IfcWall[material=concrete]", ["W2"]),
+    ('IfcWall[material~="Concrete*"], IfcWall[name=W3]', ["W1", "W2", "W3"]),
+    ("IfcWall[name!=W1][name!=W2]", ["W3"]),
+]
+
+
+@pytest.mark.parametrize("selector,names", SELECTED)
+def test_select(index, selector, names):
+    assert sorted(index.names[i] for i in index.select(selector)) == names
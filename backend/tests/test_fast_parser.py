@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fast_parser import FastPathParser
+
+METADATA = {"MaterialNames": ["Concrete", "Oak"]}
+
+# Instruction -> (entity_type, entity_ids, property, new_value, selector)
+ACCEPTED = [
+    ("make all walls red", ("IfcWall", ["all"], "color", "red", None)),
+    ("paint the doors grey", ("IfcDoor", ["all"], "color", "gray", None)),
+    ("set the color of IfcSlab to blue", ("IfcSlab", ["all"], "color", "blue", None)),
+    ("change walls to concrete", ("IfcWall", ["all"], "material", "Concrete", None)),
+    ("set material of IfcSlab to oak", ("IfcSlab", ["all"], "material", "Oak", None)),
+    ("rename door 1234 to D-01", ("IfcDoor", ["1234"], "name", "D-01", None)),
+    ("rename doors #12, 13 and 14 to D", ("IfcDoor", ["12", "13", "14"], "name", "D", None)),
+    ("rename all walls to Outer Wall", ("IfcWall", ["all"], "name", "Outer Wall", None)),
+    ("set the name of every window to W", ("IfcWindow", ["all"], "name", "W", None)),
+    ("rename `IfcDoor[material=Oak]` to Oak door", ("IfcDoor", ["all"], "name", "Oak door", "IfcDoor[material=Oak]")),
+    ("make walls on level 2 red",
+     ("IfcWall", ["all"], "color", "red", 'IfcWall[storey="2"],IfcWall[storey="Level 2"]')),
+]
+
+# Instructions left to the LLM
+REJECTED = [
+    # Names are per instance, a rename must say which entities
+    "rename wall to Outer Wall",
+    "rename walls to Outer Wall",
+    "change the name of the door to D-01",
+    # Unknown type, color or material
+    "make all gizmos red",
+    "make walls sparkly",
+    "what is the color of the walls?",
+]
+
+
+@pytest.mark.parametrize("instruction,expected", ACCEPTED)
+def test_accepted(instruction, expected):
+    result = FastPathParser().parse(instruction, METADATA)
+    assert result is not None
+    entity_type, entity_ids, prop, new_value, selector = expected
+    assert result["entity_type"] == entity_type
+    assert result["entity_ids"] == entity_ids
+    assert result["property"] == prop
+    assert result["new_value"] == new_value
+    assert result.get("selector") == selector
+    assert result["parser"] == "fast_path"
+
+
+@pytest.mark.parametrize("instruction", REJECTED)
+def test_rejected(instruction):
+    assert FastPathParser().parse(instruction, METADATA) is None
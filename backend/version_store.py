@@ -0,0 +1,697 @@
+import asyncio
+import gzip
+import hashlib
+import io
+import os
+import time
+import uuid
+import zipfile
+from contextlib import contextmanager
+
+from metrics import span
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Seconds between two garbage collection passes of the server, 0 disables them
+GC_INTERVAL_SECONDS = float(os.environ.get("SAPCAD_VERSION_GC_SECONDS", "600"))
+
+# Seconds a modified file is unused before it is packed into the version store
+PACK_AFTER_SECONDS = float(os.environ.get("SAPCAD_VERSION_PACK_AFTER", "900"))
+
+# Seconds a plain copy of a packed version stays on disk after its last use
+MATERIALIZED_TTL_SECONDS = float(os.environ.get("SAPCAD_MATERIALIZED_TTL", "900"))
+
+# Deltas applied at most to rebuild a version, beyond that a full snapshot is stored
+DELTA_CHAIN_MAX = int(os.environ.get("SAPCAD_DELTA_CHAIN_MAX", "8"))
+
+# A delta whose changed entities exceed this share of the file is stored as a full snapshot
+DELTA_MAX_RATIO = 0.5
+
+# Retention: the newest versions of every lineage are kept, older ones as long
+# as they were used within the retention time. The last version of every
+# branch and the versions of open editing sessions are never removed.
+KEEP_VERSIONS = int(os.environ.get("SAPCAD_KEEP_VERSIONS", "20"))
+RETENTION_SECONDS = float(os.environ.get("SAPCAD_VERSION_RETENTION_HOURS", "72")) * 3600
+
+ZSTD_LEVEL = int(os.environ.get("SAPCAD_ZSTD_LEVEL", "10"))
+
+# Blobs are compressed with zstd when it is installed. Without it, full
+# snapshots are stored as ifcZIP, which other IFC tools open as is, and
+# deltas with gzip.
+CODEC = "zstd" if zstandard else "zip"
+
+DELTA_MAGIC = b"SAPDELTA1\n"
+
+# Size of the chunks copied between files
+CHUNK_SIZE = 1024 * 1024
+
+
+class VersionUnavailable(Exception):
+    """The content of a version was removed by the retention policy, or is missing"""
+
+
+class _NoDelta(Exception):
+    """A file can't be stored as a delta, or the delta would not be worth it"""
+
+
+# Blobs
+
+def _blob_name(content_hash: str, base_hash: str = None):
+    if base_hash is None:
+        return f"{content_hash}.ifc.zst" if zstandard else f"{content_hash}.ifczip"
+    return f"{content_hash}.{base_hash[:16]}.delta.{'zst' if zstandard else 'gz'}"
+
+
+@contextmanager
+def _write_blob(blob_path: str):
+    """Writable stream compressing into a blob, which only appears once it is complete"""
+    temp_path = f"{blob_path}.{uuid.uuid4().hex[:8]}.part"
+    try:
+        with open(temp_path, "wb") as raw:
+            if blob_path.endswith(".zst"):
+                compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, write_checksum=True)
+                with compressor.stream_writer(raw, closefd=False) as out:
+                    yield out
+            elif blob_path.endswith(".ifczip"):
+                with zipfile.ZipFile(raw, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+                    with archive.open("model.ifc", "w", force_zip64=True) as out:
+                        yield out
+            else:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as out:
+                    yield out
+        os.replace(temp_path, blob_path)
+    finally:
+        _remove(temp_path)
+
+
+@contextmanager
+def _read_blob(blob_path: str):
+    """Buffered stream of the decompressed content of a blob"""
+    with open(blob_path, "rb") as raw:
+        if blob_path.endswith(".zst"):
+            if zstandard is None:
+                raise VersionUnavailable(f"{os.path.basename(blob_path)} needs the zstandard package")
+            with zstandard.ZstdDecompressor().stream_reader(raw, closefd=False) as reader:
+                yield io.BufferedReader(reader, CHUNK_SIZE)
+        elif blob_path.endswith(".ifczip"):
+            with zipfile.ZipFile(raw) as archive, archive.open(archive.namelist()[0]) as reader:
+                yield reader
+        else:
+            with gzip.GzipFile(fileobj=raw, mode="rb") as reader:
+                yield reader
+
+
+def _remove(path: str):
+    """Delete a file, returning the bytes freed"""
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError:
+        return 0
+
+
+def _size(path: str):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class _HashingWriter:
+    """Writes to a file, or nowhere, while hashing what is written"""
+
+    def __init__(self, out=None):
+        self.out = out
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.hasher.update(data)
+        self.size += len(data)
+        if self.out is not None:
+            self.out.write(data)
+
+
+# Entity deltas. IFC files are STEP files with one statement per entity
+# instance. A delta stores the header and trailer of the new file, the
+# instances that were added or changed and the ids of the removed ones.
+# Both files are read in id order, as IfcOpenShell writes them, so a
+# delta is computed and applied in one streaming pass over the two files.
+
+def _statements(stream):
+    """
+    Statements of a STEP file as (section, entity id, bytes), the section
+    being "H" (header), "E" (entity instance) or "T" (trailer). The bytes
+    are exactly those of the file, joined they give the file back.
+    """
+    pending = []
+    section = "H"
+    for line in stream:
+        pending.append(line)
+        if not line.rstrip().endswith(b";"):
+            continue
+        text = b"".join(pending)
+        pending = []
+        stripped = text.lstrip()
+        if stripped.startswith(b"#"):
+            if section == "T":
+                raise _NoDelta("Entity instances after the end of the data section")
+            section = "E"
+            yield section, int(stripped[1:stripped.index(b"=")]), text
+        else:
+            if section == "E":
+                section = "T"
+            yield section, None, text
+    if pending:
+        yield "H" if section == "H" else "T", None, b"".join(pending)
+
+
+def _entities(stream):
+    """(id, bytes) of the entity instances of a STEP file, checking they are in id order"""
+    last_id = -1
+    for section, entity_id, text in _statements(stream):
+        if section != "E":
+            continue
+        if entity_id <= last_id:
+            raise _NoDelta("Entity instances are not in id order")
+        last_id = entity_id
+        yield entity_id, text
+
+
+def _write_record(out, op: bytes, entity_id: int, payload: bytes):
+    out.write(b"%s %d %d\n" % (op, entity_id, len(payload)))
+    out.write(payload)
+
+
+def _write_delta(out, base_stream, stream, max_changed: int):
+    """
+    Write the delta turning the base file into the new file.
+
+    Raises:
+        _NoDelta: If the files are not in id order or the changed
+            entities add up to more than max_changed bytes
+    """
+    out.write(DELTA_MAGIC)
+    base = _entities(base_stream)
+    base_entity = next(base, None)
+    changed = 0
+    last_id = -1
+    for section, entity_id, text in _statements(stream):
+        if section != "E":
+            _write_record(out, section.encode(), 0, text)
+            continue
+        if entity_id <= last_id:
+            raise _NoDelta("Entity instances are not in id order")
+        last_id = entity_id
+
+        while base_entity is not None and base_entity[0] < entity_id:
+            _write_record(out, b"-", base_entity[0], b"")
+            base_entity = next(base, None)
+        if base_entity is not None and base_entity[0] == entity_id:
+            unchanged = base_entity[1] == text
+            base_entity = next(base, None)
+            if unchanged:
+                continue
+
+        _write_record(out, b"+", entity_id, text)
+        changed += len(text)
+        if changed > max_changed:
+            raise _NoDelta("Delta is larger than a snapshot")
+
+    while base_entity is not None:
+        _write_record(out, b"-", base_entity[0], b"")
+        base_entity = next(base, None)
+
+
+def _apply_delta(delta_stream, base_stream, out):
+    """Write the file a delta was computed for, from the delta and its base file"""
+    if delta_stream.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise ValueError("Not a delta blob")
+    trailer = []
+
+    def records():
+        # The header comes first and is written as it is read, the trailer last
+        while True:
+            line = delta_stream.readline()
+            if not line:
+                return
+            op, entity_id, size = line.split()
+            payload = delta_stream.read(int(size))
+            if op == b"H":
+                out.write(payload)
+            elif op == b"T":
+                trailer.append(payload)
+            else:
+                yield op, int(entity_id), payload
+
+    pending = records()
+    record = next(pending, None)
+    for section, entity_id, text in _statements(base_stream):
+        if section != "E":
+            continue
+        while record is not None and record[1] < entity_id:
+            out.write(record[2])
+            record = next(pending, None)
+        if record is not None and record[1] == entity_id:
+            if record[0] == b"+":
+                out.write(record[2])
+            record = next(pending, None)
+            continue
+        out.write(text)
+
+    while record is not None:
+        out.write(record[2])
+        record = next(pending, None)
+    for text in trailer:
+        out.write(text)
+
+
+# Functions run in the IFC worker processes
+
+def pack_version(file_path: str, content_hash: str, blob_dir: str, base_path: str = None, base_hash: str = None):
+    """
+    Store a modified file in the version store: as a delta against the file
+    it derives from if base_path is given and the delta is small, as a
+    compressed snapshot otherwise. The plain file is left in place.
+
+    Returns:
+        Dictionary with the state ("delta" or "full"), the blob path, the
+        plain and stored sizes, or an error
+    """
+    try:
+        start = time.perf_counter()
+        os.makedirs(blob_dir, exist_ok=True)
+        plain_size = os.path.getsize(file_path)
+        state = None
+
+        if base_path:
+            blob_path = os.path.join(blob_dir, _blob_name(content_hash, base_hash or "base"))
+            try:
+                with span("version_delta"):
+                    with _write_blob(blob_path) as out, open(base_path, "rb") as base, open(file_path, "rb") as f:
+                        _write_delta(out, base, f, int(plain_size * DELTA_MAX_RATIO))
+                    # The plain file is deleted later, make sure the delta gives it back
+                    check = _HashingWriter()
+                    with _read_blob(blob_path) as delta, open(base_path, "rb") as base:
+                        _apply_delta(delta, base, check)
+                if check.hasher.hexdigest() != content_hash:
+                    _remove(blob_path)
+                    raise _NoDelta("Delta does not reproduce the file")
+                state = "delta"
+            except (_NoDelta, ValueError):
+                state = None
+
+        if state is None:
+            state = "full"
+            blob_path = os.path.join(blob_dir, _blob_name(content_hash))
+            # Identical content is stored once
+            if not os.path.exists(blob_path):
+                with span("version_compress"), _write_blob(blob_path) as out, open(file_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        out.write(chunk)
+
+        return {
+            "state": state,
+            "blob_path": blob_path,
+            "plain_size": plain_size,
+            "stored_size": os.path.getsize(blob_path),
+            "pack_ms": round((time.perf_counter() - start) * 1000, 3)
+        }
+    except Exception as e:
+        return {"error": f"Error packing {os.path.basename(file_path)}: {str(e)}"}
+
+
+def materialize_version(steps: list):
+    """
+    Write the plain files of packed versions back to their paths.
+
+    Args:
+        steps: Versions to write in order, each a dictionary with the
+            file_path, blob_path, content_hash and, for a delta, the
+            base_path, which an earlier step or the disk provides
+
+    Returns:
+        Dictionary with the number of files written and the time taken, or an error
+    """
+    try:
+        start = time.perf_counter()
+        written = 0
+        with span("version_materialize"):
+            for step in steps:
+                file_path = step["file_path"]
+                if os.path.exists(file_path):
+                    continue
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                temp_path = f"{file_path}.{uuid.uuid4().hex[:8]}.part"
+                try:
+                    with open(temp_path, "wb") as f, _read_blob(step["blob_path"]) as blob:
+                        out = _HashingWriter(f)
+                        if step.get("base_path"):
+                            with open(step["base_path"], "rb") as base:
+                                _apply_delta(blob, base, out)
+                        else:
+                            for chunk in iter(lambda: blob.read(CHUNK_SIZE), b""):
+                                out.write(chunk)
+                    if step.get("content_hash") and out.hasher.hexdigest() != step["content_hash"]:
+                        return {"error": f"Content of {os.path.basename(file_path)} does not match its hash"}
+                    os.replace(temp_path, file_path)
+                finally:
+                    _remove(temp_path)
+                written += 1
+        return {"written": written, "materialize_ms": round((time.perf_counter() - start) * 1000, 3)}
+    except Exception as e:
+        return {"error": f"Error materializing version: {str(e)}"}
+
+
+class VersionStore:
+    """
+    Storage of the modified versions of the uploaded files.
+
+    Every edit writes a full model. Once a modified file has not been used
+    for a while it is packed: stored as a delta of the entity instances
+    changed since its parent file, or as a compressed snapshot when the
+    delta chain gets long or the delta would be large. Packed versions are
+    materialized back to their path when they are used, and the plain copy
+    is deleted again when it has not been used for MATERIALIZED_TTL_SECONDS.
+    The retention policy removes the content of old intermediate versions.
+    Their file records stay as tombstones, so lineages stay intact.
+
+    Uploads are content-addressed already and always kept as they are.
+    Packing and materializing run in the IFC worker of the lineage through
+    run (jobs.run_ifc), the storage state is kept in the registry.
+    """
+
+    def __init__(self, registry, root: str, run, lineage_root):
+        self.registry = registry
+        self.root = root
+        self.run = run
+        self.lineage_root = lineage_root
+        os.makedirs(root, exist_ok=True)
+        self._materializing = {}
+        self._collecting = asyncio.Lock()
+        self.counters = {"materialized": 0, "packed": 0, "pruned": 0, "evicted": 0, "reclaimed_bytes": 0}
+        self.last_collection = None
+
+    async def ensure(self, file_id: str, touch: bool = True):
+        """
+        Path of the content of a file, materialized first if it was packed.
+
+        Raises:
+            VersionUnavailable: If the retention policy removed the content
+        """
+        file_path = self.registry[file_id]["file_path"]
+        version = self.registry.get_version(file_id)
+        if version is None:
+            return file_path
+        if touch:
+            self.registry.touch_version(file_id)
+        if version["state"] == "pruned":
+            raise VersionUnavailable(f"Version {file_id} was removed by the retention policy")
+        if os.path.exists(file_path):
+            return file_path
+
+        # Requests for the same version wait for one materialization
+        task = self._materializing.get(file_id)
+        if task is None:
+            task = self._materializing[file_id] = asyncio.ensure_future(self._materialize(file_id))
+            task.add_done_callback(lambda _: self._materializing.pop(file_id, None))
+        await asyncio.shield(task)
+        return file_path
+
+    async def _materialize(self, file_id: str):
+        # Walk down the delta chain to a version whose plain file is on disk
+        steps = []
+        current = file_id
+        while not os.path.exists(self.registry[current]["file_path"]):
+            version = self.registry.get_version(current)
+            if version is None or version["state"] not in ("full", "delta"):
+                raise VersionUnavailable(f"Content of version {current} is missing")
+            record = self.registry[current]
+            step = {
+                "file_path": record["file_path"],
+                "blob_path": version["blob_path"],
+                "content_hash": record.get("content_hash")
+            }
+            steps.append(step)
+            if version["state"] == "full":
+                break
+            current = version["base_file_id"]
+            step["base_path"] = self.registry[current]["file_path"]
+
+        result = await self.run(materialize_version, steps[::-1], key=self.lineage_root(file_id))
+        if "error" in result:
+            raise VersionUnavailable(result["error"])
+        self.counters["materialized"] += result["written"]
+
+    def delta_depth(self, file_id: str):
+        """Number of deltas applied to rebuild a version"""
+        depth = 0
+        version = self.registry.get_version(file_id)
+        while version is not None and version["state"] == "delta" and depth <= DELTA_CHAIN_MAX:
+            depth += 1
+            version = self.registry.get_version(version["base_file_id"])
+        return depth
+
+    def _delta_base(self, file_id: str):
+        """Closest ancestor of a version whose content is still stored, or None"""
+        base_id = self.registry[file_id].get("parent_file_id")
+        while base_id and base_id in self.registry:
+            if (self.registry.get_version(base_id) or {}).get("state") != "pruned":
+                return base_id
+            base_id = self.registry[base_id].get("parent_file_id")
+        return None
+
+    async def _pack(self, file_id: str, base_id: str = None):
+        """Pack the content of a version, as a delta against base_id if given"""
+        record = self.registry[file_id]
+        file_path = await self.ensure(file_id, touch=False)
+        base_path = await self.ensure(base_id, touch=False) if base_id else None
+        content_hash = record.get("content_hash") or file_id
+        result = await self.run(
+            pack_version, file_path, content_hash, self.root, base_path,
+            self.registry[base_id].get("content_hash") if base_id else None
+        )
+        if "error" in result:
+            raise RuntimeError(result["error"])
+
+        old_blob = (self.registry.get_version(file_id) or {}).get("blob_path")
+        self.registry.update_version(
+            file_id, state=result["state"], base_file_id=base_id if result["state"] == "delta" else None,
+            blob_path=result["blob_path"], plain_size=result["plain_size"], stored_size=result["stored_size"]
+        )
+        if old_blob and old_blob != result["blob_path"]:
+            self._release_blob(old_blob)
+        return result
+
+    def _release_blob(self, blob_path: str):
+        """Delete a blob no version is stored in anymore"""
+        if not self.registry.blob_users(blob_path):
+            self.counters["reclaimed_bytes"] += _remove(blob_path)
+
+    async def _prune(self, file_id: str):
+        """Remove the content of a version, keeping its file record as a tombstone"""
+        version = self.registry.get_version(file_id)
+        # Versions stored as deltas against it are rebased on its own base first
+        base_id = version["base_file_id"] if version["state"] == "delta" else None
+        for child in self.registry.list_versions():
+            if child["base_file_id"] == file_id and child["state"] == "delta":
+                await self._pack(child["file_id"], base_id)
+
+        self.registry.update_version(file_id, state="pruned", base_file_id=None, blob_path=None, stored_size=0)
+        if version["blob_path"]:
+            self._release_blob(version["blob_path"])
+        self.counters["reclaimed_bytes"] += _remove(self.registry[file_id]["file_path"])
+        self.registry.delete_entities(file_id)
+        self.registry.forget_content(file_id)
+        self.counters["pruned"] += 1
+
+    def _retention(self, pinned):
+        """IDs of the versions the retention policy no longer keeps"""
+        now = time.time()
+        children = set()
+        for file_id in self.registry:
+            parent_id = self.registry[file_id].get("parent_file_id")
+            if parent_id:
+                children.add(parent_id)
+
+        lineages = {}
+        for version in self.registry.list_versions():
+            if version["state"] != "pruned":
+                lineages.setdefault(self.lineage_root(version["file_id"]), []).append(version)
+        expired = []
+        for versions in lineages.values():
+            # Newest first, versions are listed in the order they were registered
+            for version in versions[::-1][KEEP_VERSIONS:]:
+                # Only intermediate versions go, the last version of a branch stays
+                if version["file_id"] in pinned or version["file_id"] not in children:
+                    continue
+                if now - version["accessed_at"] >= RETENTION_SECONDS:
+                    expired.append(version["file_id"])
+        return expired
+
+    @contextmanager
+    def _lock_file(self):
+        """Hold the collection lock shared by the server workers, yields False if another one holds it"""
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(self.root, "gc.lock"), "w") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    async def collect(self, pinned=()):
+        """
+        One garbage collection pass: remove the versions the retention
+        policy no longer keeps, pack the plain files not used for
+        PACK_AFTER_SECONDS, and delete the plain copies of packed versions
+        not used for MATERIALIZED_TTL_SECONDS.
+
+        Args:
+            pinned: IDs of versions in use that are never removed
+
+        Returns:
+            Dictionary with what the pass did
+        """
+        async with self._collecting:
+            with self._lock_file() as locked:
+                if not locked:
+                    return {"status": "skipped", "reason": "Another server worker is collecting"}
+                return await self._collect(set(pinned))
+
+    async def _collect(self, pinned: set):
+        start = time.perf_counter()
+        before = dict(self.counters)
+        errors = []
+        self.registry.track_versions()
+
+        for file_id in self._retention(pinned):
+            try:
+                await self._prune(file_id)
+            except Exception as e:
+                errors.append(f"{file_id}: {str(e)}")
+
+        # Oldest first, so a version is packed before the versions derived from it
+        now = time.time()
+        for version in self.registry.list_versions():
+            if version["state"] != "plain" or now - version["accessed_at"] < PACK_AFTER_SECONDS:
+                continue
+            file_id = version["file_id"]
+            if not os.path.exists(self.registry[file_id]["file_path"]):
+                continue
+            base_id = self._delta_base(file_id)
+            if base_id and self.delta_depth(base_id) >= DELTA_CHAIN_MAX:
+                base_id = None
+            try:
+                await self._pack(file_id, base_id)
+                self.counters["packed"] += 1
+            except Exception as e:
+                errors.append(f"{file_id}: {str(e)}")
+
+        # Plain copies are deleted last, the packing above reads them as bases
+        now = time.time()
+        for version in self.registry.list_versions():
+            if version["state"] in ("full", "delta") and now - version["accessed_at"] >= MATERIALIZED_TTL_SECONDS:
+                freed = _remove(self.registry[version["file_id"]]["file_path"])
+                if freed:
+                    self.counters["evicted"] += 1
+                    self.counters["reclaimed_bytes"] += freed
+
+        self.last_collection = {
+            "status": "completed",
+            "finished_at": time.time(),
+            "collect_ms": round((time.perf_counter() - start) * 1000, 3),
+            **{key: self.counters[key] - before[key] for key in ("packed", "pruned", "evicted", "reclaimed_bytes")},
+            "errors": errors
+        }
+        return self.last_collection
+
+    def report(self, lineage_id: str = None):
+        """
+        Storage used per lineage chain: the plain files on disk, the blobs
+        of packed versions and their materialized copies, against the
+        logical size of all versions stored as plain files.
+
+        Args:
+            lineage_id: ID of the upload of the only lineage to report
+        """
+        versions = {v["file_id"]: v for v in self.registry.list_versions()}
+        lineages = {}
+        for file_id in self.registry:
+            root = self.lineage_root(file_id)
+            if lineage_id and root != lineage_id:
+                continue
+            record = self.registry[file_id]
+            version = versions.get(file_id) or {}
+            state = version.get("state", "plain")
+            on_disk = _size(record["file_path"])
+            lineage = lineages.setdefault(root, {"root_file_id": root, "versions": [], "blobs": {}})
+            lineage["versions"].append({
+                "file_id": file_id,
+                "parent_file_id": record.get("parent_file_id"),
+                "state": state,
+                "base_file_id": version.get("base_file_id"),
+                "delta_depth": self.delta_depth(file_id) if state == "delta" else 0,
+                "size": version.get("plain_size") or on_disk or 0,
+                "stored_size": version.get("stored_size") or 0,
+                "on_disk": on_disk or 0,
+                "materialized": state in ("full", "delta") and on_disk is not None
+            })
+            if version.get("blob_path"):
+                lineage["blobs"][version["blob_path"]] = version.get("stored_size") or 0
+
+        reports = []
+        for lineage in lineages.values():
+            entries = lineage.pop("versions")
+            blobs = lineage.pop("blobs")
+            plain_bytes = sum(e["on_disk"] for e in entries if e["state"] == "plain")
+            materialized_bytes = sum(e["on_disk"] for e in entries if e["materialized"])
+            # Identical content shares a blob, it is counted once
+            packed_bytes = sum(blobs.values())
+            stored_bytes = plain_bytes + packed_bytes + materialized_bytes
+            logical_bytes = sum(e["size"] for e in entries if e["state"] != "pruned")
+            reports.append({
+                **lineage,
+                "version_count": len(entries),
+                "states": {state: sum(1 for e in entries if e["state"] == state)
+                           for state in ("plain", "full", "delta", "pruned")},
+                "logical_bytes": logical_bytes,
+                "stored_bytes": stored_bytes,
+                "plain_bytes": plain_bytes,
+                "packed_bytes": packed_bytes,
+                "materialized_bytes": materialized_bytes,
+                "saved_ratio": round(1 - stored_bytes / logical_bytes, 4) if logical_bytes else 0.0,
+                "versions": entries
+            })
+        return reports
+
+    def stats(self):
+        return {
+            "codec": CODEC,
+            **self.counters,
+            "materializing": len(self._materializing),
+            "last_collection": self.last_collection,
+            "policy": {
+                "keep_versions": KEEP_VERSIONS,
+                "retention_hours": RETENTION_SECONDS / 3600,
+                "pack_after_seconds": PACK_AFTER_SECONDS,
+                "materialized_ttl_seconds": MATERIALIZED_TTL_SECONDS,
+                "delta_chain_max": DELTA_CHAIN_MAX,
+                "gc_interval_seconds": GC_INTERVAL_SECONDS
+            }
+        }
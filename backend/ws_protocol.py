@@ -0,0 +1,95 @@
+import json
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+import metrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# WebSocket subprotocols of the message framing, preferred first. MessagePack
+# frames are binary and smaller and faster to decode for large payloads
+# (entity lists, deltas with geometry); they need the msgpack package.
+# Clients that offer no subprotocol get JSON text frames.
+MSGPACK_PROTOCOL = "sapcad.msgpack"
+JSON_PROTOCOL = "sapcad.json"
+PROTOCOLS = (MSGPACK_PROTOCOL, JSON_PROTOCOL) if msgpack else (JSON_PROTOCOL,)
+
+SENT_BYTES = metrics.registry.counter(
+    "sapcad_websocket_sent_bytes_total", "Bytes of WebSocket messages sent, by framing", ["framing"]
+)
+
+
+def negotiate_protocol(offered):
+    """Subprotocol to accept from those offered by a client, or None"""
+    for protocol in PROTOCOLS:
+        if protocol in offered:
+            return protocol
+    return None
+
+
+class MessageChannel:
+    """
+    Messages exchanged with a client over a WebSocket.
+
+    Messages are JSON text frames, or MessagePack binary frames when the
+    client negotiated the sapcad.msgpack subprotocol. Either kind of frame
+    is accepted from the client on any connection.
+    """
+
+    def __init__(self, websocket: WebSocket, protocol: str = None):
+        self.websocket = websocket
+        self.protocol = protocol
+        self.binary = protocol == MSGPACK_PROTOCOL
+
+    @classmethod
+    async def accept(cls, websocket: WebSocket):
+        """Accept a connection with the preferred subprotocol the client offered"""
+        protocol = negotiate_protocol(websocket.scope.get("subprotocols") or [])
+        await websocket.accept(subprotocol=protocol)
+        return cls(websocket, protocol)
+
+    async def send(self, message: dict):
+        if self.binary:
+            data = msgpack.packb(message, use_bin_type=True, default=str)
+            await self.websocket.send_bytes(data)
+        else:
+            data = json.dumps(message, separators=(",", ":"))
+            await self.websocket.send_text(data)
+        SENT_BYTES.inc(len(data), framing="msgpack" if self.binary else "json")
+
+    async def receive(self):
+        """
+        Wait for the next message.
+
+        Returns:
+            The decoded message, or the text of a text frame that is not a
+            JSON object (a plain chat message)
+
+        Raises:
+            WebSocketDisconnect: When the client went away
+            ValueError: For a binary frame that can't be decoded
+        """
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+
+        if message.get("bytes") is not None:
+            if msgpack is None:
+                raise ValueError("Binary messages need the msgpack package on the server")
+            try:
+                decoded = msgpack.unpackb(message["bytes"], raw=False)
+            except Exception:
+                raise ValueError("Invalid MessagePack message")
+            if not isinstance(decoded, dict):
+                raise ValueError("A message must be a map")
+            return decoded
+
+        text = message.get("text") or ""
+        try:
+            decoded = json.loads(text)
+        except json.JSONDecodeError:
+            return text
+        return decoded if isinstance(decoded, dict) else text